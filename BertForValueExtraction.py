@@ -91,29 +91,61 @@ class BertForValueExtraction(torch.nn.Module):
         self.token_classifier.save_pretrained(model_path)
         print(f"Saving model at {model_path}")
 
-    def predict_sentence_values(self, tokenizer, sentence, device='cuda'):
-        if device == 'cuda':
-            input_ids = tokenizer(sentence, return_tensors="pt")['input_ids'].to('cuda')
-            preds = self.predict(input_ids).cpu().numpy()[0]
-            input_ids = input_ids.cpu().numpy()[0]
-
-        if device == 'cpu':
-            input_ids = tokenizer(sentence, return_tensors="pt")['input_ids']
-            preds = self.predict(input_ids).numpy()[0]
-            input_ids = input_ids.numpy()[0]
-
-        values = []
-        current_value_tokens = []
-        for t, p in zip(input_ids, preds):
-            if id2label[p] == "O" and current_value_tokens:
-                values.append(tokenizer.decode(current_value_tokens))
-                current_value_tokens = []
-            if id2label[p] == "B":
-                if current_value_tokens:
-                    values.append(tokenizer.decode(current_value_tokens))
-                current_value_tokens = [t]
-            if id2label[p] == "I":
-                current_value_tokens.append(t)
-        if current_value_tokens:
-            values.append(tokenizer.decode(current_value_tokens))
+    def predict_sentence_values(self, tokenizer, sentence, device=None):
+        return self.predict_values(tokenizer, [sentence], device=device)[0]
+
+    def predict_values(self, tokenizer, sentences, batch_size=32, device=None):
+        """
+        Extract the values of many sentences, batched by length so that each batch is padded to its longest sentence
+        :param device: defaults to the device of the model
+        :returns: list of the values found in each sentence
+        """
+        if not sentences:
+            return []
+        device = device or next(self.parameters()).device
+        input_ids = tokenizer(sentences)['input_ids']
+        # longest first, so that batches have sentences of similar lengths
+        order = sorted(range(len(sentences)), key=lambda i: len(input_ids[i]), reverse=True)
+        values = [None]*len(sentences)
+        with torch.inference_mode():
+            for start in range(0, len(order), batch_size):
+                batch = order[start:start+batch_size]
+                lengths = torch.tensor([len(input_ids[i]) for i in batch])
+                padded = torch.full((len(batch), lengths.max()), tokenizer.pad_token_id, dtype=torch.long)
+                attention_mask = torch.arange(lengths.max()) < lengths.unsqueeze(1)
+                padded[attention_mask] = torch.tensor([t for i in batch for t in input_ids[i]])
+                preds = self.predict(padded.to(device), attention_mask=attention_mask.long().to(device),
+                                     token_type_ids=torch.zeros_like(padded).to(device)).cpu()
+                for i, sentence_values in zip(batch, decode_values(tokenizer, padded, preds, attention_mask)):
+                    values[i] = sentence_values
         return values
+
+
+def decode_values(tokenizer, input_ids, preds, attention_mask):
+    """
+    Decode the value spans of a batch of BILUO predictions
+    A value starts at a B, or at an I which does not continue a value, continues over I tokens,
+        and ends at an O or at the next B. L and U tokens are ignored
+    :returns: list of the values found in each sentence
+    """
+    # only keep the tokens which may start, continue or end a value
+    keep = attention_mask & (preds != label2id["L"]) & (preds != label2id["U"])
+    rows, _ = keep.nonzero(as_tuple=True)
+    labels = preds[keep]
+    tokens = input_ids[keep]
+
+    previous = torch.cat([labels.new_tensor([label2id["O"]]), labels[:-1]])
+    new_row = torch.cat([rows.new_tensor([True], dtype=torch.bool), rows[1:] != rows[:-1]])
+    starts = (labels == label2id["B"]) | ((labels == label2id["I"]) & ((previous == label2id["O"]) | new_row))
+    in_value = (labels == label2id["B"]) | (labels == label2id["I"])
+    # index of the value of each token, a value never spans two sentences since each sentence's first value token starts one
+    value_ids = torch.cumsum(starts.long(), dim=0)[in_value] - 1
+
+    values = [[] for _ in range(input_ids.size(0))]
+    if value_ids.numel() == 0:
+        return values
+    value_tokens = torch.split(tokens[in_value], torch.bincount(value_ids).tolist())
+    value_rows = rows[in_value][torch.cat([value_ids.new_tensor([True], dtype=torch.bool), value_ids[1:] != value_ids[:-1]])]
+    for row, value in zip(value_rows.tolist(), tokenizer.batch_decode([v.tolist() for v in value_tokens])):
+        values[row].append(value)
+    return values
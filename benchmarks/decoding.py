@@ -0,0 +1,53 @@
+import os
+import sys
+import json
+
+# run from the repository root: python benchmarks/decoding.py --model_path=$MODEL_PATH
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models.TRADE import TRADE
+from utils.multiwoz import prepare_data, prepare_data_multiwoz_22
+import utils.utils
+
+# the decoding flags compared with the default decode, only early exit may predict different belief states
+DECODES = {"gate_first": {'gate_first_decode': True},
+           "sparse_copy": {'sparse_copy_decode': True},
+           "gate_first_sparse_copy": {'gate_first_decode': True, 'sparse_copy_decode': True},
+           "early_exit": {'early_exit_decode': True, 'gate_first_decode': True, 'sparse_copy_decode': True}}
+
+
+def main(**kwargs):
+    """Time of predicting the dev set with each decoding flag, checking that they predict the same belief states"""
+    assert(kwargs['model_path'] is not None), "benchmarks/decoding.py needs a trained model, set model_path"
+    kwargs = dict(kwargs, load_embedding=False, early_exit_decode=False, gate_first_decode=False, sparse_copy_decode=False)
+
+    if kwargs['dataset'] == 'multiwoz':
+        _, dev, _, lang, slot_list, gating_dict, _ = prepare_data(training=True, **kwargs)
+    if kwargs['dataset'] == 'multiwoz_22':
+        _, dev, _, lang, slot_list, gating_dict, _ = prepare_data_multiwoz_22(training=True, **kwargs)
+
+    model = TRADE(lang, slot_list, gating_dict, **kwargs)
+    model.eval()
+    default, report = model.timed_predict(dev, slot_list[2])
+    report = {"default": report}
+    print(f"default: {report['default']['ms_per_turn']:.3f}ms per turn")
+
+    for name, flags in DECODES.items():
+        # the flags are only read at prediction time, so the same weights are reused
+        model.kwargs.update(flags)
+        predictions, report[name] = model.timed_predict(dev, slot_list[2])
+        model.kwargs.update({flag: False for flag in flags})
+        same = [set(turn["pred_beliefstate_ptr"]) == set(predictions[dialogue_ID][turn_id]["pred_beliefstate_ptr"])
+                for dialogue_ID, turns in default.items() for turn_id, turn in turns.items()]
+        report[name]["same_predictions"] = sum(same)/len(same)
+        print(f"{name}: {report[name]['ms_per_turn']:.3f}ms per turn, "
+              f"{report[name]['same_predictions']:.4f} of the turns predicted as the default decode")
+        if name != "early_exit":
+            assert(all(same)), f"{name} must predict the same belief states as the default decode"
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+
+    main(**utils.utils.parse_args())
@@ -0,0 +1,73 @@
+import os
+import sys
+import json
+import time
+import argparse
+
+# run from the repository root: python benchmarks/ontology_matching.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.utils import find_database_value_in_utterance, load_multiwoz_database, load_multiwoz_22_database
+from utils.ontology_matcher import OntologyMatcher, FuzzyOntologyMatcher
+
+
+def read_utterances(dataset):
+    """user and system utterances of the dev set"""
+    if dataset == 'multiwoz':
+        dialogues = json.load(open('data/dev_dials.json'))
+        return [turn[key] for dial in dialogues for turn in dial['dialogue'] for key in ['system_transcript', 'transcript']]
+    utterances = []
+    for f in ["MultiWOZ_2.2/dev/dialogues_001.json", "MultiWOZ_2.2/dev/dialogues_002.json"]:
+        utterances.extend(turn['utterance'] for dial in json.load(open(f)) for turn in dial['turns'])
+    return utterances
+
+
+def time_per_turn(find, utterances):
+    """returns the values found in each utterance, and the mean milliseconds per utterance"""
+    start = time.perf_counter()
+    found = [find(utterance) for utterance in utterances]
+    return found, (time.perf_counter() - start)*1000/len(utterances)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time of finding the ontology values of dev utterances, for the DB value sources")
+    parser.add_argument('--dataset', type=str, default='multiwoz', choices=['multiwoz', 'multiwoz_22'])
+    parser.add_argument('--max_edits', type=int, nargs='*', default=[1, 2])
+    parser.add_argument('--output', type=str, default=None, help="optional path of a json report")
+    args = parser.parse_args()
+
+    database = load_multiwoz_database() if args.dataset == 'multiwoz' else load_multiwoz_22_database()
+    utterances = read_utterances(args.dataset)
+    print(f"{sum(len(values) for values in database.values())} ontology values, {len(utterances)} utterances")
+
+    report = {}
+    found, report['loop_ms_per_turn'] = time_per_turn(lambda u: find_database_value_in_utterance(u, database), utterances)
+    print(f"substring loop: {report['loop_ms_per_turn']:.3f}ms per turn")
+
+    start = time.perf_counter()
+    matcher = OntologyMatcher(database)
+    report['exact_build_seconds'] = time.perf_counter() - start
+    exact, report['exact_ms_per_turn'] = time_per_turn(lambda u: find_database_value_in_utterance(u, database, matcher),
+                                                       utterances)
+    assert(exact == found), "the exact matcher must find the same values as the substring loop"
+    print(f"exact matcher: {report['exact_ms_per_turn']:.3f}ms per turn, built in {report['exact_build_seconds']:.2f}s")
+
+    n_exact = sum(len(values) for values in exact)
+    for max_edits in args.max_edits:
+        start = time.perf_counter()
+        matcher = FuzzyOntologyMatcher(database, max_edits)
+        build_seconds = time.perf_counter() - start
+        fuzzy, ms_per_turn = time_per_turn(lambda u: find_database_value_in_utterance(u, database, matcher), utterances)
+        n_fuzzy = sum(len(values) for values in fuzzy)
+        report[f"fuzzy_{max_edits}"] = {'build_seconds': build_seconds, 'ms_per_turn': ms_per_turn,
+                                        'additional_values': n_fuzzy - n_exact}
+        print(f"fuzzy matcher, {max_edits} edits: {ms_per_turn:.3f}ms per turn, built in {build_seconds:.2f}s, "
+              f"{n_fuzzy - n_exact} values more than the exact matcher")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+# run from the repository root: python benchmarks/startup.py
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODULES = ['utils.multiwoz', 'train', 'test', 'predictor']
+
+# runs in a fresh interpreter, so that nothing is imported or cached beforehand
+MEASURE = """
+import json, resource, time, importlib
+start = time.perf_counter()
+for module in {modules!r}:
+    importlib.import_module(module)
+import_seconds = time.perf_counter() - start
+load_seconds = 0
+if {appended_values!r} is not None:
+    from utils.value_sources import get_value_source
+    from utils.utils import {load_database}
+    start = time.perf_counter()
+    get_value_source({appended_values!r}, {load_database})
+    load_seconds = time.perf_counter() - start
+# ru_maxrss is in kilobytes on linux
+print(json.dumps({{'import_seconds': import_seconds, 'value_source_seconds': load_seconds,
+                  'max_rss_MB': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024}}))
+"""
+
+
+def measure(modules, appended_values=None, load_database='load_multiwoz_database', repeats=3):
+    """returns the best import time, value source load time and peak memory over repeats fresh interpreters"""
+    runs = []
+    for _ in range(repeats):
+        code = MEASURE.format(modules=modules, appended_values=appended_values, load_database=load_database)
+        output = subprocess.run([sys.executable, '-c', code], cwd=ROOT, check=True, capture_output=True, text=True).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    return {key: min(run[key] for run in runs) for key in runs[0]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import time and memory of the training and prediction entry points")
+    parser.add_argument('--value_sources', nargs='*', default=[],
+                        help="also measure constructing these value sources (e.g. NER DB), they need their dependencies and data")
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--output', type=str, default=None, help="optional path of a json report")
+    args = parser.parse_args()
+
+    report = {}
+    for module in MODULES:
+        report[module] = measure([module], repeats=args.repeats)
+        print(f"import {module}: {report[module]['import_seconds']:.3f}s, {report[module]['max_rss_MB']:.0f}MB")
+    for appended_values in args.value_sources:
+        result = measure(['utils.multiwoz'], appended_values, repeats=args.repeats)
+        report[f"value_source:{appended_values}"] = result
+        print(f"value source {appended_values}: {result['value_source_seconds']:.3f}s, {result['max_rss_MB']:.0f}MB")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+import os
+import json
+import hashlib
+import pickle as pkl
+import torch
+
+from models.TRADE import TRADE
+from models.bundle import BUNDLE_FILE, has_bundle, load_bundle_model
+from models.scripted import ScriptedTRADE, ScriptedTRADERuntime, SCRIPTED_MODEL_FILE, SCRIPTED_VOCAB_FILE
+from utils.multiwoz import get_slot_information, get_slot_information_multiwoz_22
+import utils.utils
+
+ONTOLOGY_PATH = "data/multi-woz/MULTIWOZ2 2/ontology.json"
+# inference decodes at most this many words per slot, as in TRADE.decode_encoded
+MAX_POINTERS = 10
+
+
+def source_fingerprint(kwargs):
+    """Hash of the trained model, vocab, ontology and options, the exported model is rebuilt whenever it changes"""
+    sha = hashlib.sha1()
+    if has_bundle(kwargs['model_path']):
+        # the bundle holds the vocab and slots of the model
+        paths = [os.path.join(kwargs['model_path'], BUNDLE_FILE)]
+    else:
+        paths = [os.path.join(kwargs['model_path'], 'enc.pt'), os.path.join(kwargs['model_path'], 'dec.pt'),
+                 os.path.join(kwargs['lang_path'], 'lang-all.pkl'), ONTOLOGY_PATH]
+    for path in paths:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(2**20), b''):
+                sha.update(chunk)
+    options = {key: kwargs[key] for key in ['dataset', 'hidden', 'causal_encoder', 'drop_slots', 'early_exit_decode']}
+    options.update(max_pointers=MAX_POINTERS, torch_version=torch.__version__)
+    sha.update(json.dumps(options, sort_keys=True).encode())
+    return sha.hexdigest()
+
+
+def is_up_to_date(export_path, fingerprint):
+    vocab_path = os.path.join(export_path, SCRIPTED_VOCAB_FILE)
+    if not os.path.exists(os.path.join(export_path, SCRIPTED_MODEL_FILE)) or not os.path.exists(vocab_path):
+        return False
+    with open(vocab_path, 'r') as f:
+        return json.load(f).get('source_fingerprint') == fingerprint
+
+
+def export(**kwargs):
+    """
+    Compile the encoder and greedy decoder of a trained model with TorchScript,
+        and save it with its vocab so that it can be run with ScriptedTRADERuntime
+    The compiled model is cached in export_path, and only rebuilt when the trained model, vocab or options change
+    :returns: export_path
+    """
+    assert(kwargs['model_path'] is not None), "export needs a trained model, set model_path"
+    export_path = kwargs['export_path'] or os.path.join(kwargs['model_path'], 'scripted')
+    fingerprint = source_fingerprint(kwargs)
+    if is_up_to_date(export_path, fingerprint):
+        print(f"EXPORTED MODEL {export_path} IS UP TO DATE")
+        return export_path
+
+    # export on cpu, the runtime moves the model to its own device
+    if has_bundle(kwargs['model_path']):
+        model, lang, slot_lists, gating_dict, kwargs = load_bundle_model(**dict(kwargs, device='cpu'))
+        slots = slot_lists[0]
+    else:
+        with open(os.path.join(kwargs['lang_path'], 'lang-all.pkl'), 'rb') as handle:
+            lang = pkl.load(handle)
+        with open(os.path.join(kwargs['lang_path'], 'mem-lang-all.pkl'), 'rb') as handle:
+            mem_lang = pkl.load(handle)
+        ontology = json.load(open(ONTOLOGY_PATH, 'r'))
+        if kwargs['dataset'] == 'multiwoz':
+            slots = get_slot_information(ontology, kwargs['drop_slots'])
+        else:
+            slots = get_slot_information_multiwoz_22(ontology, kwargs['drop_slots'])
+        gating_dict = {"ptr": 0, "dontcare": 1, "none": 2}
+
+        kwargs = dict(kwargs, load_embedding=False, device='cpu')
+        model = TRADE([lang, mem_lang], [slots]*4, gating_dict, **kwargs)
+    model.eval()
+    scripted = torch.jit.script(ScriptedTRADE(model.encoder, model.decoder, slots, MAX_POINTERS,
+                                              kwargs['EOS_token'], gating_dict['ptr'],
+                                              early_exit=kwargs['early_exit_decode']).eval())
+    scripted = torch.jit.freeze(scripted)
+
+    os.makedirs(export_path, exist_ok=True)
+    torch.jit.save(scripted, os.path.join(export_path, SCRIPTED_MODEL_FILE))
+    with open(os.path.join(export_path, SCRIPTED_VOCAB_FILE), 'w') as f:
+        json.dump({'source_fingerprint': fingerprint,
+                   'index2word': [lang.index2word[idx] for idx in range(lang.n_words)],
+                   'slots': slots,
+                   'gating_dict': gating_dict,
+                   'UNK_token': kwargs['UNK_token'],
+                   'PAD_token': kwargs['PAD_token'],
+                   'EOS_token': kwargs['EOS_token'],
+                   'early_exit': kwargs['early_exit_decode']}, f)
+    print(f"EXPORTED MODEL TO {export_path}")
+    return export_path
+
+
+def main(**kwargs):
+    export_path = export(**kwargs)
+    # check that the exported model loads without the training dependencies
+    ScriptedTRADERuntime(export_path)
+
+
+if __name__ == "__main__":
+
+    main(**utils.utils.parse_args())
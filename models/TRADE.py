@@ -1,16 +1,22 @@
 import os
 import json
+import time
 import random
+from collections import OrderedDict
 import torch
 import numpy as np
 from tqdm import tqdm
 
-from utils.masked_cross_entropy import masked_cross_entropy_for_value
+from models.bundle import has_bundle, load_bundle, load_quantized_bundle, save_bundle
+from utils.pretrained_embeddings import load_pretrained_emb
+from utils.masked_cross_entropy import masked_cross_entropy_for_value, masked_cross_entropy_for_target_probs
 
 
 class TRADE(torch.nn.Module):
     def __init__(self, lang, slots, gating_dict, **kwargs):
         super(TRADE, self).__init__()
+        # state of a bundle being loaded by models.bundle.load_bundle_model
+        bundle = kwargs.pop('bundle', None)
         self.kwargs = kwargs
         self.hidden_size = kwargs['hidden']
         self.lang = lang[0]
@@ -19,18 +25,31 @@ class TRADE(torch.nn.Module):
         self.dropout = kwargs['dropout']
         # combined slots from all of train, dev, and test
         self.slots = slots[0]
+        # slot lists [all, train, dev, test], saved in the model bundle
+        self.slot_lists = slots
         # self.slot_temp = slots[2] # slots from dev
         self.gating_dict = gating_dict
         self.num_gates = len(self.gating_dict)
         self.cross_entropy = torch.nn.CrossEntropyLoss()
 
+        # a trained model overwrites the pretrained embeddings, don't load them
+        load_embedding = self.kwargs['load_embedding'] and not kwargs['model_path']
         self.encoder = EncoderRNN(
             self.lang.n_words, self.hidden_size, self.dropout, self.kwargs['PAD_token'],
-            self.kwargs['device'], self.kwargs['load_embedding'])
+            self.kwargs['device'], load_embedding, bidirectional=not self.kwargs['causal_encoder'],
+            word2index=self.lang.word2index)
         self.decoder = Generator(self.lang, self.encoder.embedding, self.lang.n_words,
                                  self.hidden_size, self.dropout, self.slots, self.num_gates, self.kwargs['device'])
 
-        if kwargs['model_path'] and 'enc.pt' in os.listdir(kwargs['model_path']):
+        if bundle is not None or has_bundle(kwargs['model_path']):
+            print("MODEL {} LOADED".format(kwargs['model_path']))
+            bundle = bundle or load_bundle(kwargs['model_path'])
+            assert(bundle['slot_w2i'] == self.decoder.slot_w2i), "the slots differ from the slots the model was trained with"
+            # the memory-mapped tensors become the parameters, they are only read from disk when used
+            self.encoder.load_state_dict(bundle['encoder'], assign=True)
+            self.decoder.load_state_dict(bundle['decoder'], assign=True)
+
+        elif kwargs['model_path'] and 'enc.pt' in os.listdir(kwargs['model_path']):
             if self.kwargs['device'] == 'cuda':
                 print("MODEL {} LOADED".format(kwargs['model_path']))
                 trained_encoder = torch.load(kwargs['model_path']+'/enc.pt')
@@ -45,6 +64,15 @@ class TRADE(torch.nn.Module):
             self.encoder.load_state_dict(trained_encoder.state_dict())
             self.decoder.load_state_dict(trained_decoder.state_dict())
 
+        if self.kwargs['quantize'] == 'int8':
+            self.quantize_int8()
+            # the weights saved by quantize.py replace the quantized fp32 weights, when they were quantized from them
+            quantized = load_quantized_bundle(kwargs['model_path'])
+            if quantized is not None:
+                print("QUANTIZED MODEL {} LOADED".format(kwargs['model_path']))
+                self.encoder.load_state_dict(quantized['encoder'])
+                self.decoder.load_state_dict(quantized['decoder'])
+
         # self.optimizer = torch.optim.Adam(self.parameters(), lr=self.lr)
         # self.scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(self.optimizer, mode='max',
         #                                                             factor=0.5, patience=1, min_lr=self.lr/100, verbose=True)
@@ -67,10 +95,22 @@ class TRADE(torch.nn.Module):
         directory = f"save/{self.kwargs['experiment_ID']}-TRADE-{self.kwargs['dataset']}{self.kwargs['task']}/HDD{self.hidden_size}-BSZ{self.kwargs['batch_size']}-DR{self.dropout}-{score}"
         if not os.path.exists(directory):
             os.makedirs(directory)
-        torch.save(self.encoder, directory + '/enc.pt')
-        torch.save(self.decoder, directory + '/dec.pt')
+        save_bundle(self, directory)
         print("MODEL SAVED")
 
+    def quantize_int8(self):
+        """
+        Dynamic int8 quantization for CPU inference, of the GRUs, W_ratio, W_gate,
+            and of the vocab projection in attend_vocab, which uses a copy of the shared embedding matrix
+        Embedding lookups stay in fp32, the quantized model can not be trained
+        """
+        assert(self.kwargs['device'] == 'cpu'), "dynamic quantization only runs on cpu"
+        self.decoder.vocab_projection = torch.nn.Linear(self.hidden_size, self.decoder.vocab_size, bias=False)
+        self.decoder.vocab_projection.weight.data.copy_(self.encoder.embedding.weight.data)
+        torch.ao.quantization.quantize_dynamic(self.encoder, {'gru'}, dtype=torch.qint8, inplace=True)
+        torch.ao.quantization.quantize_dynamic(self.decoder, {'gru', 'W_ratio', 'W_gate', 'vocab_projection'},
+                                               dtype=torch.qint8, inplace=True)
+
     # def reset(self):
     #     self.loss, self.print_every, self.loss_pointer, self.loss_gate = 0, 1, 0, 0
 
@@ -124,13 +164,17 @@ class TRADE(torch.nn.Module):
 
     def calculate_loss_pointer(self, pointer_outputs, pointer_targets, target_lengths):
         # pointer outputs has shape (# slots, batch size, max target length, vocab size)
+        #   or (# slots, batch size, max target length) when only the target probabilities were kept
         # pointer targets has shape (batch size, # slots, max target length)
+        # pointer outputs may be bfloat16 (--bf16), the losses cast them to fp32
+        if pointer_outputs.dim() == 3:
+            return masked_cross_entropy_for_target_probs(pointer_outputs.transpose(0, 1).float(), target_lengths)
         return masked_cross_entropy_for_value(pointer_outputs.transpose(0, 1).contiguous(), pointer_targets.contiguous(), target_lengths)
 
     def calculate_loss_gate(self, gate_outputs, gate_targets):
         # gate outputs has shape (# slots, batch size, # gates)
         # gate targets has shape (batch size, # slots)
-        return self.cross_entropy(gate_outputs.transpose(0, 1).contiguous().view(-1, gate_outputs.shape[-1]), gate_targets.contiguous().view(-1))
+        return self.cross_entropy(gate_outputs.transpose(0, 1).contiguous().view(-1, gate_outputs.shape[-1]).float(), gate_targets.contiguous().view(-1))
 
     # def calculate_loss_batch(self, data, slots, logger=None, reset=False):
     #     """Calculate loss, but not gradients, on a single batch
@@ -199,69 +243,140 @@ class TRADE(torch.nn.Module):
         else:
             story = data['context']
 
-        # Encode the dialogue history
-        encoded_outputs, encoded_hidden = self.encoder(story.transpose(0, 1), data['context_len'])
+        with self.autocast():
+            # Encode the dialogue history
+            encoded_outputs, encoded_hidden = self.encoder(story.transpose(0, 1), data['context_len'])
+
+            return self.decode_encoded(data, story, encoded_outputs, encoded_hidden, use_teacher_forcing, slots)
 
+    def autocast(self):
+        """bfloat16 autocast for --bf16, disabled otherwise. Losses are computed outside of it, in fp32"""
+        device_type = 'cuda' if self.kwargs['device'] == 'cuda' else 'cpu'
+        return torch.autocast(device_type=device_type, dtype=torch.bfloat16, enabled=self.kwargs['bf16'])
+
+    def decode_encoded(self, data, story, encoded_outputs, encoded_hidden, use_teacher_forcing, slots):
+        """Decode a batch whose dialogue history was already encoded (see encode_and_decode)"""
         # Get list of words that can be copied
         batch_size = len(data['context_len'])
         self.copy_list = data['context_plain']
         max_pointers = data['generate_y'].shape[2] if self.encoder.training else 10
+
+        # at inference, optionally stop decoding rows once they are finished
+        if self.row_decode() and not self.decoder.training:
+            return self.decoder.decode(batch_size, encoded_hidden, encoded_outputs, data['context_len'], story, max_pointers,
+                                       slots, self.gating_dict['ptr'], self.kwargs['EOS_token'],
+                                       early_exit=self.kwargs['early_exit_decode'],
+                                       gate_first=self.kwargs['gate_first_decode'],
+                                       sparse_copy=self.kwargs['sparse_copy_decode'])
+
         all_point_outputs, all_gate_outputs, words_pointer_output = self.decoder.forward(batch_size,
                                                                                          encoded_hidden, encoded_outputs, data[
                                                                                              'context_len'], story, max_pointers, data['generate_y'],
-                                                                                         use_teacher_forcing, slots)
+                                                                                         use_teacher_forcing, slots,
+                                                                                         gather_targets=self.kwargs['streaming_loss'] and self.decoder.training,
+                                                                                         pointer_dtype=torch.bfloat16 if self.kwargs['bf16'] else torch.float32)
 
         return all_point_outputs, all_gate_outputs, words_pointer_output
 
-    def evaluate(self, dev, slots, eval_slots, metric_best=None, logger=None, early_stopping=True):
-        print("EVALUATING ON DEV")
-        all_predictions = {}
+    def row_decode(self):
+        """whether inference runs Generator.decode, which stops decoding the rows it does not need"""
+        return self.kwargs['early_exit_decode'] or self.kwargs['gate_first_decode'] or self.kwargs['sparse_copy_decode']
+
+    def get_predicted_beliefs(self, gates, words, slots, batch_size):
+        """Convert decoder outputs into predicted belief states
+        :returns: for each datum in the batch, a list of beliefs formatted as "domain-slot-value"
+        """
         inverse_gating_dict = dict([(v, k) for k, v in self.gating_dict.items()])
-        for j, data_dev in enumerate(tqdm(dev)):
-            batch_size = len(data_dev['context_len'])
-            _, gates, words = self.encode_and_decode(data_dev, False, slots)
-
-            for batch_idx in range(batch_size):
-                if data_dev["ID"][batch_idx] not in all_predictions.keys():
-                    all_predictions[data_dev['ID'][batch_idx]] = {}
-                all_predictions[data_dev["ID"][batch_idx]][data_dev["turn_id"][batch_idx]] = {
-                    "turn_belief": data_dev["turn_belief"][batch_idx]}
-                predict_belief_bsz_ptr = []
-                predicted_gates = torch.argmax(
-                    gates.transpose(0, 1)[batch_idx], dim=1)
-
-                for slot_idx, gate in enumerate(predicted_gates):
-                    if gate == self.gating_dict['none']:
-                        continue
-                    elif gate == self.gating_dict['ptr']:
-                        pred = np.transpose(words[slot_idx])[batch_idx]
-                        st = []
-                        for token in pred:
-                            if token == 'EOS':
-                                break
-                            else:
-                                st.append(token)
-                        st = " ".join(st)
-                        if st == 'none':
-                            continue
+        # only the rows stopped at EOS by --early_exit_decode are truncated at the vocab's EOS word,
+        #   every other decode keeps the words predicted after it, as the original evaluation did
+        EOS_words = ['EOS', self.lang.index2word[self.kwargs['EOS_token']]] if self.kwargs['early_exit_decode'] else ['EOS']
+        predicted_beliefs = []
+        for batch_idx in range(batch_size):
+            predict_belief_bsz_ptr = []
+            predicted_gates = torch.argmax(
+                gates.transpose(0, 1)[batch_idx], dim=1)
+
+            for slot_idx, gate in enumerate(predicted_gates):
+                if gate == self.gating_dict['none']:
+                    continue
+                elif gate == self.gating_dict['ptr']:
+                    pred = np.transpose(words[slot_idx])[batch_idx]
+                    st = []
+                    for token in pred:
+                        if token in EOS_words:
+                            break
                         else:
-                            predict_belief_bsz_ptr.append(
-                                f"{slots[slot_idx]}-{st}")
+                            st.append(token)
+                    st = " ".join(st)
+                    if st == 'none':
+                        continue
                     else:
-                        predict_belief_bsz_ptr.append(
-                            f"{slots[slot_idx]}-{inverse_gating_dict[gate.item()]}")
+                        predict_belief_bsz_ptr.append(f"{slots[slot_idx]}-{st}")
+                else:
+                    predict_belief_bsz_ptr.append(f"{slots[slot_idx]}-{inverse_gating_dict[gate.item()]}")
+            predicted_beliefs.append(predict_belief_bsz_ptr)
+        return predicted_beliefs
 
-                all_predictions[data_dev["ID"][batch_idx]][data_dev["turn_id"]
-                                                           [batch_idx]]["pred_beliefstate_ptr"] = predict_belief_bsz_ptr
+    def predict_beliefs(self, data, slots):
+        """Predict the belief state of every datum in a single batch of data from the dataloader"""
+        batch_size = len(data['context_len'])
+        _, gates, words = self.encode_and_decode(data, False, slots)
+        return self.get_predicted_beliefs(gates, words, slots, batch_size)
 
-                if set(data_dev['turn_belief'][batch_idx]) != set(predict_belief_bsz_ptr) and self.kwargs['gen_sample']:
-                    print("True", set(data_dev["turn_belief"][batch_idx]))
+    def predict(self, dataloader, slots):
+        """Predict belief states for every turn in a dataloader
+        :returns: dict of dialogues, each dialogue contains turns with ground truth turn beliefs and predicted beliefs
+        """
+        all_predictions = {}
+        for j, data in enumerate(tqdm(dataloader)):
+            predicted_beliefs = self.predict_beliefs(data, slots)
+
+            for batch_idx, predict_belief_bsz_ptr in enumerate(predicted_beliefs):
+                if data["ID"][batch_idx] not in all_predictions.keys():
+                    all_predictions[data['ID'][batch_idx]] = {}
+                all_predictions[data["ID"][batch_idx]][data["turn_id"][batch_idx]] = {
+                    "turn_belief": data["turn_belief"][batch_idx],
+                    "pred_beliefstate_ptr": predict_belief_bsz_ptr}
+
+                if self.kwargs['gen_sample'] and set(data['turn_belief'][batch_idx]) != set(predict_belief_bsz_ptr):
+                    print("True", set(data["turn_belief"][batch_idx]))
                     print("Pred", set(predict_belief_bsz_ptr), "\n")
 
         if self.kwargs['gen_sample']:
             json.dump(all_predictions, open(
                 "all_prediction_{}.json".format(self.name), 'w'), indent=2)
 
+        return all_predictions
+
+    def timed_predict(self, dataloader, slots):
+        """Predict belief states for every turn in a dataloader without gradients, timing the predictions
+        :returns: all predictions, and a dict with the prediction latency and throughput
+        """
+        start = time.perf_counter()
+        with torch.no_grad():
+            all_predictions = self.predict(dataloader, slots)
+        seconds = time.perf_counter() - start
+        num_turns = sum(len(turns) for turns in all_predictions.values())
+        return all_predictions, {"seconds": seconds,
+                                 "ms_per_turn": 1000*seconds/num_turns,
+                                 "turns_per_second": num_turns/seconds}
+
+    def timed_evaluation(self, dataloader, slots, eval_slots):
+        """Predict and score every turn in a dataloader, timing the predictions
+        :returns: all predictions, and a dict of metrics from evaluate_metrics with the prediction latency
+        """
+        all_predictions, timing = self.timed_predict(dataloader, slots)
+
+        joint_acc_score, turn_acc_score, joint_F1_score, _, _, _, _ = self.evaluate_metrics(
+            all_predictions, "pred_beliefstate_ptr", eval_slots)
+        return all_predictions, dict({"Joint_accuracy": joint_acc_score,
+                                      "Turn accuracy": turn_acc_score,
+                                      "Joint F1": joint_F1_score}, **timing)
+
+    def evaluate(self, dev, slots, eval_slots, metric_best=None, logger=None, early_stopping=True):
+        print("EVALUATING ON DEV")
+        all_predictions, timing = self.timed_predict(dev, slots)
+
         joint_acc_score, turn_acc_score, joint_F1_score, individual_slot_scores, joint_success, FN_slots, FP_slots = self.evaluate_metrics(
             all_predictions, "pred_beliefstate_ptr", eval_slots)
 
@@ -281,6 +396,8 @@ class TRADE(torch.nn.Module):
                                                              'FP_slots': FP_slots
                                                              }])
         print(evaluation_metrics)
+        # kept with the latency, so that train.py can compare it with other precisions without evaluating again
+        self.last_evaluation = dict(evaluation_metrics, **timing)
 
         if (early_stopping == "F1"):
             if joint_F1_score >= metric_best:
@@ -293,49 +410,7 @@ class TRADE(torch.nn.Module):
 
     def test(self, test, slots, eval_slots, logger=None):
         print("EVALUATING ON TEST")
-        all_predictions = {}
-        inverse_gating_dict = dict([(v, k) for k, v in self.gating_dict.items()])
-        for j, data_test in enumerate(tqdm(test)):
-            batch_size = len(data_test['context_len'])
-            _, gates, words = self.encode_and_decode(data_test, False, slots)
-
-            for batch_idx in range(batch_size):
-                if data_test["ID"][batch_idx] not in all_predictions.keys():
-                    all_predictions[data_test['ID'][batch_idx]] = {}
-                all_predictions[data_test["ID"][batch_idx]][data_test["turn_id"][batch_idx]] = {"turn_belief": data_test["turn_belief"][batch_idx]}
-                predict_belief_bsz_ptr = []
-                predicted_gates = torch.argmax(
-                    gates.transpose(0, 1)[batch_idx], dim=1)
-
-                for slot_idx, gate in enumerate(predicted_gates):
-                    if gate == self.gating_dict['none']:
-                        continue
-                    elif gate == self.gating_dict['ptr']:
-                        pred = np.transpose(words[slot_idx])[batch_idx]
-                        st = []
-                        for token in pred:
-                            if token == 'EOS':
-                                break
-                            else:
-                                st.append(token)
-                        st = " ".join(st)
-                        if st == 'none':
-                            continue
-                        else:
-                            predict_belief_bsz_ptr.append(f"{slots[slot_idx]}-{st}")
-                    else:
-                        predict_belief_bsz_ptr.append(f"{slots[slot_idx]}-{inverse_gating_dict[gate.item()]}")
-
-                all_predictions[data_test["ID"][batch_idx]][data_test["turn_id"]
-                                                            [batch_idx]]["pred_beliefstate_ptr"] = predict_belief_bsz_ptr
-
-                if self.kwargs['gen_sample'] and set(data_test['turn_belief'][batch_idx]) != set(predict_belief_bsz_ptr):
-                    print("True", set(data_test["turn_belief"][batch_idx]))
-                    print("Pred", set(predict_belief_bsz_ptr), "\n")
-
-        if self.kwargs['gen_sample']:
-            json.dump(all_predictions, open(
-                "all_prediction_{}.json".format(self.name), 'w'), indent=2)
+        all_predictions = self.predict(test, slots)
 
         joint_acc_score, turn_acc_score, joint_F1_score, individual_slot_scores, joint_success, FN_slots, FP_slots = self.evaluate_metrics(
             all_predictions, "pred_beliefstate_ptr", eval_slots)
@@ -503,28 +578,35 @@ class TRADE(torch.nn.Module):
 
 
 class EncoderRNN(torch.nn.Module):
-    def __init__(self, vocab_size, hidden_size, dropout, PAD_token, device, load_embedding, n_layers=1):
+    def __init__(self, vocab_size, hidden_size, dropout, PAD_token, device, load_embedding, n_layers=1, bidirectional=True,
+                 word2index=None):
+        """
+        :param bidirectional: if False, the encoder is causal, each output only depends on earlier tokens
+            a causal encoder can encode a dialogue one turn at a time (see encode_turn)
+        :param word2index: vocab of the pretrained embeddings, needed if load_embedding
+        """
         super(EncoderRNN, self).__init__()
         self.vocab_size = vocab_size
         self.hidden_size = hidden_size
         self.device = device
         self.dropout = dropout
+        self.bidirectional = bidirectional
         self.dropout_layer = torch.nn.Dropout(dropout)
         self.embedding = torch.nn.Embedding(vocab_size, hidden_size, padding_idx=PAD_token)
         self.embedding.weight.data.normal_(0, 0.1)
-        self.gru = torch.nn.GRU(hidden_size, hidden_size, n_layers, dropout=self.dropout, bidirectional=True)
+        self.gru = torch.nn.GRU(hidden_size, hidden_size, n_layers, dropout=self.dropout, bidirectional=bidirectional)
 
         if load_embedding:
-            with open(os.path.join('data', f'emb{self.vocab_size}.json')) as f:
-                E = json.load(f)
-            new = self.embedding.weight.data.new
-            self.embedding.weight.data.copy_(new(E))
+            E = load_pretrained_emb(word2index)
+            # copied straight from the memory-mapped matrix into the parameter
+            self.embedding.weight.data.copy_(torch.from_numpy(E))
             self.embedding.weight.requires_grad = True
             print("Encoder embedding requires_grad", self.embedding.weight.requires_grad)
 
     def get_state(self, batch_size):
         """Get cell states and hidden states"""
-        return torch.autograd.Variable(torch.zeros(2, batch_size, self.hidden_size)).to(self.device)
+        num_directions = 2 if self.bidirectional else 1
+        return torch.autograd.Variable(torch.zeros(num_directions, batch_size, self.hidden_size)).to(self.device)
 
     def forward(self, input_sequences, input_lengths=None):
         embedded = self.embedding(input_sequences)
@@ -536,11 +618,73 @@ class EncoderRNN(torch.nn.Module):
         outputs, hidden = self.gru(embedded, hidden)
         if input_lengths:
             outputs, _ = torch.nn.utils.rnn.pad_packed_sequence(outputs, batch_first=False)
+        if not self.bidirectional:
+            return outputs.transpose(0, 1), hidden
         hidden = hidden[0] + hidden[1]
         outputs = outputs[:, :, :self.hidden_size] + \
             outputs[:, :, self.hidden_size:]
         return outputs.transpose(0, 1), hidden.unsqueeze(0)
 
+    def encode_turn(self, turn_tokens, state=None):
+        """Encode only the tokens of a new turn, continuing from the state of the previous turns
+        Only possible for a causal (unidirectional) encoder, where the result matches encoding the whole history
+        :param turn_tokens: LongTensor of the new turn's token indices, shape (turn length,)
+        :param state: (outputs, hidden) returned for the previous turn of the same dialogue, or None
+        :returns: (outputs, hidden) for the whole history so far,
+            outputs has shape (1, history length, hidden size) and hidden has shape (1, 1, hidden size)
+        """
+        assert(not self.bidirectional), "Only a causal encoder can encode a dialogue turn by turn"
+        embedded = self.dropout_layer(self.embedding(turn_tokens.unsqueeze(1)))
+        prev_outputs, hidden = state if state is not None else (None, self.get_state(1))
+        outputs, hidden = self.gru(embedded, hidden)
+        outputs = outputs.transpose(0, 1)
+        if prev_outputs is not None:
+            outputs = torch.cat([prev_outputs, outputs], dim=1)
+        return outputs, hidden
+
+
+class EncoderStateCache():
+    """
+    LRU cache of encoder states (outputs, hidden) by dialogue ID, for encoding live dialogues turn by turn
+    The least recently used dialogues are evicted once the cached tensors take more than max_bytes
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.states = OrderedDict()
+        self.num_bytes = 0
+
+    def __len__(self):
+        return len(self.states)
+
+    def __contains__(self, dialogue_ID):
+        return dialogue_ID in self.states
+
+    def state_bytes(self, state):
+        return sum(t.numel()*t.element_size() for t in state)
+
+    def get(self, dialogue_ID):
+        """returns the state of a dialogue, or None if it is not cached"""
+        if dialogue_ID not in self.states:
+            return None
+        self.states.move_to_end(dialogue_ID)
+        return self.states[dialogue_ID]
+
+    def put(self, dialogue_ID, state):
+        self.pop(dialogue_ID)
+        self.states[dialogue_ID] = state
+        self.num_bytes += self.state_bytes(state)
+        # evict least recently used dialogues, but always keep the newest state
+        while self.num_bytes > self.max_bytes and len(self.states) > 1:
+            _, evicted = self.states.popitem(last=False)
+            self.num_bytes -= self.state_bytes(evicted)
+
+    def pop(self, dialogue_ID):
+        state = self.states.pop(dialogue_ID, None)
+        if state is not None:
+            self.num_bytes -= self.state_bytes(state)
+        return state
+
 
 class Generator(torch.nn.Module):
     def __init__(self, lang, shared_emb, vocab_size, hidden_size, dropout, slots, num_gates, device):
@@ -559,6 +703,8 @@ class Generator(torch.nn.Module):
         self.device = device
 
         self.W_gate = torch.nn.Linear(hidden_size, num_gates)
+        # quantized copy of the shared embedding used by attend_vocab, only set by TRADE.quantize_int8
+        self.vocab_projection = None
 
         # Create independent slot embeddings
         self.slot_w2i = {}
@@ -571,14 +717,10 @@ class Generator(torch.nn.Module):
         self.Slot_emb = torch.nn.Embedding(len(self.slot_w2i), hidden_size)
         self.Slot_emb.weight.data.normal_(0, 0.1)
 
-    def forward(self, batch_size, encoded_hidden, encoded_outputs,
-                encoded_lengths, story, max_pointers, target_batches, use_teacher_forcing, slots):
-
-        # initialize tensors for pointers and gates
-        all_pointer_outputs = torch.zeros([len(slots), batch_size, max_pointers, self.vocab_size], device=self.device)
-        all_gate_outputs = torch.zeros([len(slots), batch_size, self.num_gates], device=self.device)
-
-        # Get slot embeddings
+    def get_slot_embeddings(self, slots, encoded_hidden):
+        """Combine domain and slot embeddings for each slot, expanded for each datum in the batch
+        :returns: tensor of shape (|slots|, batch size, hidden size)
+        """
         slot_emb_dict = {}
         for i, slot in enumerate(slots):
             # Domain embedding
@@ -603,6 +745,28 @@ class Generator(torch.nn.Module):
             else:
                 slot_emb_arr = torch.cat(
                     (slot_emb_arr, slot_emb_expanded), dim=0)
+        return slot_emb_arr
+
+    def forward(self, batch_size, encoded_hidden, encoded_outputs,
+                encoded_lengths, story, max_pointers, target_batches, use_teacher_forcing, slots,
+                gather_targets=False, pointer_dtype=torch.float32):
+        """
+        :param gather_targets: instead of the full pointer distributions, only keep the probability of each target word
+            all_pointer_outputs then has shape (|slots|, batch size, max_pointers),
+            and words are only predicted when not using teacher forcing
+        :param pointer_dtype: dtype of all_pointer_outputs, bfloat16 halves its memory when training with --bf16
+        """
+
+        # initialize tensors for pointers and gates
+        if gather_targets:
+            all_pointer_outputs = torch.zeros([len(slots), batch_size, max_pointers], dtype=pointer_dtype, device=self.device)
+        else:
+            all_pointer_outputs = torch.zeros([len(slots), batch_size, max_pointers, self.vocab_size],
+                                              dtype=pointer_dtype, device=self.device)
+        all_gate_outputs = torch.zeros([len(slots), batch_size, self.num_gates], device=self.device)
+
+        # Get slot embeddings
+        slot_emb_arr = self.get_slot_embeddings(slots, encoded_hidden)
 
         # In this implementation we only use parallel decode
         # if self.kwargs['parallel_decode']:
@@ -612,22 +776,48 @@ class Generator(torch.nn.Module):
         hidden = encoded_hidden.repeat(1, len(slots), 1)  # 1 * (batch*|slot|) * emb
         words_point_out = [[] for i in range(len(slots))]
 
+        # encoder outputs and story are shared by all slots, only the padding mask is computed up front
+        enc_mask = self.length_mask(encoded_lengths, encoded_outputs.size(1))
+
         for word_idx in range(max_pointers):
             dec_state, hidden = self.gru(decoder_input.expand_as(hidden), hidden)
 
-            enc_out = encoded_outputs.repeat(len(slots), 1, 1)
-            enc_len = encoded_lengths * len(slots)
-            context_vec, logits, prob = self.attend(enc_out, hidden.squeeze(0), enc_len)
+            context_vec, logits, prob = self.attend(encoded_outputs, hidden.squeeze(0), enc_mask)
 
             if word_idx == 0:
                 all_gate_outputs = torch.reshape(self.W_gate(context_vec), all_gate_outputs.size())
 
-            p_vocab = self.attend_vocab(self.embedding.weight, hidden.squeeze(0))
             p_gen_vec = torch.cat([dec_state.squeeze(0), context_vec, decoder_input], -1)
             vocab_pointer_switches = self.sigmoid(self.W_ratio(p_gen_vec))
-            p_context_ptr = torch.zeros(p_vocab.size(), device=self.device)
 
-            p_context_ptr.scatter_add_(1, story.repeat(len(slots), 1), prob)
+            if gather_targets:
+                # probability of the target word only: copy probability from every story position holding the target,
+                #   plus the vocab probability of the target
+                target_words = torch.flatten(target_batches[:, :, word_idx].transpose(1, 0))
+                target_positions = story.unsqueeze(0) == target_words.view(len(slots), batch_size, 1)
+                p_context_target = prob.mul(target_positions.view(prob.size())).sum(1, keepdim=True)
+                p_vocab_target = self.attend_vocab_targets(self.embedding.weight, hidden.squeeze(0), target_words)
+                final_p_target = (1 - vocab_pointer_switches) * p_context_target + vocab_pointer_switches * p_vocab_target
+                all_pointer_outputs[:, :, word_idx] = torch.reshape(final_p_target, (len(slots), batch_size))
+
+                if use_teacher_forcing:
+                    decoder_input = self.embedding(target_words)
+                    continue
+
+                # greedy prediction is not part of the loss, so the full distribution is not kept for backward
+                with torch.no_grad():
+                    p_vocab = self.attend_vocab(self.embedding.weight, hidden.squeeze(0))
+                    p_context_ptr = self.point_to_story(prob, story)
+                    final_p_vocab = (1 - vocab_pointer_switches) * p_context_ptr + vocab_pointer_switches * p_vocab
+                    pred_word = torch.argmax(final_p_vocab, dim=1)
+                words = [self.lang.index2word[w_idx.item()] for w_idx in pred_word]
+                for si in range(len(slots)):
+                    words_point_out[si].append(words[si*batch_size:(si+1)*batch_size])
+                decoder_input = self.embedding(pred_word)
+                continue
+
+            p_vocab = self.attend_vocab(self.embedding.weight, hidden.squeeze(0))
+            p_context_ptr = self.point_to_story(prob, story)
 
             final_p_vocab = (1 - vocab_pointer_switches).expand_as(p_context_ptr) * p_context_ptr + \
                 vocab_pointer_switches.expand_as(p_context_ptr) * p_vocab
@@ -646,20 +836,193 @@ class Generator(torch.nn.Module):
 
         return all_pointer_outputs, all_gate_outputs, words_point_out
 
-    def attend(self, seq, cond, lens):
+    def decode(self, batch_size, encoded_hidden, encoded_outputs,
+               encoded_lengths, story, max_pointers, slots, ptr_gate, EOS_token, early_exit=False, gate_first=False,
+               sparse_copy=False):
+        """Greedy decoding for inference which drops finished (slot, batch) rows from the decoder
+        A row is finished after the first step if its gate is not ptr, its words are never used
+        Rows gated ptr predict the same words as forward, for all max_pointers steps unless early_exit
+        Finished rows are padded with EOS, and pointer distributions are not kept (None is returned in their place)
+        :param ptr_gate: index of the ptr gate in the gating dict
+        :param EOS_token: index of the EOS token in the vocabulary
+        :param early_exit: also finish rows once they predict EOS, the words they would predict after it are lost
+        :param gate_first: take the gates from the first decoder step of all rows, then only generate words for
+            rows gated ptr. Rows with any other gate are never generated, not even their first word
+        :param sparse_copy: keep the copy distribution over story tokens only, and only compute the vocab distribution
+            for rows where generating from the vocab could beat copying (see sparse_pointer_argmax)
+        """
+        num_rows = len(slots)*batch_size
+        slot_emb_arr = self.get_slot_embeddings(slots, encoded_hidden)
+
+        decoder_input = self.dropout_layer(slot_emb_arr).view(-1, self.hidden_size)  # (batch*|slot|) * emb
+        hidden = encoded_hidden.repeat(1, len(slots), 1).squeeze(0)  # (batch*|slot|) * emb
+
+        # while all rows are active, the encoder outputs and story of each batch are shared by all slots
+        # once rows are dropped, they are gathered per remaining row
+        enc_mask = self.length_mask(encoded_lengths, encoded_outputs.size(1))
+        enc_out, enc_mask_rows, story_rows = encoded_outputs, enc_mask, story
+        story_ids, story_tokens = self.story_vocab(story)
+        story_ids_rows, story_tokens_rows = story_ids, story_tokens
+
+        # index of every active row into the (|slot|*batch) rows
+        active_rows = torch.arange(num_rows, device=self.device)
+        pred_words = torch.full((num_rows, max_pointers), EOS_token, dtype=torch.long, device=self.device)
+
+        for word_idx in range(max_pointers):
+            dec_state, hidden = self.gru(decoder_input.unsqueeze(0), hidden.unsqueeze(0))
+            dec_state, hidden = dec_state.squeeze(0), hidden.squeeze(0)
+            context_vec, logits, prob = self.attend(enc_out, hidden, enc_mask_rows)
+
+            if word_idx == 0:
+                all_gate_outputs = torch.reshape(self.W_gate(context_vec), (len(slots), batch_size, self.num_gates))
+                ptr_rows = torch.argmax(all_gate_outputs, dim=2).view(-1) == ptr_gate
+
+                # second phase only continues with the rows gated ptr
+                if gate_first:
+                    if not ptr_rows.any():
+                        break
+                    active_rows, hidden, dec_state, context_vec, prob, decoder_input = \
+                        self.select_rows(ptr_rows, [active_rows, hidden, dec_state, context_vec, prob, decoder_input])
+                    enc_out, enc_mask_rows, story_rows, story_ids_rows, story_tokens_rows = \
+                        self.select_rows(active_rows % batch_size, [encoded_outputs, enc_mask, story, story_ids, story_tokens])
+
+            p_gen_vec = torch.cat([dec_state, context_vec, decoder_input], -1)
+            vocab_pointer_switches = self.sigmoid(self.W_ratio(p_gen_vec))
+
+            if sparse_copy:
+                pred_word = self.sparse_pointer_argmax(hidden, prob, vocab_pointer_switches,
+                                                       story_ids_rows, story_tokens_rows)
+            else:
+                p_vocab = self.attend_vocab(self.embedding.weight, hidden)
+                p_context_ptr = self.point_to_story(prob, story_rows)
+
+                final_p_vocab = (1 - vocab_pointer_switches).expand_as(p_context_ptr) * p_context_ptr + \
+                    vocab_pointer_switches.expand_as(p_context_ptr) * p_vocab
+                pred_word = torch.argmax(final_p_vocab, dim=1)
+            pred_words[active_rows, word_idx] = pred_word
+
+            # drop rows which are finished
+            keep = pred_word != EOS_token if early_exit else torch.ones_like(pred_word, dtype=torch.bool)
+            if word_idx == 0 and not gate_first:
+                keep &= ptr_rows
+            if not keep.any():
+                break
+            if not keep.all():
+                active_rows, hidden, pred_word = self.select_rows(keep, [active_rows, hidden, pred_word])
+                enc_out, enc_mask_rows, story_rows, story_ids_rows, story_tokens_rows = \
+                    self.select_rows(active_rows % batch_size, [encoded_outputs, enc_mask, story, story_ids, story_tokens])
+
+            decoder_input = self.embedding(pred_word)
+
+        # words_point_out[slot][word_idx][batch_idx], as in forward
+        pred_words = pred_words.view(len(slots), batch_size, max_pointers).transpose(1, 2).tolist()
+        words_point_out = [[[self.lang.index2word[w_idx] for w_idx in step] for step in slot_words]
+                           for slot_words in pred_words]
+
+        return None, all_gate_outputs, words_point_out
+
+    def select_rows(self, rows, row_tensors):
+        """Index the rows (first dimension) of each tensor with `rows`, either a boolean mask or indices"""
+        return [t[rows] for t in row_tensors]
+
+    def length_mask(self, lengths, max_len):
+        """
+        boolean mask of shape (batch, max_len), True for positions inside each sequence length
+        """
+        lengths = torch.as_tensor(lengths, device=self.device)
+        return torch.arange(max_len, device=self.device).unsqueeze(0) < lengths.unsqueeze(1)
+
+    def attend(self, seq, cond, mask):
         """
         attend over the sequences `seq` using the condition `cond`.
+        `seq` (batch * len * hidden) is shared by every group of batch rows in `cond`,
+            so cond of shape ((|slot|*batch) * hidden) attends over the same sequences for each slot
+        `mask` (batch * len) is False at padding positions
         """
-        scores_ = cond.unsqueeze(1).expand_as(seq).mul(seq).sum(2)
-        max_len = max(lens)
-        for i, l in enumerate(lens):
-            if l < max_len:
-                scores_.data[i, l:] = -np.inf
-        scores = torch.nn.functional.softmax(scores_, dim=1)
-        context = scores.unsqueeze(2).expand_as(seq).mul(seq).sum(1)
-        return context, scores_, scores
+        batch_size, max_len = mask.size()
+        cond = cond.view(-1, batch_size, cond.size(-1))
+        scores_ = torch.einsum('sbh,blh->sbl', cond, seq)
+        scores_ = scores_.masked_fill(~mask.unsqueeze(0), -np.inf)
+        scores = torch.nn.functional.softmax(scores_, dim=2)
+        context = torch.einsum('sbl,blh->sbh', scores, seq)
+        return context.reshape(-1, seq.size(2)), scores_.view(-1, max_len), scores.view(-1, max_len)
+
+    def point_to_story(self, prob, story):
+        """
+        scatter the attention over story positions onto the vocab,
+            with `story` (batch * len) shared by every group of batch rows in `prob` ((|slot|*batch) * len)
+        """
+        batch_size, max_len = story.size()
+        prob = prob.view(-1, batch_size, max_len)
+        p_context_ptr = torch.zeros(prob.size(0), batch_size, self.vocab_size, dtype=prob.dtype, device=self.device)
+        p_context_ptr.scatter_add_(2, story.unsqueeze(0).expand_as(prob), prob)
+        return p_context_ptr.view(-1, self.vocab_size)
+
+    def story_vocab(self, story):
+        """
+        map every story position to the index of its token among the unique tokens of its story
+        :returns: story_ids (batch * len), index of each position's token in story_tokens
+                  story_tokens (batch * len), unique tokens of each story, padded with the PAD token
+        """
+        sorted_story, order = story.sort(dim=1)
+        new_token = torch.ones_like(sorted_story, dtype=torch.bool)
+        new_token[:, 1:] = sorted_story[:, 1:] != sorted_story[:, :-1]
+        unique_idx = new_token.long().cumsum(1) - 1
+        story_ids = torch.empty_like(story).scatter_(1, order, unique_idx)
+        story_tokens = torch.full_like(story, self.embedding.padding_idx).scatter_(1, unique_idx, sorted_story)
+        return story_ids, story_tokens
+
+    def sparse_pointer_argmax(self, hidden, prob, vocab_pointer_switches, story_ids, story_tokens):
+        """
+        argmax of the pointer-generator distribution without building the dense copy distribution
+        The copy distribution is summed over the unique tokens of each story.
+        A token outside the story only gets probability from the vocab, at most the switch value,
+            so when the top copied token beats the runner-up by more than the switch value, the vocab is never computed.
+        Otherwise the vocab distribution is computed for those rows, and the best story token is compared with the
+            best vocab token.
+        `story_ids` and `story_tokens` (from story_vocab) are shared by every group of batch rows in `prob`
+        """
+        batch_size, max_len = story_ids.size()
+        p_copy = torch.zeros(prob.size(0)//batch_size, batch_size, max_len, dtype=prob.dtype, device=self.device)
+        p_copy.scatter_add_(2, story_ids.unsqueeze(0).expand_as(p_copy), prob.view(p_copy.size()))
+        p_copy = (1 - vocab_pointer_switches) * p_copy.view(-1, max_len)
+        story_tokens = story_tokens.unsqueeze(0).expand(p_copy.size(0)//batch_size, -1, -1).reshape(p_copy.size())
+
+        if max_len > 1:
+            top_copy, top_idx = p_copy.topk(2, dim=1)
+            copy_margin = top_copy[:, 0] - top_copy[:, 1]
+        else:
+            top_copy, top_idx = p_copy, torch.zeros_like(story_tokens)
+            copy_margin = top_copy[:, 0]
+        pred_word = story_tokens.gather(1, top_idx[:, :1]).squeeze(1)
+
+        needs_vocab = copy_margin <= vocab_pointer_switches.squeeze(1)
+        if needs_vocab.any():
+            switches = vocab_pointer_switches[needs_vocab]
+            p_vocab = switches * self.attend_vocab(self.embedding.weight, hidden[needs_vocab])
+            # story tokens get both their copy and vocab probability
+            p_story = p_copy[needs_vocab] + p_vocab.gather(1, story_tokens[needs_vocab])
+            best_story, best_story_idx = p_story.max(dim=1)
+            best_vocab, best_vocab_word = p_vocab.max(dim=1)
+            story_word = story_tokens[needs_vocab].gather(1, best_story_idx.unsqueeze(1)).squeeze(1)
+            pred_word[needs_vocab] = torch.where(best_story >= best_vocab, story_word, best_vocab_word)
+        return pred_word
+
+    def vocab_scores(self, seq, cond):
+        """scores of `cond` against every word, `seq` is the shared embedding matrix unless it was quantized"""
+        if self.vocab_projection is not None:
+            return self.vocab_projection(cond)
+        return cond.matmul(seq.transpose(1, 0))
 
     def attend_vocab(self, seq, cond):
-        scores_ = cond.matmul(seq.transpose(1, 0))
+        scores_ = self.vocab_scores(seq, cond)
         scores = torch.nn.functional.softmax(scores_, dim=1)
         return scores
+
+    def attend_vocab_targets(self, seq, cond, targets):
+        """
+        probability of each target under the vocab distribution, without keeping the full softmax
+        """
+        scores_ = self.vocab_scores(seq, cond)
+        log_scores = scores_.gather(1, targets.unsqueeze(1)) - torch.logsumexp(scores_, dim=1, keepdim=True)
+        return log_scores.exp()
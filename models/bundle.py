@@ -0,0 +1,111 @@
+import os
+import torch
+
+# a bundle holds everything needed to predict with a trained model, without the training data
+# this module must not import utils.multiwoz (spaCy, transformers, embeddings)
+
+BUNDLE_FILE = 'bundle.pt'
+# weights of the model quantized by quantize.py, next to the fp32 bundle they were quantized from
+QUANTIZED_BUNDLE_FILE = 'bundle-int8.pt'
+# bump when the layout of the bundle changes
+BUNDLE_VERSION = 1
+
+# options the model was built and trained with, they override the options of the loading script
+BUNDLE_HYPERPARAMETERS = ['hidden', 'dropout', 'causal_encoder', 'dataset', 'drop_slots',
+                          'USR_SYS_tokens', 'appended_values', 'append_SYS_values', 'ground_truth_slots',
+                          'UNK_token', 'PAD_token', 'SOS_token', 'EOS_token', 'ENT_token', 'SYS_token', 'USR_token']
+
+
+class BundleLang():
+    """Vocabulary of a bundle, with the lookups of utils.multiwoz.Lang used for prediction"""
+
+    def __init__(self, word2index):
+        self.word2index = word2index
+        self.index2word = {index: word for word, index in word2index.items()}
+        self.n_words = len(word2index)
+
+
+def has_bundle(model_path):
+    return model_path is not None and os.path.exists(os.path.join(model_path, BUNDLE_FILE))
+
+
+def save_bundle(model, directory):
+    """
+    Save the weights of a TRADE model with its vocab, slots and hyperparameters in directory/BUNDLE_FILE
+    Tensors are saved in torch's zip format, so that load_bundle can memory-map them
+    """
+    bundle = {'version': BUNDLE_VERSION,
+              'encoder': model.encoder.state_dict(),
+              'decoder': model.decoder.state_dict(),
+              'word2index': model.lang.word2index,
+              'slots': model.slot_lists,
+              'gating_dict': model.gating_dict,
+              'slot_w2i': model.decoder.slot_w2i,
+              'hyperparameters': {key: model.kwargs[key] for key in BUNDLE_HYPERPARAMETERS}}
+    # write to a temporary file first, so that an interrupted save never leaves a partial bundle
+    path = os.path.join(directory, BUNDLE_FILE)
+    torch.save(bundle, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+def load_bundle(model_path):
+    """
+    Load a bundle saved by save_bundle
+    Tensors are memory-mapped, and only read from disk when they are used
+    """
+    bundle = torch.load(os.path.join(model_path, BUNDLE_FILE), map_location='cpu', mmap=True, weights_only=True)
+    assert(bundle['version'] == BUNDLE_VERSION), \
+        f"{model_path} was saved with bundle version {bundle['version']}, expected {BUNDLE_VERSION}"
+    return bundle
+
+
+def fp32_checkpoint_fingerprint(model_path):
+    """names, sizes and modification times of the fp32 weights in model_path, the bundle or the legacy enc.pt/dec.pt"""
+    names = [BUNDLE_FILE] if has_bundle(model_path) else ['enc.pt', 'dec.pt']
+    stats = [os.stat(os.path.join(model_path, name)) for name in names]
+    return [[name, stat.st_size, stat.st_mtime_ns] for name, stat in zip(names, stats)]
+
+
+def save_quantized_bundle(model, directory):
+    """
+    Save the state dicts of a model quantized by TRADE.quantize_int8 in directory/QUANTIZED_BUNDLE_FILE,
+        with the fingerprint of the fp32 weights they were quantized from
+    """
+    quantized = {'version': BUNDLE_VERSION,
+                 'encoder': model.encoder.state_dict(),
+                 'decoder': model.decoder.state_dict(),
+                 'fp32_checkpoint': fp32_checkpoint_fingerprint(directory)}
+    path = os.path.join(directory, QUANTIZED_BUNDLE_FILE)
+    torch.save(quantized, path + '.tmp')
+    os.replace(path + '.tmp', path)
+    print("QUANTIZED MODEL SAVED")
+
+
+def load_quantized_bundle(model_path):
+    """
+    Load the state dicts saved by save_quantized_bundle, to be loaded into a model prepared by TRADE.quantize_int8
+    :returns: None if they were not saved, or were quantized from other fp32 weights than the current ones
+    """
+    path = os.path.join(model_path, QUANTIZED_BUNDLE_FILE) if model_path is not None else None
+    if path is None or not os.path.exists(path):
+        return None
+    # packed quantized parameters are not plain tensors, they can not be loaded with weights_only
+    quantized = torch.load(path, map_location='cpu', weights_only=False)
+    if quantized['version'] != BUNDLE_VERSION or quantized['fp32_checkpoint'] != fp32_checkpoint_fingerprint(model_path):
+        print(f"{path} was quantized from other fp32 weights, quantizing the current ones")
+        return None
+    return quantized
+
+
+def load_bundle_model(**kwargs):
+    """
+    Build a TRADE model from the bundle in model_path only, without the training data, ontology or language files
+    :param kwargs: options of the loading script, the model options are taken from the bundle
+    :returns: TRADE model, lang, slot lists [all, train, dev, test], gating_dict, and the merged options
+    """
+    from models.TRADE import TRADE
+    bundle = load_bundle(kwargs['model_path'])
+    kwargs = dict(kwargs, **bundle['hyperparameters'], load_embedding=False)
+    lang = BundleLang(bundle['word2index'])
+    model = TRADE([lang, lang], bundle['slots'], bundle['gating_dict'], bundle=bundle, **kwargs)
+    return model, lang, bundle['slots'], bundle['gating_dict'], kwargs
@@ -0,0 +1,180 @@
+import os
+import json
+from typing import Tuple
+import torch
+
+# only torch is needed to run an exported model, this module must not import utils.multiwoz (spaCy, transformers, embeddings)
+
+SCRIPTED_MODEL_FILE = 'trade.ts'
+SCRIPTED_VOCAB_FILE = 'vocab.json'
+
+
+class ScriptedTRADE(torch.nn.Module):
+    """
+    Encoder and greedy decoder of a trained TRADE model, written so that it can be compiled by torch.jit.script
+    Returns token indices only, the vocab lookup is left to the caller (see ScriptedTRADERuntime)
+    """
+
+    def __init__(self, encoder, decoder, slots, max_pointers, EOS_token, ptr_gate, early_exit=False):
+        """
+        :param encoder: trained EncoderRNN
+        :param decoder: trained Generator
+        :param slots: domain-slot pairs to decode, in the order of the returned gates and words
+        :param early_exit: stop decoding slots once they predict EOS, as --early_exit_decode
+            otherwise slots gated ptr are decoded for all max_pointers steps, as the default decode of TRADE
+        """
+        super(ScriptedTRADE, self).__init__()
+        self.embedding = encoder.embedding
+        self.encoder_gru = encoder.gru
+        self.bidirectional = encoder.bidirectional
+        self.decoder_gru = decoder.gru
+        self.W_ratio = decoder.W_ratio
+        self.W_gate = decoder.W_gate
+        self.hidden_size = encoder.hidden_size
+        self.max_pointers = max_pointers
+        self.EOS_token = EOS_token
+        self.ptr_gate = ptr_gate
+        self.early_exit = early_exit
+        # slot embeddings are fixed once trained, so they are computed once here
+        with torch.no_grad():
+            slot_emb = decoder.get_slot_embeddings(slots, torch.zeros(1, 1, self.hidden_size, device=decoder.device))
+        self.register_buffer('slot_emb', slot_emb.view(len(slots), self.hidden_size).detach().clone())
+
+    def encode(self, story: torch.Tensor, lengths: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """same as EncoderRNN.forward, story (batch * len) must be sorted by length (descending order)"""
+        batch_size = story.size(0)
+        embedded = self.embedding(story.transpose(0, 1))
+        num_directions = 2 if self.bidirectional else 1
+        hidden = torch.zeros(num_directions, batch_size, self.hidden_size, dtype=embedded.dtype, device=embedded.device)
+        packed = torch.nn.utils.rnn.pack_padded_sequence(embedded, lengths.cpu(), batch_first=False)
+        outputs, hidden = self.encoder_gru(packed, hidden)
+        outputs, _ = torch.nn.utils.rnn.pad_packed_sequence(outputs, batch_first=False, total_length=story.size(1))
+        if self.bidirectional:
+            hidden = (hidden[0] + hidden[1]).unsqueeze(0)
+            outputs = outputs[:, :, :self.hidden_size] + outputs[:, :, self.hidden_size:]
+        return outputs.transpose(0, 1), hidden
+
+    def forward(self, story: torch.Tensor, lengths: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        :param story: LongTensor of dialogue histories (batch * len), sorted by length (descending order)
+        :param lengths: LongTensor of history lengths (batch)
+        :returns: gates (|slot| * batch), index of the predicted gate for every slot
+                  words (|slot| * batch * max_pointers), predicted token indices, padded with EOS
+                  only slots gated ptr are decoded past the first step, and only until EOS if early_exit
+        """
+        encoded_outputs, encoded_hidden = self.encode(story, lengths)
+        num_slots = self.slot_emb.size(0)
+        batch_size, max_len = story.size()
+        num_rows = num_slots*batch_size
+
+        decoder_input = self.slot_emb.unsqueeze(1).expand(num_slots, batch_size, self.hidden_size).reshape(num_rows, self.hidden_size)
+        hidden = encoded_hidden.repeat(1, num_slots, 1)
+        mask = torch.arange(max_len, device=story.device).unsqueeze(0) < lengths.unsqueeze(1)
+        shared_story = story.unsqueeze(0).expand(num_slots, batch_size, max_len)
+        vocab = self.embedding.weight
+        vocab_size = vocab.size(0)
+
+        gates = torch.zeros(num_slots, batch_size, dtype=torch.long, device=story.device)
+        words = torch.full((num_rows, self.max_pointers), self.EOS_token, dtype=torch.long, device=story.device)
+        active = torch.ones(num_rows, dtype=torch.bool, device=story.device)
+
+        for word_idx in range(self.max_pointers):
+            dec_state, hidden = self.decoder_gru(decoder_input.unsqueeze(0), hidden)
+            cond = hidden.view(num_slots, batch_size, self.hidden_size)
+
+            # attention over the encoder outputs, which are shared by every slot
+            scores_ = torch.einsum('sbh,blh->sbl', cond, encoded_outputs)
+            scores_ = scores_.masked_fill(~mask.unsqueeze(0), float('-inf'))
+            prob = torch.softmax(scores_, dim=2)
+            context_vec = torch.einsum('sbl,blh->sbh', prob, encoded_outputs).reshape(num_rows, self.hidden_size)
+
+            if word_idx == 0:
+                gates = torch.argmax(self.W_gate(context_vec), dim=1).view(num_slots, batch_size)
+                active = gates.view(-1) == self.ptr_gate
+
+            p_gen_vec = torch.cat([dec_state.squeeze(0), context_vec, decoder_input], -1)
+            vocab_pointer_switches = torch.sigmoid(self.W_ratio(p_gen_vec))
+            p_vocab = torch.softmax(hidden.squeeze(0).matmul(vocab.transpose(1, 0)), dim=1)
+            p_context_ptr = torch.zeros(num_slots, batch_size, vocab_size, dtype=prob.dtype, device=story.device)
+            p_context_ptr = p_context_ptr.scatter_add_(2, shared_story, prob).view(num_rows, vocab_size)
+            final_p_vocab = (1 - vocab_pointer_switches) * p_context_ptr + vocab_pointer_switches * p_vocab
+            pred_word = torch.argmax(final_p_vocab, dim=1)
+
+            words[:, word_idx] = torch.where(active, pred_word, torch.full_like(pred_word, self.EOS_token))
+            if self.early_exit:
+                active = active & (pred_word != self.EOS_token)
+            if not bool(active.any()):
+                break
+            decoder_input = self.embedding(pred_word)
+
+        return gates, words.view(num_slots, batch_size, self.max_pointers)
+
+
+class ScriptedTRADERuntime():
+    """
+    Loads a model exported by export.py, needs only torch
+    Dialogue histories must be formatted the same way as during training (see TRADEPredictor.format_turn)
+    """
+
+    def __init__(self, export_path, device='cpu'):
+        self.device = device
+        self.model = torch.jit.load(os.path.join(export_path, SCRIPTED_MODEL_FILE), map_location=device)
+        self.model.eval()
+        with open(os.path.join(export_path, SCRIPTED_VOCAB_FILE), 'r') as f:
+            vocab = json.load(f)
+        self.index2word = vocab['index2word']
+        self.word2index = {word: idx for idx, word in enumerate(self.index2word)}
+        self.slots = vocab['slots']
+        self.inverse_gating_dict = {v: k for k, v in vocab['gating_dict'].items()}
+        self.UNK_token = vocab['UNK_token']
+        self.PAD_token = vocab['PAD_token']
+        self.EOS_token = vocab['EOS_token']
+        # exports without the option always stopped decoding at EOS
+        self.early_exit = vocab.get('early_exit', True)
+
+    def tokenize(self, text):
+        return [self.word2index.get(word, self.UNK_token) for word in text.split()]
+
+    def predict_ids(self, histories):
+        """
+        :param histories: list of dialogue histories, each a list of token indices
+        :returns: gates (|slot| * batch) and words (|slot| * batch * max_pointers), in the order of histories
+        """
+        order = sorted(range(len(histories)), key=lambda i: len(histories[i]), reverse=True)
+        story = torch.full((len(histories), len(histories[order[0]])), self.PAD_token, dtype=torch.long)
+        for row, i in enumerate(order):
+            story[row, :len(histories[i])] = torch.tensor(histories[i], dtype=torch.long)
+        lengths = torch.tensor([len(histories[i]) for i in order], dtype=torch.long)
+        with torch.no_grad():
+            gates, words = self.model(story.to(self.device), lengths.to(self.device))
+        restore = torch.tensor(order).argsort().to(self.device)
+        return gates[:, restore], words[:, restore]
+
+    def predict(self, histories):
+        """
+        :param histories: list of dialogue history strings
+        :returns: for each history, a list of beliefs formatted as "domain-slot-value"
+        """
+        gates, words = self.predict_ids([self.tokenize(history) for history in histories])
+        gates, words = gates.t().tolist(), words.transpose(0, 1).tolist()
+        predicted_beliefs = []
+        for datum_gates, datum_words in zip(gates, words):
+            beliefs = []
+            for slot, gate, slot_words in zip(self.slots, datum_gates, datum_words):
+                gate = self.inverse_gating_dict[gate]
+                if gate == 'none':
+                    continue
+                if gate != 'ptr':
+                    beliefs.append(f"{slot}-{gate}")
+                    continue
+                value = []
+                for w_idx in slot_words:
+                    # same stopping words as TRADE.get_predicted_beliefs, the words after EOS are only lost with early exit
+                    if (self.early_exit and w_idx == self.EOS_token) or self.index2word[w_idx] == 'EOS':
+                        break
+                    value.append(self.index2word[w_idx])
+                value = " ".join(value)
+                if value != 'none':
+                    beliefs.append(f"{slot}-{value}")
+            predicted_beliefs.append(beliefs)
+        return predicted_beliefs
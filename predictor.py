@@ -0,0 +1,193 @@
+import os
+import json
+import time
+import uuid
+import pickle as pkl
+import torch
+
+from models.TRADE import TRADE, EncoderStateCache
+from models.bundle import has_bundle, load_bundle_model
+from utils.multiwoz import normalize_text, get_turn, get_slot_information, get_slot_information_multiwoz_22
+from utils.value_sources import load_value_source
+from utils.utils import load_multiwoz_database, load_multiwoz_22_database
+
+
+class TRADEPredictor():
+    """
+    Loads a trained TRADE model and its vocabulary once, then tracks the belief state of live dialogues
+    kwargs are the same as for train.py and test.py (see utils.utils.parse_args), model_path must be set
+
+    Example:
+        predictor = TRADEPredictor(**utils.utils.parse_args(["--model_path", MODEL_PATH]))
+        session = predictor.new_session()
+        session.add_turn("", "i need a cheap hotel in the north")
+    """
+
+    def __init__(self, **kwargs):
+        assert(kwargs['model_path'] is not None), "TRADEPredictor needs a trained model, set model_path"
+        self.device = kwargs['device']
+
+        if has_bundle(kwargs['model_path']):
+            # the bundle holds the vocab, slots and options of the model, the training data is not needed
+            self.model, self.lang, slot_lists, self.gating_dict, self.kwargs = load_bundle_model(**kwargs)
+            self.slots = slot_lists[0]
+        else:
+            # the trained weights replace the pretrained embeddings, so don't load them
+            self.kwargs = dict(kwargs, load_embedding=False)
+            with open(os.path.join(kwargs['lang_path'], 'lang-all.pkl'), 'rb') as handle:
+                self.lang = pkl.load(handle)
+            with open(os.path.join(kwargs['lang_path'], 'mem-lang-all.pkl'), 'rb') as handle:
+                mem_lang = pkl.load(handle)
+
+            # load domain-slot pairs from ontology, the same as prepare_data*
+            ontology = json.load(open("data/multi-woz/MULTIWOZ2 2/ontology.json", 'r'))
+            if kwargs['dataset'] == 'multiwoz':
+                self.slots = get_slot_information(ontology, kwargs['drop_slots'])
+            else:
+                self.slots = get_slot_information_multiwoz_22(ontology, kwargs['drop_slots'])
+            self.gating_dict = {"ptr": 0, "dontcare": 1, "none": 2}
+
+            self.model = TRADE([self.lang, mem_lang], [self.slots]*4, self.gating_dict, **self.kwargs)
+        self.model.eval()
+        # with a bundle, appended_values is the value source the model was trained with
+        assert(self.kwargs['appended_values'] not in ['ground_truth', 'boosted_NER']), \
+            f"{self.kwargs['appended_values']} values need ground truth labels, which are not available for live dialogues"
+
+        load_database = load_multiwoz_database if self.kwargs['dataset'] == 'multiwoz' else load_multiwoz_22_database
+
+        self.value_kwargs = load_value_source(self.kwargs['appended_values'], load_database,
+                                              {'turn_label': None,
+                                               'percent_ground_truth': self.kwargs['percent_ground_truth'],
+                                               'append_SYS_values': self.kwargs['append_SYS_values'],
+                                               'ground_truth_slots': self.kwargs['ground_truth_slots']})
+
+        # a causal encoder only needs to encode the newest turn of each dialogue
+        self.encoder_cache = EncoderStateCache(self.kwargs['session_cache_MB']*2**20) if self.kwargs['causal_encoder'] else None
+
+    def new_session(self, dialogue_ID=None):
+        return DialogueSession(self, dialogue_ID)
+
+    def format_turn(self, system_utterance, user_utterance, first_turn):
+        """Format a single turn the same way as read_language/read_language_multiwoz_22 add it to the dialogue history"""
+        SYS_token = self.lang.index2word[self.kwargs['SYS_token']]
+        USR_token = self.lang.index2word[self.kwargs['USR_token']]
+        ENT_token = self.lang.index2word[self.kwargs['ENT_token']]
+        use_USR_SYS_tokens = self.kwargs['USR_SYS_tokens']
+        appended_values = self.kwargs['appended_values']
+
+        if self.kwargs['dataset'] == 'multiwoz':
+            current_turn_dialogue = f" {SYS_token}" if use_USR_SYS_tokens else ""
+            current_turn_dialogue += f" {get_turn(system_utterance or '', appended_values, ENT_token, speaker='system', **self.value_kwargs)}"
+            current_turn_dialogue += f" {USR_token} " if use_USR_SYS_tokens else " ; "
+            current_turn_dialogue += get_turn(user_utterance, appended_values, ENT_token, speaker='user', **self.value_kwargs)
+            if not use_USR_SYS_tokens:
+                current_turn_dialogue += " ;"
+            return current_turn_dialogue
+
+        # in MultiWOZ 2.2 the user starts the dialogue, so the first turn may not have a system utterance
+        current_turn_dialogue = SYS_token if use_USR_SYS_tokens else ""
+        if system_utterance or not first_turn:
+            current_turn_dialogue += normalize_text(get_turn(system_utterance or '', appended_values, ENT_token,
+                                                             speaker='system', **self.value_kwargs))
+        current_turn_dialogue += USR_token if use_USR_SYS_tokens else ";"
+        current_turn_dialogue += normalize_text(get_turn(user_utterance, appended_values, ENT_token,
+                                                         speaker='user', **self.value_kwargs))
+        if not use_USR_SYS_tokens:
+            current_turn_dialogue += ";"
+        return current_turn_dialogue
+
+    def tokenize(self, text):
+        """Converts words to ids, as in multiwoz_dataset.write_columnar_store"""
+        return [self.lang.word2index[word] if word in self.lang.word2index else self.kwargs['UNK_token']
+                for word in text.split()]
+
+    def encode_sessions(self, sessions, story):
+        """Encode the dialogue history of each session, sessions must be sorted by history length (descending)
+        :param story: the padded histories of the sessions, see pad_histories
+        :returns: encoded outputs (batch, max length, hidden) and encoded hidden (1, batch, hidden)
+        """
+        if self.encoder_cache is None:
+            return self.model.encoder(story.transpose(0, 1), [len(session.tokens) for session in sessions])
+
+        all_outputs, all_hidden = [], []
+        for session in sessions:
+            # encode the whole history if this session was never encoded, even if a closed session with the same ID
+            #   left its state in the cache, or if its state was evicted from the cache
+            state = self.encoder_cache.get(session.dialogue_ID) if session.encoded_len > 0 else None
+            encoded_len = session.encoded_len if state is not None else 0
+            new_tokens = torch.tensor(session.tokens[encoded_len:], dtype=torch.long, device=self.device)
+            if len(new_tokens) > 0:
+                state = self.model.encoder.encode_turn(new_tokens, state)
+                self.encoder_cache.put(session.dialogue_ID, state)
+                session.encoded_len = len(session.tokens)
+            all_outputs.append(state[0].squeeze(0))
+            all_hidden.append(state[1])
+        encoded_outputs = torch.nn.utils.rnn.pad_sequence(all_outputs, batch_first=True)
+        return encoded_outputs, torch.cat(all_hidden, dim=1)
+
+    def pad_histories(self, sessions):
+        max_len = len(sessions[0].tokens)
+        story = torch.full((len(sessions), max_len), self.kwargs['PAD_token'], dtype=torch.long)
+        for i, session in enumerate(sessions):
+            story[i, :len(session.tokens)] = torch.tensor(session.tokens, dtype=torch.long)
+        return story.to(self.device)
+
+    def predict(self, sessions):
+        """Predict the current belief state of several sessions in a single batch
+        :returns: for each session, a list of beliefs formatted as "domain-slot-value"
+        """
+        # sort by history length (descending order) to use pack_padded_sequence, as in collate_fn
+        order = sorted(range(len(sessions)), key=lambda i: len(sessions[i].tokens), reverse=True)
+        sorted_sessions = [sessions[i] for i in order]
+
+        with torch.no_grad():
+            story = self.pad_histories(sorted_sessions)
+            encoded_outputs, encoded_hidden = self.encode_sessions(sorted_sessions, story)
+            data = {'context_len': [len(session.tokens) for session in sorted_sessions],
+                    'context_plain': [None]*len(sorted_sessions),
+                    'generate_y': None}
+            _, gates, words = self.model.decode_encoded(data, story, encoded_outputs, encoded_hidden, False, self.slots)
+            predicted_beliefs = self.model.get_predicted_beliefs(gates, words, self.slots, len(sorted_sessions))
+
+        beliefs = [None]*len(sessions)
+        for sorted_idx, session_idx in enumerate(order):
+            beliefs[session_idx] = predicted_beliefs[sorted_idx]
+        return beliefs
+
+
+class DialogueSession():
+    """
+    A single live dialogue, keeps the token indices of its history so that it never rebuilds the history string
+    """
+
+    def __init__(self, predictor, dialogue_ID=None):
+        self.predictor = predictor
+        self.dialogue_ID = dialogue_ID if dialogue_ID is not None else uuid.uuid4().hex
+        self.tokens = []
+        # number of tokens already encoded in the predictor's encoder cache
+        self.encoded_len = 0
+        self.num_turns = 0
+        self.belief_state = []
+
+    def append_turn(self, system_utterance, user_utterance):
+        """Add a turn to the history without predicting"""
+        turn = self.predictor.format_turn(system_utterance, user_utterance, first_turn=self.num_turns == 0)
+        self.tokens.extend(self.predictor.tokenize(turn))
+        self.num_turns += 1
+
+    def add_turn(self, system_utterance, user_utterance):
+        """
+        Add a turn to the dialogue and predict the belief state
+        :param system_utterance: system utterance preceding the user, may be empty for the first turn
+        :param user_utterance: user utterance
+        :returns: dict with the belief state (list of "domain-slot-value") and the latency of this call in seconds
+        """
+        start = time.perf_counter()
+        self.append_turn(system_utterance, user_utterance)
+        self.belief_state = self.predictor.predict([self])[0]
+        return {"belief_state": self.belief_state, "latency": time.perf_counter() - start}
+
+    def close(self):
+        """Release the cached encoder state of this dialogue"""
+        if self.predictor.encoder_cache is not None:
+            self.predictor.encoder_cache.pop(self.dialogue_ID)
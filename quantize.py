@@ -0,0 +1,57 @@
+import os
+import json
+
+from models.TRADE import TRADE
+from models.bundle import save_quantized_bundle
+from utils.multiwoz import prepare_data, prepare_data_multiwoz_22
+import utils.utils
+
+
+def main(**kwargs):
+    """
+    Quantize a trained model to int8 from its fp32 weights, save it next to them to be loaded with --quantize int8,
+        and compare the accuracy and latency of both models on the dev set
+    """
+    assert(kwargs['model_path'] is not None), "quantize.py needs a trained model, set model_path"
+    # the trained weights replace the pretrained embeddings, so don't load them
+    kwargs = dict(kwargs, load_embedding=False, device='cpu')
+
+    if kwargs['dataset'] == 'multiwoz':
+        _, dev, _, lang, slot_list, gating_dict, _ = prepare_data(training=True, **kwargs)
+    if kwargs['dataset'] == 'multiwoz_22':
+        _, dev, _, lang, slot_list, gating_dict, _ = prepare_data_multiwoz_22(training=True, **kwargs)
+
+    fp32_model = TRADE(lang, slot_list, gating_dict, **dict(kwargs, quantize=None))
+    fp32_model.eval()
+    # quantize the fp32 weights again, instead of loading the int8 weights saved by a previous run
+    int8_model = TRADE(lang, slot_list, gating_dict, **dict(kwargs, quantize=None))
+    int8_model.quantize_int8()
+    int8_model.kwargs['quantize'] = 'int8'
+    int8_model.eval()
+    save_quantized_bundle(int8_model, kwargs['model_path'])
+
+    print("EVALUATING FP32 MODEL ON DEV")
+    fp32_predictions, fp32_metrics = fp32_model.timed_evaluation(dev, slot_list[2], kwargs['eval_slots'])
+    print("EVALUATING INT8 MODEL ON DEV")
+    int8_predictions, int8_metrics = int8_model.timed_evaluation(dev, slot_list[2], kwargs['eval_slots'])
+
+    # fraction of dev turns where both models predict the same belief state
+    same, total = 0, 0
+    for dialogue_ID, turns in fp32_predictions.items():
+        for turn_id, turn in turns.items():
+            total += 1
+            same += set(turn["pred_beliefstate_ptr"]) == set(int8_predictions[dialogue_ID][turn_id]["pred_beliefstate_ptr"])
+
+    report = {"fp32": fp32_metrics,
+              "int8": int8_metrics,
+              "Joint_accuracy_delta": int8_metrics["Joint_accuracy"] - fp32_metrics["Joint_accuracy"],
+              "speedup": fp32_metrics["seconds"]/int8_metrics["seconds"],
+              "same_predictions": same/total}
+    print(json.dumps(report, indent=2))
+    with open(os.path.join(kwargs['model_path'], 'quantization_report.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+
+    main(**utils.utils.parse_args())
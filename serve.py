@@ -0,0 +1,188 @@
+import asyncio
+import json
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from predictor import TRADEPredictor
+import utils.utils
+
+
+class MicroBatcher():
+    """
+    Collects concurrent prediction requests into batches of at most max_batch_size sessions,
+    waiting at most max_wait_ms after the first request of a batch for more requests to arrive
+    """
+
+    def __init__(self, predictor, max_batch_size, max_wait_ms):
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms/1000
+        self.queue = asyncio.Queue()
+        # the model and the encoder cache are only touched from this thread
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.num_batches = 0
+        self.num_requests = 0
+
+    async def predict(self, session):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((session, future))
+        return await future
+
+    async def run_in_model_thread(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def collect_batch(self):
+        batch = [await self.queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self):
+        while True:
+            batch = await self.collect_batch()
+            sessions = [session for session, _ in batch]
+            try:
+                # predictor.predict sorts sessions by history length, as collate_fn does, and restores their order
+                beliefs = await self.run_in_model_thread(self.predictor.predict, sessions)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.num_batches += 1
+            self.num_requests += len(batch)
+            for (_, future), belief_state in zip(batch, beliefs):
+                if not future.done():
+                    future.set_result(belief_state)
+
+
+class BeliefTrackingServer():
+    """
+    Serves TRADEPredictor over a local socket, one JSON object per line
+    Requests:
+        {"dialogue_ID": "...", "system": "...", "user": "..."} adds a turn to the dialogue and predicts its belief state
+        {"dialogue_ID": "...", "close": true} ends the dialogue
+    Responses:
+        {"dialogue_ID": "...", "belief_state": [...], "latency": seconds} or {"error": "..."}
+    """
+
+    def __init__(self, predictor, max_batch_size, max_wait_ms, max_sessions=10000):
+        """:param max_sessions: number of open dialogues, the least recently used idle dialogues are closed beyond it"""
+        self.predictor = predictor
+        self.batcher = MicroBatcher(predictor, max_batch_size, max_wait_ms)
+        # least recently used first, clients may never close their dialogues
+        self.sessions = OrderedDict()
+        self.max_sessions = max_sessions
+        # turns of the same dialogue must be predicted in order, one at a time
+        self.session_locks = {}
+
+    async def close_session(self, dialogue_ID):
+        session = self.sessions.pop(dialogue_ID, None)
+        self.session_locks.pop(dialogue_ID, None)
+        if session is not None:
+            # releases the cached encoder state, which is only touched from the model thread
+            await self.batcher.run_in_model_thread(session.close)
+
+    async def evict_sessions(self, max_sessions):
+        """close the least recently used dialogues which are not predicting a turn, until at most max_sessions are open"""
+        for dialogue_ID in list(self.sessions):
+            if len(self.sessions) <= max_sessions:
+                break
+            lock = self.session_locks.get(dialogue_ID)
+            if lock is not None and not lock.locked():
+                await self.close_session(dialogue_ID)
+
+    async def handle_request(self, request):
+        dialogue_ID = request.get("dialogue_ID")
+        if dialogue_ID is None:
+            return {"error": "dialogue_ID is required"}
+
+        if request.get("close"):
+            lock = self.session_locks.get(dialogue_ID)
+            if lock is not None:
+                # wait for the turn being predicted, so that the dialogue is not replaced while it is used
+                async with lock:
+                    await self.close_session(dialogue_ID)
+            return {"dialogue_ID": dialogue_ID, "closed": True}
+
+        if "user" not in request:
+            return {"error": "user is required"}
+
+        if dialogue_ID not in self.sessions:
+            await self.evict_sessions(self.max_sessions - 1)
+            # another request of the same dialogue may have opened it during the eviction
+            if dialogue_ID not in self.sessions:
+                self.sessions[dialogue_ID] = self.predictor.new_session(dialogue_ID)
+                self.session_locks[dialogue_ID] = asyncio.Lock()
+        self.sessions.move_to_end(dialogue_ID)
+        session = self.sessions[dialogue_ID]
+
+        async with self.session_locks[dialogue_ID]:
+            # the dialogue was closed while this turn waited for the previous one
+            if self.sessions.get(dialogue_ID) is not session:
+                return {"error": f"dialogue {dialogue_ID} was closed"}
+            start = time.perf_counter()
+            await asyncio.get_running_loop().run_in_executor(
+                None, session.append_turn, request.get("system", ""), request["user"])
+            session.belief_state = await self.batcher.predict(session)
+            return {"dialogue_ID": dialogue_ID, "belief_state": session.belief_state,
+                    "latency": time.perf_counter() - start}
+
+    async def respond(self, line, writer, write_lock):
+        try:
+            response = await self.handle_request(json.loads(line))
+        except Exception as e:
+            response = {"error": f"{type(e).__name__}: {e}"}
+        async with write_lock:
+            writer.write((json.dumps(response) + "\n").encode())
+            await writer.drain()
+
+    async def handle_connection(self, reader, writer):
+        # requests on one connection are handled concurrently, so clients may pipeline several dialogues
+        write_lock = asyncio.Lock()
+        tasks = set()
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            task = asyncio.create_task(self.respond(line, writer, write_lock))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+        writer.close()
+
+    async def serve(self, host=None, port=None, unix_socket=None):
+        batcher_task = asyncio.create_task(self.batcher.run())
+        if unix_socket:
+            server = await asyncio.start_unix_server(self.handle_connection, path=unix_socket)
+            print(f"SERVING ON {unix_socket}")
+        else:
+            server = await asyncio.start_server(self.handle_connection, host, port)
+            print(f"SERVING ON {host}:{port}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher_task.cancel()
+
+
+def main(**kwargs):
+    predictor = TRADEPredictor(**kwargs)
+    server = BeliefTrackingServer(predictor, kwargs['max_batch_size'], kwargs['max_wait_ms'], kwargs['max_sessions'])
+    asyncio.run(server.serve(kwargs['host'], kwargs['port'], kwargs['unix_socket']))
+
+
+if __name__ == "__main__":
+
+    main(**utils.utils.parse_args())
@@ -1,3 +1,4 @@
+import time
 from tqdm import tqdm
 import argparse
 from torch import cuda
@@ -10,7 +11,28 @@ from utils.logger import simple_logger
 import utils.utils
 
 
+def log_bf16_deltas(model, dev, slots, eval_slots, epoch, logger, bf16_metrics):
+    """
+    Evaluate the same weights on dev without bfloat16 autocast, and log the accuracy and throughput deltas
+    :param bf16_metrics: metrics of the bf16 evaluation of these weights, see TRADE.evaluate
+    """
+    model.kwargs['bf16'] = False
+    try:
+        _, fp32_metrics = model.timed_evaluation(dev, slots, eval_slots)
+    finally:
+        model.kwargs['bf16'] = True
+    deltas = {"epoch": epoch,
+              "bf16": bf16_metrics,
+              "fp32": fp32_metrics,
+              "Joint_accuracy_delta": bf16_metrics["Joint_accuracy"] - fp32_metrics["Joint_accuracy"],
+              "turns_per_second_delta": bf16_metrics["turns_per_second"] - fp32_metrics["turns_per_second"],
+              "speedup": fp32_metrics["seconds"]/bf16_metrics["seconds"]}
+    print(f"bf16 joint accuracy delta: {deltas['Joint_accuracy_delta']:.4f}, speedup: {deltas['speedup']:.2f}")
+    logger.logger.setdefault('bf16_deltas', []).append(deltas)
+
+
 def main(**kwargs):
+    assert(not kwargs['quantize']), "quantized models can only be used for inference"
     logger = simple_logger(kwargs) if kwargs['log_path'] else None
 
     avg_best, count, accuracy = 0.0, 0, 0.0
@@ -39,9 +61,16 @@ def main(**kwargs):
         total_loss = 0
         total_loss_pointer = 0
         total_loss_gate = 0
+        num_turns = 0
+        num_tokens = 0
+        num_padded_tokens = 0
+        epoch_start = time.perf_counter()
 
         pbar = tqdm(enumerate(train), total=len(train))
         for i, data in pbar:
+            num_turns += len(data['context_len'])
+            num_tokens += sum(data['context_len'])
+            num_padded_tokens += data['context'].numel()
 
             # Calculate outputs
             outputs_pointer, outputs_gate, _ = model(data, slot_list[1])
@@ -77,9 +106,24 @@ def main(**kwargs):
                 batch_num = ((i+1)/gradient_accumulation_steps)
                 pbar.set_description(f"Loss: {total_loss/batch_num:.4f},Pointer loss: {total_loss_pointer/batch_num:.4f},Gate loss: {total_loss_gate/batch_num:.4f}")
 
+        epoch_seconds = time.perf_counter() - epoch_start
+        turns_per_second = num_turns/epoch_seconds
+        tokens_per_second = num_tokens/epoch_seconds
+        # fraction of the encoded context positions which are padding
+        padded_token_ratio = 1 - num_tokens/num_padded_tokens
+        print(f"Training throughput: {turns_per_second:.1f} turns/s, {tokens_per_second:.1f} tokens/s, "
+              f"padded token ratio: {padded_token_ratio:.3f}")
+        # logged with the same keys with and without --bf16, the training throughput delta is between two runs' logs
+        if logger:
+            logger.logger.setdefault('throughput', []).append(
+                {"epoch": epoch, "bf16": kwargs['bf16'], "turns_per_second": turns_per_second,
+                 "tokens_per_second": tokens_per_second, "padded_token_ratio": padded_token_ratio})
+
         if ((epoch+1) % kwargs['eval_patience']) == 0:
             model.eval()
             accuracy = model.evaluate(dev, slot_list[2], kwargs['eval_slots'], avg_best, logger, kwargs['early_stopping'])
+            if kwargs['bf16'] and logger:
+                log_bf16_deltas(model, dev, slot_list[2], kwargs['eval_slots'], epoch, logger, model.last_evaluation)
             model.train()
             scheduler.step(accuracy)
 
@@ -0,0 +1,96 @@
+import os
+import sys
+import json
+
+
+def iter_json_array(path, chunk_size=2**20):
+    """
+    Yield the elements of a json file holding a single array (eg. data/train_dials.json),
+        reading chunk_size characters at a time, so that the whole file is never in memory
+    """
+    decoder = json.JSONDecoder()
+    with open(path, 'r') as f:
+        buffer, pos, started = "", 0, False
+        while True:
+            chunk = f.read(chunk_size)
+            # drop the elements already decoded
+            buffer = buffer[pos:] + chunk
+            pos = 0
+            while True:
+                # skip whitespace and the separators between elements
+                while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                    pos += 1
+                if pos == len(buffer):
+                    break
+                if not started:
+                    assert(buffer[pos] == "["), f"{path} does not hold a json array"
+                    started = True
+                    pos += 1
+                    continue
+                if buffer[pos] == "]":
+                    return
+                try:
+                    element, pos_end = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    # the element continues in the next chunk
+                    if not chunk:
+                        raise
+                    break
+                yield element
+                pos = pos_end
+            if not chunk:
+                raise ValueError(f"{path} ended before the end of its json array")
+
+
+def jsonl_path(path):
+    return os.path.splitext(path)[0] + ".jsonl"
+
+
+def stream_path(path):
+    """the line-delimited copy of a json file written by convert_to_jsonl if it is up to date, otherwise the file itself"""
+    jsonl = jsonl_path(path)
+    if path != jsonl and os.path.exists(jsonl) and os.path.getmtime(jsonl) >= os.path.getmtime(path):
+        return jsonl
+    return path
+
+
+def iter_dialogues(paths, shard=0, num_shards=1):
+    """
+    Yield the dialogues of json or jsonl files one at a time, in order
+    :param paths: paths of json files, read from their line-delimited copy when there is one (see stream_path)
+    :param shard: only yield the dialogues whose index modulo num_shards is shard,
+        lines of other shards in jsonl files are not decoded
+    """
+    index = 0
+    for path in paths:
+        path = stream_path(path)
+        if path.endswith(".jsonl"):
+            with open(path, 'r') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    if index % num_shards == shard:
+                        yield json.loads(line)
+                    index += 1
+        else:
+            for dialogue in iter_json_array(path):
+                if index % num_shards == shard:
+                    yield dialogue
+                index += 1
+
+
+def convert_to_jsonl(path):
+    """write the dialogues of a json file next to it, one per line, so that they can be streamed and sharded cheaply"""
+    jsonl = jsonl_path(path)
+    # write to a temporary file first, so that an interrupted conversion is never streamed
+    with open(jsonl + '.tmp', 'w') as f:
+        for dialogue in iter_json_array(path):
+            f.write(json.dumps(dialogue) + "\n")
+    os.replace(jsonl + '.tmp', jsonl)
+    print(f"Wrote {jsonl}")
+
+
+if __name__ == "__main__":
+    # python -m utils.dialogue_stream data/train_dials.json MultiWOZ_2.2/train/dialogues_*.json
+    for path in sys.argv[1:]:
+        convert_to_jsonl(path)
@@ -148,32 +148,28 @@ def masked_cross_entropy_for_value(logits, target, mask):
     # mask:   b * |s|
     # -1 means infered from other dimentions
     logits_flat = logits.view(-1, logits.size(-1))
-    # print(logits_flat.size())
-    log_probs_flat = torch.log(logits_flat)
-    # print("log_probs_flat", log_probs_flat)
     target_flat = target.view(-1, 1)
-    # print("target_flat", target_flat)
-    losses_flat = -torch.gather(log_probs_flat, dim=1, index=target_flat)
+    # only the target probabilities are needed, gather them before the log,
+    #   and take the log in fp32 when logits are in reduced precision
+    losses_flat = -torch.log(torch.gather(logits_flat, dim=1, index=target_flat).float())
     losses = losses_flat.view(*target.size())  # b * |s| * m
     loss = masking(losses, mask)
     return loss
 
 
+def masked_cross_entropy_for_target_probs(target_probs, mask):
+    # target_probs: b * |s| * m, probability given to each target
+    # mask:   b * |s|
+    losses = -torch.log(target_probs)
+    loss = masking(losses, mask)
+    return loss
+
+
 def masking(losses, mask):
-    mask_ = []
-    batch_size = mask.size(0)
-    max_len = losses.size(2)
-    for si in range(mask.size(1)):
-        seq_range = torch.arange(0, max_len).long()
-        seq_range_expand = seq_range.unsqueeze(0).expand(batch_size, max_len)
-        if mask[:, si].is_cuda:
-            seq_range_expand = seq_range_expand.cuda()
-        seq_length_expand = mask[:, si].unsqueeze(1).expand_as(seq_range_expand)
-        mask_.append((seq_range_expand < seq_length_expand))
-    mask_ = torch.stack(mask_)
-    mask_ = mask_.transpose(0, 1)
-    if losses.is_cuda:
-        mask_ = mask_.cuda()
+    # losses: b * |s| * m
+    # mask:   b * |s|, length of each target
+    seq_range = torch.arange(0, losses.size(2), device=losses.device).long()
+    mask_ = seq_range.view(1, 1, -1) < mask.unsqueeze(2)
     losses = losses * mask_.float()
     loss = losses.sum() / (mask_.sum().float())
     return loss
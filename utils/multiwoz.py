@@ -2,20 +2,23 @@ import os
 import json
 import random
 import re
+import shutil
+import atexit
+import tempfile
 import pickle as pkl
+from itertools import repeat
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 import utils.multiwoz_dataset as multiwoz_dataset
-from utils.utils import find_database_value_in_utterance, load_multiwoz_database, load_multiwoz_22_database
+from utils.utils import load_multiwoz_database, load_multiwoz_22_database
+from utils.value_sources import VALUE_SOURCES, load_value_source, value_source_fingerprint
+from utils.pretrained_embeddings import dump_pretrained_emb
+from utils.dialogue_stream import iter_dialogues
+import utils.pretrained_embeddings as pretrained_embeddings
+from utils.preprocessing_cache import preprocessing_cache_key, load_preprocessed, save_preprocessed, columnar_store_path
 from torch.utils.data import DataLoader
-from torch import cuda
-from embeddings import GloveEmbedding, KazumaCharEmbedding
-from BertForValueExtraction import BertForValueExtraction
-from transformers import BertTokenizer
 from tqdm import tqdm
 
-
-import en_core_web_sm
-ner = en_core_web_sm.load()
-
 # Main differences:
 #   default tokens in different order, additional ENT_token
 
@@ -98,59 +101,6 @@ class Lang():
             self.n_words += 1
 
 
-def append_GT_values(turn, turn_label, ENT_token, percent_ground_truth, slots):
-    for domain_slot, value in turn_label:
-        if domain_slot in slots:
-            if random.random() <= percent_ground_truth*0.01:
-                turn += f" {ENT_token} {value}"
-    return turn
-
-
-def append_NER_values(turn, ENT_token):
-    res = ner(turn)
-    for word in res:
-        if word.ent_iob_ == "B":
-            turn += f" {ENT_token} {word}"
-        if word.ent_iob == "I":
-            turn += f" {word}"
-    return turn
-
-
-def append_boosted_NER_values(turn, turn_label, ENT_token):
-    res = ner(turn)
-    for word in res:
-        if word.ent_iob_ == "B":
-            turn += f" {ENT_token} {word}"
-        if word.ent_iob == "I":
-            turn += f" {word}"
-    for domain_slot, value in turn_label:
-        if domain_slot in ['hotel-parking', 'hotel-internet']:
-            turn += f" {ENT_token} {value}"
-    return turn
-
-
-def append_BERT_VE_values(turn, ve_model, tokenizer, ENT_token):
-    values = ve_model.predict_sentence_values(tokenizer, turn)
-    for value in values:
-        turn += f" {ENT_token} {value}"
-    return turn
-
-
-def append_DB_values_include_domain_slot_name(turn, database, ENT_token):
-    domain_slot_values = find_database_value_in_utterance(turn, database)
-    for ds, value in domain_slot_values.items():
-        for v in value:
-            turn += f" {ENT_token} {ds} {v}"
-    return turn
-
-
-def append_DB_values(turn, database, ENT_token):
-    domain_slot_values = find_database_value_in_utterance(turn, database)
-    for value in domain_slot_values:
-        turn += f" {ENT_token} {value}"
-    return turn
-
-
 def get_turn(turn, value_source, ENT_token, **kwargs):
     """
     Appends values from value_source to a single turn
@@ -168,28 +118,143 @@ def get_turn(turn, value_source, ENT_token, **kwargs):
     # If either:
     #       this is a system turn and we want to append system values
     #       this is a user turn
-    if value_source == 'ground_truth':
-        current_turn_dialogue = append_GT_values(turn, kwargs['turn_label'], ENT_token,
-                                                 kwargs['percent_ground_truth'], kwargs['ground_truth_slots'])
+    if value_source not in VALUE_SOURCES:
+        return turn
+    return kwargs['source'].append_values(turn, ENT_token, **kwargs)
 
-    elif value_source == "NER":
-        current_turn_dialogue = append_NER_values(turn, ENT_token)
 
-    elif value_source == "boosted_NER":
-        current_turn_dialogue = append_boosted_NER_values(turn, kwargs['turn_label'],
-                                                          ENT_token)
+def read_dialogue_multiwoz(dialogue_dict, gating_dict, slots, dataset, mem_language, value_kwargs, domain_counter,
+                           SYS_token=None, use_USR_SYS_tokens=False, USR_token=None, ENT_token=None,
+                           appended_values=None, only_domain='', except_domain='', drop_slots=None):
+    """ Read the turns of a single dialogue, see read_language
+    mem_language and domain_counter are updated in place
+    :param value_kwargs: kwargs for get_turn, with the value source loaded by load_value_source
+    :returns: data, longest dialogue history, longest value, and slots of the data (None if the dialogue is skipped)
+    """
+    data = []
+    max_response_len, max_value_len = 0, 0
+    slot_temp = None
 
-    elif value_source == "BERT_VE":
-        current_turn_dialogue = append_BERT_VE_values(turn, kwargs['ve_model'],
-                                                      kwargs['tokenizer'], ENT_token)
+    dialogue_history = ""
 
-    elif value_source == "DB":
-        current_turn_dialogue = append_DB_values(turn, kwargs['database'], ENT_token)
+    # Filter domains - maybe?
+    for domain in dialogue_dict['domains']:
+        if domain not in EXPERIMENT_DOMAINS:
+            continue
+        if domain not in domain_counter.keys():
+            domain_counter[domain] = 0
+        domain_counter[domain] += 1
+
+    # For training/testing on separate domains
+    if only_domain and only_domain not in dialogue_dict['domains']:
+        return data, max_response_len, max_value_len, slot_temp
+    if (except_domain and dataset == 'test' and except_domain not in dialogue_dict['domains']) \
+            or (except_domain and dataset != 'test' and except_domain in dialogue_dict['domains']):
+        return data, max_response_len, max_value_len, slot_temp
+
+    # Read dialogue data
+    for turn in dialogue_dict['dialogue']:
+        turn_domain = turn['domain']
+        turn_idx = turn['turn_idx']
+        current_turn_dialogue = ""
+
+        value_kwargs['turn_label'] = turn['turn_label']
+        value_kwargs['speaker'] = 'system'
+
+        if use_USR_SYS_tokens:
+            current_turn_dialogue += f" {SYS_token}"
+
+        current_turn_dialogue += f" {get_turn(turn['system_transcript'], appended_values, ENT_token, **value_kwargs)}"
+
+        value_kwargs['speaker'] = 'user'
+        if use_USR_SYS_tokens:
+            current_turn_dialogue += f" {USR_token} "
+        else:
+            current_turn_dialogue += " ; "
 
-    else:
-        current_turn_dialogue = turn
+        current_turn_dialogue += get_turn(turn['transcript'], appended_values, ENT_token, **value_kwargs)
+
+        if not use_USR_SYS_tokens:
+            current_turn_dialogue += " ;"
+
+        dialogue_history += current_turn_dialogue
+        source_text = dialogue_history.strip()
+        current_belief_state = fix_general_label_error(turn['belief_state'], slots, drop_slots)
+
+        # For training/testing on separate domains
+        # Generate domain-dependent slot list
+        slot_temp = slots
+        if dataset == "train" or dataset == "dev":
+            if except_domain != "":
+                slot_temp = [
+                    k for k in slots if except_domain not in k]
+                current_belief_state = dict(
+                    [(k, v) for k, v in current_belief_state.items() if except_domain not in k])
+            elif only_domain != "":
+                slot_temp = [
+                    k for k in slots if only_domain in k]
+                current_belief_state = dict(
+                    [(k, v) for k, v in current_belief_state.items() if only_domain in k])
+        else:
+            if except_domain != "":
+                slot_temp = [
+                    k for k in slots if except_domain in k]
+                current_belief_state = dict(
+                    [(k, v) for k, v in current_belief_state.items() if except_domain in k])
+            elif only_domain != "":
+                slot_temp = [
+                    k for k in slots if only_domain in k]
+                current_belief_state = dict(
+                    [(k, v) for k, v in current_belief_state.items() if only_domain in k])
+
+        if drop_slots:
+            turn_belief_list = []
+            for k, v in current_belief_state.items():
+                if k not in drop_slots:
+                    turn_belief_list.append(f"{k}-{v}")
+        else:
+            turn_belief_list = [f"{k}-{v}" for k, v in current_belief_state.items()]
+
+        # if dataset == 'train':
+        mem_language.index_words(current_belief_state, 'belief')
 
-    return current_turn_dialogue
+        generate_y, gating_label = [], []
+        for slot in slot_temp:
+            if slot in current_belief_state.keys():
+                slot_value = current_belief_state[slot]
+                generate_y.append(slot_value)
+
+                if slot_value == "dontcare":
+                    gating_label.append(gating_dict[slot_value])
+                elif slot_value == "none":
+                    gating_label.append(gating_dict[slot_value])
+                else:
+                    gating_label.append(gating_dict['ptr'])
+
+                if max_value_len < len(current_belief_state[slot]):
+                    max_value_len = len(current_belief_state[slot])
+
+            else:
+                generate_y.append("none")
+                gating_label.append(gating_dict['none'])
+
+        data_detail = {
+            "ID": dialogue_dict["dialogue_idx"],
+            # "domains": dialogue_dict["domains"], # never used
+            "turn_domain": turn_domain,
+            "turn_id": turn_idx,
+            "dialog_history": source_text,
+            "turn_belief": turn_belief_list,
+            "gating_label": gating_label,
+            # "turn_uttr": turn_utterance_stripped, # never used
+            'generate_y': generate_y
+        }
+        data.append(data_detail)
+
+        if max_response_len < len(source_text.split()):
+            max_response_len = len(source_text.split())
+
+    return data, max_response_len, max_value_len, slot_temp
 
 
 def read_language(dataset_path, gating_dict, slots, dataset, language, mem_language,
@@ -197,7 +262,7 @@ def read_language(dataset_path, gating_dict, slots, dataset, language, mem_langu
                   USR_token=None, ENT_token=None, appended_values=None,
                   append_SYS_values=False,
                   percent_ground_truth=100, only_domain='',
-                  except_domain='', data_ratio=100, drop_slots=None):
+                  except_domain='', data_ratio=100, drop_slots=None, seed=None):
     """ Load a dataset of dialogues and add utterances, slots, domains
     :param dataset_path: path to a json dataset (rg. data/train_dials.json)
     :param gating_dict: dict with mapping for gating mechanism (ptr, dont care, none)
@@ -207,6 +272,7 @@ def read_language(dataset_path, gating_dict, slots, dataset, language, mem_langu
     :param mem_language: Lang class, for belief states
     :param only_domain: specify if training/testing on a single domain
     :param except_domain: specify if training/testing on all except a specific domain
+    :param seed: seed for sampling percent_ground_truth of the ground truth values
     """
 
     print("READING DATASET")
@@ -219,22 +285,10 @@ def read_language(dataset_path, gating_dict, slots, dataset, language, mem_langu
 
     value_kwargs = {'turn_label': None,
                     'percent_ground_truth': percent_ground_truth,
-                    'append_SYS_values': append_SYS_values}
-
-    # If we need the BERT_VE model, load it, and the tokenizer
-    if appended_values == 'BERT_VE':
-        tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
-        ve_model = BertForValueExtraction(from_pretrained='BERT_ValueExtraction_models/MW_bs30_gradacc20_lr1e-4_usrsys-F10.8377')
-        if cuda.is_available():
-            ve_model.to('cuda')
-            ve_model.eval()
-        value_kwargs['tokenizer'] = tokenizer
-        value_kwargs['ve_model'] = ve_model
-
-    # If we need the ontology, load it
-    if appended_values == 'DB':
-        database = load_multiwoz_database()
-        value_kwargs['database'] = database
+                    'append_SYS_values': append_SYS_values,
+                    'rng': random.Random(seed)}
+
+    load_value_source(appended_values, load_multiwoz_database, value_kwargs)
 
     # create the vocab for this dataset
     for dialogue_dict in dialogues:
@@ -247,52 +301,186 @@ def read_language(dataset_path, gating_dict, slots, dataset, language, mem_langu
         random.Random(10).shuffle(dialogues)
         dialogues = dialogues[:int(len(dialogues)*data_ratio*0.01)]
 
+    # let the value source process every utterance it will see at once
+    if value_kwargs['source'] is not None:
+        utterances = []
+        for dialogue_dict in dialogues:
+            for turn in dialogue_dict['dialogue']:
+                if append_SYS_values:
+                    utterances.append(turn['system_transcript'])
+                utterances.append(turn['transcript'])
+        value_kwargs['source'].annotate(utterances)
+
+    dialogue_kwargs = {'SYS_token': SYS_token, 'use_USR_SYS_tokens': use_USR_SYS_tokens, 'USR_token': USR_token,
+                       'ENT_token': ENT_token, 'appended_values': appended_values, 'only_domain': only_domain,
+                       'except_domain': except_domain, 'drop_slots': drop_slots}
+    slot_temp = None
     for dialogue_dict in tqdm(dialogues):
-        dialogue_history = ""
+        dialogue_data, dialogue_max_response_len, dialogue_max_value_len, dialogue_slot_temp = read_dialogue_multiwoz(
+            dialogue_dict, gating_dict, slots, dataset, mem_language, value_kwargs, domain_counter, **dialogue_kwargs)
+        data.extend(dialogue_data)
+        max_response_len = max(max_response_len, dialogue_max_response_len)
+        max_value_len = max(max_value_len, dialogue_max_value_len)
+        if dialogue_slot_temp is not None:
+            slot_temp = dialogue_slot_temp
+
+    if "t{}".format(max_value_len-1) not in mem_language.word2index.keys() and dataset == "train":
+        for time_i in range(max_value_len):
+            mem_language.index_words("t{}".format(time_i), "utter")
 
-        # Filter domains - maybe?
-        for domain in dialogue_dict['domains']:
-            if domain not in EXPERIMENT_DOMAINS:
-                continue
-            if domain not in domain_counter.keys():
-                domain_counter[domain] = 0
-            domain_counter[domain] += 1
+    print("domain counter", domain_counter)
+    return data, max_response_len, slot_temp
 
-        # For training/testing on separate domains
-        if only_domain and only_domain not in dialogue_dict['domains']:
-            continue
-        if (except_domain and dataset == 'test' and except_domain not in dialogue_dict['domains']) \
-                or (except_domain and dataset != 'test' and except_domain in dialogue_dict['domains']):
+
+def read_dialogue_multiwoz_22(dialogue_dict, gating_dict, slots, dataset, mem_language, value_kwargs, domain_counter,
+                              SYS_token=None, use_USR_SYS_tokens=False, USR_token=None, ENT_token=None,
+                              appended_values=None, only_domain='', except_domain='', drop_slots=None):
+    """ Read the turns of a single dialogue, see read_language_multiwoz_22
+    mem_language and domain_counter are updated in place
+    :param value_kwargs: kwargs for get_turn, with the value source loaded by load_value_source
+    :returns: data, longest dialogue history, longest value, and slots of the data (None if the dialogue is skipped)
+    """
+    data = []
+    max_response_len, max_value_len = 0, 0
+    slot_temp = None
+
+    # initialize variables
+
+    # track the entire dialogue with speaker tokens, and appended labels
+    dialogue_history = ""
+
+    # track slot values which have multiple ground truth values
+    # so that we can map from all ground truth, to the one in the current dialogue
+    noncat_slots_uttered = {}
+
+    # current turn labels may be appended to end of an utterance if using ground truth labels
+    current_turn_labels = {}
+
+    # track slot-values as they occur so that we can track
+    #   slot values on a turn-by-turn basis
+    prev_GT = {}
+
+    # current turn dialogue consists of
+    #   SYS_token, SYS utterance, SYS labels, USR token, USR utterance, USR labels
+    if use_USR_SYS_tokens:
+        current_turn_dialogue = f"{SYS_token}"
+    else:
+        current_turn_dialogue = ""
+
+    # track number of dialogs from each domain
+    out_of_domain = 0
+    for domain in dialogue_dict['services']:
+        if domain not in EXPERIMENT_DOMAINS:
+            out_of_domain += 1
             continue
+        if domain not in domain_counter.keys():
+            domain_counter[domain] = 0
+        domain_counter[domain] += 1
+    if out_of_domain == len(dialogue_dict['services']):
+        return data, max_response_len, max_value_len, slot_temp
 
-        # Read dialogue data
-        for turn in dialogue_dict['dialogue']:
-            turn_domain = turn['domain']
-            turn_idx = turn['turn_idx']
-            current_turn_dialogue = ""
+    # read each turn
+    # in this dataset a turn may either be the user, or the system
+    for turn in dialogue_dict['turns']:
+
+        # First, handle SYSTEM turns
+        if turn['speaker'] == "SYSTEM":
+            # TODO: keep track of slot-values from system utterance?
+
+            # get any new slot values
+            for frame in turn['frames']:
+                for slot in frame['slots']:
+
+                    # confirm that we want to track this slot value
+                    if slot['slot'] not in slots:
+                        continue
+
+                    # If we are taking this direct from the utterance
+                    if 'copy_from' not in slot.keys():
+                        val = slot['value']
 
-            value_kwargs['turn_label'] = turn['turn_label']
-            value_kwargs['speaker'] = 'system'
+                    # If we need to copy this value from another slot
+                    else:
+                        val = noncat_slots_uttered[slot['copy_from']]
+
+                    noncat_slots_uttered[slot['slot']] = val
 
+            # reset turn dialogue since we always start with system utterance
+            current_turn_dialogue = ""
             if use_USR_SYS_tokens:
-                current_turn_dialogue += f" {SYS_token}"
+                current_turn_dialogue += SYS_token
 
-            current_turn_dialogue += f" {get_turn(turn['system_transcript'], appended_values, ENT_token, **value_kwargs)}"
+            value_kwargs['speaker'] = "system"
+            current_turn_utterance = get_turn(turn['utterance'], appended_values, ENT_token, **value_kwargs)
+            # add a single space before punctuation
+            current_turn_utterance = normalize_text(current_turn_utterance)
+            current_turn_dialogue += current_turn_utterance
+
+        # First, handle USER turns
+        if turn['speaker'] == "USER":
+            current_belief_state = {}
+            for frame in turn['frames']:
+                for ds, v in frame['state']['slot_values'].items():
+                    if ds not in slots:
+                        continue
+                    current_belief_state[ds] = v
+                    if ds in noncat_slots_uttered.keys():
+                        current_belief_state[ds] = noncat_slots_uttered[ds]
+
+            for frame in turn['frames']:
+                for slot in frame['slots']:
+                    # confirm that we want to track this slot value
+                    if slot['slot'] not in slots:
+                        continue
+
+                    if 'copy_from' not in slot.keys():
+                        val = slot['value']
+                    else:
+                        succesfully_copied = False
+                        if slot['copy_from'] in noncat_slots_uttered.keys():
+                            val = noncat_slots_uttered[slot['copy_from']]
+                            successfully_copied = True
+                        if not successfully_copied and slot['copy_from'] in current_belief_state.keys():
+                            val = current_belief_state[slot['copy_from']]
+                            successfully_copied = True
+                        if not successfully_copied:
+                            print(f"{slot['copy_from']} not found in previous slots: {list(noncat_slots_uttered.keys())} OR {list(current_belief_state.keys())}")
+
+                    noncat_slots_uttered[slot['slot']] = val
+
+            current_belief_state.update(noncat_slots_uttered)
+            # convert slot values to strings
+            for ds, v in current_belief_state.items():
+                if type(v) == list and len(v) == 1:
+                    current_belief_state[ds] = v[0]
+                if type(v) == list and len(v) > 1:
+                    current_belief_state[ds] = " ".join(v)
 
-            value_kwargs['speaker'] = 'user'
             if use_USR_SYS_tokens:
-                current_turn_dialogue += f" {USR_token} "
+                current_turn_dialogue += USR_token
             else:
-                current_turn_dialogue += " ; "
+                current_turn_dialogue += ";"
+
+            value_kwargs['turn_label'] = current_belief_state.copy()
+            value_kwargs['turn_label'] = []
+            for ds, value in current_belief_state.items():
+                if ds not in prev_GT.keys():
+                    value_kwargs['turn_label'].append([ds, value])
+                else:
+                    if prev_GT[ds] != current_belief_state[ds]:
+                        value_kwargs['turn_label'].append([ds, value])
 
-            current_turn_dialogue += get_turn(turn['transcript'], appended_values, ENT_token, **value_kwargs)
+            value_kwargs['speaker'] = 'user'
+            current_turn_utterance = get_turn(turn['utterance'], appended_values, ENT_token, **value_kwargs)
+            # add a single space before punctuation
+            current_turn_utterance = normalize_text(current_turn_utterance)
+            current_turn_dialogue += current_turn_utterance
 
             if not use_USR_SYS_tokens:
-                current_turn_dialogue += " ;"
+                current_turn_dialogue += ";"
 
             dialogue_history += current_turn_dialogue
             source_text = dialogue_history.strip()
-            current_belief_state = fix_general_label_error(turn['belief_state'], slots, drop_slots)
 
             # For training/testing on separate domains
             # Generate domain-dependent slot list
@@ -328,7 +516,6 @@ def read_language(dataset_path, gating_dict, slots, dataset, language, mem_langu
             else:
                 turn_belief_list = [f"{k}-{v}" for k, v in current_belief_state.items()]
 
-            # if dataset == 'train':
             mem_language.index_words(current_belief_state, 'belief')
 
             generate_y, gating_label = [], []
@@ -351,28 +538,88 @@ def read_language(dataset_path, gating_dict, slots, dataset, language, mem_langu
                     generate_y.append("none")
                     gating_label.append(gating_dict['none'])
 
+            # track current dialogue state
+            prev_GT.update(current_belief_state)
+
+            # Add data_details to data
             data_detail = {
-                "ID": dialogue_dict["dialogue_idx"],
-                # "domains": dialogue_dict["domains"], # never used
-                "turn_domain": turn_domain,
-                "turn_id": turn_idx,
+                "ID": dialogue_dict['dialogue_id'],
+                "turn_id": turn['turn_id'],
                 "dialog_history": source_text,
-                "turn_belief": turn_belief_list,
+                "turn_belief": turn_belief_list,  # list of belief states formatted as "domain-slot-value"
                 "gating_label": gating_label,
-                # "turn_uttr": turn_utterance_stripped, # never used
-                'generate_y': generate_y
+                "generate_y": generate_y
             }
             data.append(data_detail)
 
             if max_response_len < len(source_text.split()):
                 max_response_len = len(source_text.split())
 
-    if "t{}".format(max_value_len-1) not in mem_language.word2index.keys() and dataset == "train":
-        for time_i in range(max_value_len):
-            mem_language.index_words("t{}".format(time_i), "utter")
+    return data, max_response_len, max_value_len, slot_temp
 
-    print("domain counter", domain_counter)
-    return data, max_response_len, slot_temp
+
+def read_dialogue_file_multiwoz_22(dataset_path, gating_dict, slots, dataset, language, mem_language, value_kwargs,
+                                   domain_counter, SYS_token=None, use_USR_SYS_tokens=False,
+                                   USR_token=None, ENT_token=None, appended_values=None,
+                                   append_SYS_values=False, only_domain='', except_domain='',
+                                   data_ratio=100, drop_slots=None, progress=True):
+    """ Read the dialogues of a single json file, see read_language_multiwoz_22
+    language, mem_language and domain_counter are updated in place
+    :param value_kwargs: kwargs for get_turn, with the value source loaded by load_value_source
+    :returns: data, longest dialogue history, longest value, and slots of the data (None if the file has no user turns)
+    """
+    data = []
+    max_response_len, max_value_len = 0, 0
+    slot_temp = None
+
+    dialogues = json.load(open(dataset_path))
+
+    # create the vocab for this dataset
+    for dialogue_dict in dialogues:
+        for turn in dialogue_dict['turns']:
+            language.index_words(turn['utterance'], 'utter')
+
+    # For only using a portion of total data
+    if data_ratio != 100:
+        random.Random(10).shuffle(dialogues)
+        dialogues = dialogues[:int(len(dialogues)*data_ratio*0.01)]
+
+    # let the value source process every utterance it will see at once
+    if value_kwargs['source'] is not None:
+        value_kwargs['source'].annotate([turn['utterance'] for dialogue_dict in dialogues
+                                         for turn in dialogue_dict['turns']
+                                         if turn['speaker'] == "USER" or append_SYS_values])
+
+    # read each dialogue in the dataset
+    dialogue_kwargs = {'SYS_token': SYS_token, 'use_USR_SYS_tokens': use_USR_SYS_tokens, 'USR_token': USR_token,
+                       'ENT_token': ENT_token, 'appended_values': appended_values, 'only_domain': only_domain,
+                       'except_domain': except_domain, 'drop_slots': drop_slots}
+    for dialogue_dict in tqdm(dialogues, disable=not progress):
+        dialogue_data, dialogue_max_response_len, dialogue_max_value_len, dialogue_slot_temp = read_dialogue_multiwoz_22(
+            dialogue_dict, gating_dict, slots, dataset, mem_language, value_kwargs, domain_counter, **dialogue_kwargs)
+        data.extend(dialogue_data)
+        max_response_len = max(max_response_len, dialogue_max_response_len)
+        max_value_len = max(max_value_len, dialogue_max_value_len)
+        if dialogue_slot_temp is not None:
+            slot_temp = dialogue_slot_temp
+
+    return data, max_response_len, max_value_len, slot_temp
+
+
+def read_dialogue_file_shard_multiwoz_22(dataset_path, gating_dict, slots, dataset, language, mem_language,
+                                         value_kwargs, file_kwargs):
+    """ Ingestion worker, reads a single json file with copies of language and mem_language
+    :returns: output of read_dialogue_file_multiwoz_22, the words added to language and to mem_language
+        in the order they were added, and the domain counter of the file
+    """
+    n_words, n_mem_words = language.n_words, mem_language.n_words
+    domain_counter = {}
+    load_value_source(file_kwargs['appended_values'], load_multiwoz_22_database, value_kwargs)
+    output = read_dialogue_file_multiwoz_22(dataset_path, gating_dict, slots, dataset, language, mem_language,
+                                            value_kwargs, domain_counter, progress=False, **file_kwargs)
+    words = [language.index2word[i] for i in range(n_words, language.n_words)]
+    mem_words = [mem_language.index2word[i] for i in range(n_mem_words, mem_language.n_words)]
+    return output, words, mem_words, domain_counter
 
 
 def read_language_multiwoz_22(dataset_paths, gating_dict, slots, dataset, language, mem_language,
@@ -381,7 +628,7 @@ def read_language_multiwoz_22(dataset_paths, gating_dict, slots, dataset, langua
                               append_SYS_values=False,
                               percent_ground_truth=100, only_domain='',
                               except_domain='', data_ratio=100, drop_slots=None,
-                              ground_truth_slots=combined_slot_names):
+                              ground_truth_slots=combined_slot_names, seed=None, num_workers=0):
     """ Load a dataset of dialogues and add utterances, slots, domains
     :param dataset_path: path to multiple json datasets
     :param gating_dict: dict with mapping for gating mechanism (ptr, dont care, none)
@@ -391,6 +638,8 @@ def read_language_multiwoz_22(dataset_paths, gating_dict, slots, dataset, langua
     :param mem_language: Lang class, for belief states
     :param only_domain: specify if training/testing on a single domain
     :param except_domain: specify if training/testing on all except a specific domain
+    :param seed: seed for sampling percent_ground_truth of the ground truth values
+    :param num_workers: number of processes reading the files in parallel, the output is the same as reading them in order
     """
 
     print("READING DATASET")
@@ -401,289 +650,215 @@ def read_language_multiwoz_22(dataset_paths, gating_dict, slots, dataset, langua
     value_kwargs = {'turn_label': None,
                     'percent_ground_truth': percent_ground_truth,
                     'append_SYS_values': append_SYS_values,
-                    'ground_truth_slots': ground_truth_slots}
-
-    # If we need the BERT_VE model, load it, and the tokenizer
-    if appended_values == 'BERT_VE':
-        tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
-        ve_model = BertForValueExtraction(from_pretrained='BERT_ValueExtraction_models/MW_bs30_gradacc20_lr1e-4_usrsys-F10.8377')
-        if cuda.is_available():
-            ve_model.to('cuda')
-            ve_model.eval()
-        value_kwargs['tokenizer'] = tokenizer
-        value_kwargs['ve_model'] = ve_model
-
-    # If we need the ontology, load it
-    if appended_values == 'DB':
-        database = load_multiwoz_22_database()
-        value_kwargs['database'] = database
-
-    for dataset_path in dataset_paths:
-        dialogues = json.load(open(dataset_path))
+                    'ground_truth_slots': ground_truth_slots,
+                    'rng': random.Random(seed)}
+
+    load_value_source(appended_values, load_multiwoz_22_database, value_kwargs)
+
+    file_kwargs = {'SYS_token': SYS_token, 'use_USR_SYS_tokens': use_USR_SYS_tokens, 'USR_token': USR_token,
+                   'ENT_token': ENT_token, 'appended_values': appended_values, 'append_SYS_values': append_SYS_values,
+                   'only_domain': only_domain, 'except_domain': except_domain, 'data_ratio': data_ratio,
+                   'drop_slots': drop_slots}
+    slot_temp = None
+
+    # files are read in parallel unless the values depend on the files read before
+    #   (sampled ground truth values share a single random generator),
+    #   or the value source must stay in this process (see ValueSource.process_safe)
+    source = value_kwargs['source']
+    parallel = num_workers > 1 and len(dataset_paths) > 1 and (source is None or source.process_safe) and \
+        not (appended_values == 'ground_truth' and percent_ground_truth < 100)
+
+    if parallel:
+        worker_value_kwargs = {k: v for k, v in value_kwargs.items() if k != 'source'}
+        with ProcessPoolExecutor(min(num_workers, len(dataset_paths))) as executor:
+            shards = list(tqdm(executor.map(read_dialogue_file_shard_multiwoz_22, dataset_paths,
+                                            *[repeat(arg) for arg in [gating_dict, slots, dataset, language, mem_language,
+                                                                      worker_value_kwargs, file_kwargs]]),
+                               total=len(dataset_paths)))
+        # merge the shards in the order of dataset_paths, words get the same index as when reading the files in order
+        outputs = []
+        for output, words, mem_words, file_domain_counter in shards:
+            outputs.append(output)
+            for word in words:
+                language.index_word(word)
+            for word in mem_words:
+                mem_language.index_word(word)
+            for domain, count in file_domain_counter.items():
+                domain_counter[domain] = domain_counter.get(domain, 0) + count
+    else:
+        outputs = [read_dialogue_file_multiwoz_22(dataset_path, gating_dict, slots, dataset, language, mem_language,
+                                                  value_kwargs, domain_counter, **file_kwargs)
+                   for dataset_path in dataset_paths]
 
-        # create the vocab for this dataset
-        for dialogue_dict in dialogues:
-            for turn in dialogue_dict['turns']:
-                language.index_words(turn['utterance'], 'utter')
+    for file_data, file_max_response_len, file_max_value_len, file_slot_temp in outputs:
+        data.extend(file_data)
+        max_response_len = max(max_response_len, file_max_response_len)
+        max_value_len = max(max_value_len, file_max_value_len)
+        if file_slot_temp is not None:
+            slot_temp = file_slot_temp
 
-        # For only using a portion of total data
-        if data_ratio != 100:
-            random.Random(10).shuffle(dialogues)
-            dialogues = dialogues[:int(len(dialogues)*data_ratio*0.01)]
+    if "t{}".format(max_value_len-1) not in mem_language.word2index.keys() and dataset == "train":
+        for time_i in range(max_value_len):
+            mem_language.index_words("t{}".format(time_i), "utter")
 
-        # read each dialogue in the dataset
-        for dialogue_dict in tqdm(dialogues):
-            # initialize variables
+    print("domain counter", domain_counter)
+    return data, max_response_len, slot_temp
 
-            # track the entire dialogue with speaker tokens, and appended labels
-            dialogue_history = ""
 
-            # track slot values which have multiple ground truth values
-            # so that we can map from all ground truth, to the one in the current dialogue
-            noncat_slots_uttered = {}
+def read_dialogue_data(dialogue_dict, read_dialogue, **kwargs):
+    """the data of a single dialogue, see StreamingDataset"""
+    return read_dialogue(dialogue_dict, **kwargs)[0]
+
+
+def read_language_streaming(dataset_paths, gating_dict, slots, dataset, language, mem_language, dataset_name,
+                            SYS_token=None, use_USR_SYS_tokens=False,
+                            USR_token=None, ENT_token=None, appended_values=None,
+                            append_SYS_values=False,
+                            percent_ground_truth=100, only_domain='',
+                            except_domain='', drop_slots=None,
+                            ground_truth_slots=combined_slot_names, shuffle_buffer=10000, seed=None):
+    """ Read a dataset of dialogues once, one dialogue at a time, to add utterances, slots and domains,
+    and return a StreamingDataset which reads the dialogues again every epoch, for datasets that do not fit in memory
+    the vocab, longest dialogue history and slots are the same as with read_language/read_language_multiwoz_22
+    :param dataset_paths: json files of dialogues, or their line-delimited copies (see dialogue_stream.convert_to_jsonl)
+    :param dataset_name: multiwoz or multiwoz_22, the format of the dialogues
+    :param shuffle_buffer: number of turns shuffled together by the StreamingDataset
+    :param seed: seed of the shuffling
+    """
+    assert(not(appended_values == 'ground_truth' and percent_ground_truth < 100)), \
+        "sampled ground truth values would be sampled again every epoch, they can not be streamed"
 
-            # current turn labels may be appended to end of an utterance if using ground truth labels
-            current_turn_labels = {}
+    print("STREAMING DATASET")
+    num_turns, max_response_len, max_value_len, max_value_tokens = 0, 0, 0, 1
+    domain_counter = {}
 
-            # track slot-values as they occur so that we can track
-            #   slot values on a turn-by-turn basis
-            prev_GT = {}
+    value_kwargs = {'turn_label': None,
+                    'percent_ground_truth': percent_ground_truth,
+                    'append_SYS_values': append_SYS_values,
+                    'ground_truth_slots': ground_truth_slots,
+                    'rng': random.Random(seed)}
 
-            # current turn dialogue consists of
-            #   SYS_token, SYS utterance, SYS labels, USR token, USR utterance, USR labels
-            if use_USR_SYS_tokens:
-                current_turn_dialogue = f"{SYS_token}"
-            else:
-                current_turn_dialogue = ""
-
-            # track number of dialogs from each domain
-            out_of_domain = 0
-            for domain in dialogue_dict['services']:
-                if domain not in EXPERIMENT_DOMAINS:
-                    out_of_domain += 1
-                    continue
-                if domain not in domain_counter.keys():
-                    domain_counter[domain] = 0
-                domain_counter[domain] += 1
-            if out_of_domain == len(dialogue_dict['services']):
-                continue
-
-            # read each turn
-            # in this dataset a turn may either be the user, or the system
+    if dataset_name == 'multiwoz_22':
+        read_dialogue = read_dialogue_multiwoz_22
+        load_value_source(appended_values, load_multiwoz_22_database, value_kwargs)
+    else:
+        read_dialogue = read_dialogue_multiwoz
+        load_value_source(appended_values, load_multiwoz_database, value_kwargs)
+    assert(value_kwargs['source'] is None or value_kwargs['source'].process_safe), \
+        f"{appended_values} values are extracted from whole files, they can not be streamed"
+
+    dialogue_kwargs = {'SYS_token': SYS_token, 'use_USR_SYS_tokens': use_USR_SYS_tokens, 'USR_token': USR_token,
+                       'ENT_token': ENT_token, 'appended_values': appended_values, 'only_domain': only_domain,
+                       'except_domain': except_domain, 'drop_slots': drop_slots}
+    slot_temp = None
+    for dialogue_dict in tqdm(iter_dialogues(dataset_paths)):
+        # create the vocab for this dataset
+        if dataset_name == 'multiwoz_22':
             for turn in dialogue_dict['turns']:
-
-                # First, handle SYSTEM turns
-                if turn['speaker'] == "SYSTEM":
-                    # TODO: keep track of slot-values from system utterance?
-
-                    # get any new slot values
-                    for frame in turn['frames']:
-                        for slot in frame['slots']:
-
-                            # confirm that we want to track this slot value
-                            if slot['slot'] not in slots:
-                                continue
-
-                            # If we are taking this direct from the utterance
-                            if 'copy_from' not in slot.keys():
-                                val = slot['value']
-
-                            # If we need to copy this value from another slot
-                            else:
-                                val = noncat_slots_uttered[slot['copy_from']]
-
-                            noncat_slots_uttered[slot['slot']] = val
-
-                    # reset turn dialogue since we always start with system utterance
-                    current_turn_dialogue = ""
-                    if use_USR_SYS_tokens:
-                        current_turn_dialogue += SYS_token
-
-                    value_kwargs['speaker'] = "system"
-                    current_turn_utterance = get_turn(turn['utterance'], appended_values, ENT_token, **value_kwargs)
-                    # add a single space before punctuation
-                    current_turn_utterance = normalize_text(current_turn_utterance)
-                    current_turn_dialogue += current_turn_utterance
-
-                # First, handle USER turns
-                if turn['speaker'] == "USER":
-                    current_belief_state = {}
-                    for frame in turn['frames']:
-                        for ds, v in frame['state']['slot_values'].items():
-                            if ds not in slots:
-                                continue
-                            current_belief_state[ds] = v
-                            if ds in noncat_slots_uttered.keys():
-                                current_belief_state[ds] = noncat_slots_uttered[ds]
-
-                    for frame in turn['frames']:
-                        for slot in frame['slots']:
-                            # confirm that we want to track this slot value
-                            if slot['slot'] not in slots:
-                                continue
-
-                            if 'copy_from' not in slot.keys():
-                                val = slot['value']
-                            else:
-                                succesfully_copied = False
-                                if slot['copy_from'] in noncat_slots_uttered.keys():
-                                    val = noncat_slots_uttered[slot['copy_from']]
-                                    successfully_copied = True
-                                if not successfully_copied and slot['copy_from'] in current_belief_state.keys():
-                                    val = current_belief_state[slot['copy_from']]
-                                    successfully_copied = True
-                                if not successfully_copied:
-                                    print(f"{slot['copy_from']} not found in previous slots: {list(noncat_slots_uttered.keys())} OR {list(current_belief_state.keys())}")
-
-                            noncat_slots_uttered[slot['slot']] = val
-
-                    current_belief_state.update(noncat_slots_uttered)
-                    # convert slot values to strings
-                    for ds, v in current_belief_state.items():
-                        if type(v) == list and len(v) == 1:
-                            current_belief_state[ds] = v[0]
-                        if type(v) == list and len(v) > 1:
-                            current_belief_state[ds] = " ".join(v)
-
-                    if use_USR_SYS_tokens:
-                        current_turn_dialogue += USR_token
-                    else:
-                        current_turn_dialogue += ";"
-
-                    value_kwargs['turn_label'] = current_belief_state.copy()
-                    value_kwargs['turn_label'] = []
-                    for ds, value in current_belief_state.items():
-                        if ds not in prev_GT.keys():
-                            value_kwargs['turn_label'].append([ds, value])
-                        else:
-                            if prev_GT[ds] != current_belief_state[ds]:
-                                value_kwargs['turn_label'].append([ds, value])
-
-                    value_kwargs['speaker'] = 'user'
-                    current_turn_utterance = get_turn(turn['utterance'], appended_values, ENT_token, **value_kwargs)
-                    # add a single space before punctuation
-                    current_turn_utterance = normalize_text(current_turn_utterance)
-                    current_turn_dialogue += current_turn_utterance
-
-                    if not use_USR_SYS_tokens:
-                        current_turn_dialogue += ";"
-
-                    dialogue_history += current_turn_dialogue
-                    source_text = dialogue_history.strip()
-
-                    # For training/testing on separate domains
-                    # Generate domain-dependent slot list
-                    slot_temp = slots
-                    if dataset == "train" or dataset == "dev":
-                        if except_domain != "":
-                            slot_temp = [
-                                k for k in slots if except_domain not in k]
-                            current_belief_state = dict(
-                                [(k, v) for k, v in current_belief_state.items() if except_domain not in k])
-                        elif only_domain != "":
-                            slot_temp = [
-                                k for k in slots if only_domain in k]
-                            current_belief_state = dict(
-                                [(k, v) for k, v in current_belief_state.items() if only_domain in k])
-                    else:
-                        if except_domain != "":
-                            slot_temp = [
-                                k for k in slots if except_domain in k]
-                            current_belief_state = dict(
-                                [(k, v) for k, v in current_belief_state.items() if except_domain in k])
-                        elif only_domain != "":
-                            slot_temp = [
-                                k for k in slots if only_domain in k]
-                            current_belief_state = dict(
-                                [(k, v) for k, v in current_belief_state.items() if only_domain in k])
-
-                    if drop_slots:
-                        turn_belief_list = []
-                        for k, v in current_belief_state.items():
-                            if k not in drop_slots:
-                                turn_belief_list.append(f"{k}-{v}")
-                    else:
-                        turn_belief_list = [f"{k}-{v}" for k, v in current_belief_state.items()]
-
-                    mem_language.index_words(current_belief_state, 'belief')
-
-                    generate_y, gating_label = [], []
-                    for slot in slot_temp:
-                        if slot in current_belief_state.keys():
-                            slot_value = current_belief_state[slot]
-                            generate_y.append(slot_value)
-
-                            if slot_value == "dontcare":
-                                gating_label.append(gating_dict[slot_value])
-                            elif slot_value == "none":
-                                gating_label.append(gating_dict[slot_value])
-                            else:
-                                gating_label.append(gating_dict['ptr'])
-
-                            if max_value_len < len(current_belief_state[slot]):
-                                max_value_len = len(current_belief_state[slot])
-
-                        else:
-                            generate_y.append("none")
-                            gating_label.append(gating_dict['none'])
-
-                    # track current dialogue state
-                    prev_GT.update(current_belief_state)
-
-                    # Add data_details to data
-                    data_detail = {
-                        "ID": dialogue_dict['dialogue_id'],
-                        "turn_id": turn['turn_id'],
-                        "dialog_history": source_text,
-                        "turn_belief": turn_belief_list,  # list of belief states formatted as "domain-slot-value"
-                        "gating_label": gating_label,
-                        "generate_y": generate_y
-                    }
-                    data.append(data_detail)
-
-                    if max_response_len < len(source_text.split()):
-                        max_response_len = len(source_text.split())
+                language.index_words(turn['utterance'], 'utter')
+        else:
+            for turn in dialogue_dict['dialogue']:
+                language.index_words(turn['system_transcript'], 'utter')
+                language.index_words(turn['transcript'], 'utter')
+
+        dialogue_data, dialogue_max_response_len, dialogue_max_value_len, dialogue_slot_temp = read_dialogue(
+            dialogue_dict, gating_dict, slots, dataset, mem_language, value_kwargs, domain_counter, **dialogue_kwargs)
+        num_turns += len(dialogue_data)
+        max_response_len = max(max_response_len, dialogue_max_response_len)
+        max_value_len = max(max_value_len, dialogue_max_value_len)
+        # values are padded to the longest value with EOS
+        for datum in dialogue_data:
+            max_value_tokens = max([max_value_tokens] + [len(value.split()) + 1 for value in datum['generate_y']])
+        if dialogue_slot_temp is not None:
+            slot_temp = dialogue_slot_temp
 
     if "t{}".format(max_value_len-1) not in mem_language.word2index.keys() and dataset == "train":
         for time_i in range(max_value_len):
             mem_language.index_words("t{}".format(time_i), "utter")
 
     print("domain counter", domain_counter)
-    return data, max_response_len, slot_temp
+    read_data = partial(read_dialogue_data, read_dialogue=read_dialogue, gating_dict=gating_dict, slots=slots,
+                        dataset=dataset, mem_language=mem_language, value_kwargs=value_kwargs, domain_counter={},
+                        **dialogue_kwargs)
+    streaming_dataset = multiwoz_dataset.StreamingDataset(dataset_paths, read_data, language.word2index,
+                                                          language.word2index, num_turns, max_value_tokens,
+                                                          shuffle_buffer=shuffle_buffer, seed=seed)
+    return streaming_dataset, max_response_len, slot_temp
 
 
-def get_sequence_dataloader(data, language, mem_language, batch_size, shuffle=True,
-                            num_workers=0, pin_memory=False):
-    data_keys = data[0].keys()
-    data_info = {k: [] for k in data_keys}
+def get_streaming_dataloader(dataset, batch_size, bucket_by_length=False, max_batch_tokens=None, seed=None,
+                             num_workers=0, pin_memory=False, prefetch_factor=2, device='cpu'):
+    """
+    :param dataset: StreamingDataset, see read_language_streaming
+    the other options are the same as get_sequence_dataloader,
+        turns are batched in the order of the shuffle buffer, they can not be bucketed by length
+    """
+    assert(not(bucket_by_length or max_batch_tokens)), "streamed turns can not be bucketed by length"
+    data_loader = DataLoader(dataset=dataset,
+                             batch_size=batch_size,
+                             collate_fn=multiwoz_dataset.collate_fn,
+                             num_workers=num_workers,
+                             pin_memory=pin_memory,
+                             prefetch_factor=prefetch_factor if num_workers > 0 else None,
+                             persistent_workers=num_workers > 0)
+
+    return multiwoz_dataset.DevicePrefetcher(data_loader, device)
 
-    for datum in data:
-        for k in data_keys:
-            data_info[k].append(datum[k])
 
-    dataset = multiwoz_dataset.Dataset(
-        data_info, language.word2index, language.word2index, mem_language.word2index)
+def get_sequence_dataloader(data, language, mem_language, batch_size, shuffle=True, bucket_by_length=False,
+                            max_batch_tokens=None, seed=None, num_workers=0, pin_memory=False, prefetch_factor=2,
+                            device='cpu', store_path=None):
+    """
+    :param shuffle: shuffle the turns every epoch, otherwise batch them in order of context length
+    :param bucket_by_length: when shuffling, batch turns with similar context lengths (see LengthBatchSampler)
+    :param max_batch_tokens: if set, batches are bucketed and sized so that batch size * longest context <= max_batch_tokens
+    :param seed: seed of the bucketed shuffling
+    :param num_workers: number of processes collating batches, 0 collates in the main process
+    :param pin_memory: collate into pinned memory, so that batches are copied to cuda asynchronously
+    :param prefetch_factor: batches loaded in advance by each worker
+    :param device: batches are moved to this device by multiwoz_dataset.DevicePrefetcher
+    :param store_path: directory of the split's columnar store, reused if it was written with the same vocab
+        if None, the store is written to a temporary directory
+    """
+    if store_path is None:
+        store_path = tempfile.mkdtemp(prefix="trade-columnar-")
+        atexit.register(shutil.rmtree, store_path, ignore_errors=True)
+
+    if not multiwoz_dataset.is_columnar_store(store_path, language.word2index):
+        data_keys = data[0].keys()
+        data_info = {k: [] for k in data_keys}
+
+        for datum in data:
+            for k in data_keys:
+                data_info[k].append(datum[k])
+
+        multiwoz_dataset.write_columnar_store(data_info, language.word2index, language.word2index, store_path)
+
+    dataset = multiwoz_dataset.Dataset(store_path)
+    loader_kwargs = {'batch_size': batch_size, 'shuffle': True}
+    if not shuffle or bucket_by_length or max_batch_tokens:
+        loader_kwargs = {'batch_sampler': multiwoz_dataset.LengthBatchSampler(
+            dataset.context_lengths(), batch_size, shuffle=shuffle, max_tokens=max_batch_tokens, seed=seed)}
     data_loader = DataLoader(dataset=dataset,
-                             batch_size=batch_size, shuffle=shuffle,
                              collate_fn=multiwoz_dataset.collate_fn,
                              num_workers=num_workers,
-                             pin_memory=pin_memory)
+                             pin_memory=pin_memory,
+                             prefetch_factor=prefetch_factor if num_workers > 0 else None,
+                             persistent_workers=num_workers > 0,
+                             **loader_kwargs)
 
-    return data_loader
+    return multiwoz_dataset.DevicePrefetcher(data_loader, device)
 
 
-def dump_pretrained_emb(word2index, index2word, dump_path):
-    print(f"Dumping pretrained embeddings at {dump_path}")
-    embeddings = [GloveEmbedding(), KazumaCharEmbedding()]
-    E = []
-    for i in range(len(word2index.keys())):
-        w = index2word[i]
-        e = []
-        for emb in embeddings:
-            e += emb.emb(w, default='zero')
-        E.append(e)
-    with open(dump_path, 'wt') as f:
-        json.dump(E, f)
+def dataloader_options(**kwargs):
+    """get_sequence_dataloader options from the command line arguments"""
+    return {'bucket_by_length': kwargs['bucket_by_length'],
+            'max_batch_tokens': kwargs['max_batch_tokens'],
+            'seed': kwargs['seed'],
+            'num_workers': kwargs['num_workers'],
+            'pin_memory': kwargs['device'] == 'cuda',
+            'prefetch_factor': kwargs['prefetch_factor'],
+            'device': kwargs['device']}
 
 
 def get_slot_information(ontology, drop_slots=[]):
@@ -713,7 +888,8 @@ def prepare_data(training, **kwargs):
         os.makedirs(lang_path)
 
     # load domain-slot pairs from ontology
-    ontology = json.load(open("data/multi-woz/MULTIWOZ2 2/ontology.json", 'r'))
+    ontology_path = "data/multi-woz/MULTIWOZ2 2/ontology.json"
+    ontology = json.load(open(ontology_path, 'r'))
     all_slots = get_slot_information(ontology, kwargs['drop_slots'])
     # all_slots = get_slot_information(ontology)
     gating_dict = {"ptr": 0, "dontcare": 1, "none": 2}
@@ -743,36 +919,78 @@ def prepare_data(training, **kwargs):
     mem_lang_name = 'mem-lang-all.pkl'
 
     if training:
-        # Get training data, longest training turn length, slots used in training
-        data_train, max_len_train, slot_train = read_language(file_train, gating_dict, all_slots, "train", lang, mem_lang,
-                                                              ENT_token=lang.index2word[kwargs['ENT_token']],
-                                                              use_USR_SYS_tokens=kwargs['USR_SYS_tokens'],
-                                                              SYS_token=lang.index2word[kwargs['SYS_token']],
-                                                              USR_token=lang.index2word[kwargs['USR_token']],
-                                                              appended_values=kwargs['appended_values'],
-                                                              append_SYS_values=kwargs['append_SYS_values'],
-                                                              percent_ground_truth=kwargs['percent_ground_truth'],
-                                                              data_ratio=kwargs['train_data_ratio'],
-                                                              drop_slots=kwargs['drop_slots'])
-        dataloader_train = get_sequence_dataloader(data_train, lang, mem_lang, batch_size)
-        vocab_size_train = lang.n_words
-
-        # Get dev data, longest dev turn length, slots used in dev
-        data_dev, max_len_dev, slot_dev = read_language(file_dev, gating_dict, all_slots, "dev", lang, mem_lang,
-                                                        ENT_token=lang.index2word[kwargs['ENT_token']],
-                                                        use_USR_SYS_tokens=kwargs['USR_SYS_tokens'],
-                                                        SYS_token=lang.index2word[kwargs['SYS_token']],
-                                                        USR_token=lang.index2word[kwargs['USR_token']],
-                                                        appended_values=kwargs['appended_values'],
-                                                        append_SYS_values=kwargs['append_SYS_values'],
-                                                        percent_ground_truth=kwargs['percent_ground_truth'],
-                                                        data_ratio=kwargs['dev_data_ratio'],
-                                                        drop_slots=kwargs['drop_slots'])
-        dataloader_dev = get_sequence_dataloader(data_dev, lang, mem_lang, batch_size)
-
-        data_test, max_len_test, slot_test = read_language(file_test, gating_dict, all_slots, "test", lang,
-                                                           mem_lang, data_ratio=kwargs['test_data_ratio'],
-                                                           drop_slots=kwargs['drop_slots'])
+        cache_key = preprocessing_cache_key([file_train, file_dev, file_test, ontology_path], training,
+                                            value_source_fingerprint(kwargs['appended_values'], load_multiwoz_database),
+                                            **kwargs)
+        preprocessed = load_preprocessed(cache_key, **kwargs)
+        if preprocessed:
+            data_train, max_len_train, slot_train = preprocessed['train']
+            data_dev, max_len_dev, slot_dev = preprocessed['dev']
+            data_test, max_len_test, slot_test = preprocessed['test']
+            vocab_size_train = preprocessed['vocab_size_train']
+            lang, mem_lang = preprocessed['langs']
+
+        else:
+            # Get training data, longest training turn length, slots used in training
+            if kwargs['stream_train']:
+                data_train, max_len_train, slot_train = read_language_streaming([file_train], gating_dict, all_slots, "train",
+                                                                                lang, mem_lang, kwargs['dataset'],
+                                                                                ENT_token=lang.index2word[kwargs['ENT_token']],
+                                                                                use_USR_SYS_tokens=kwargs['USR_SYS_tokens'],
+                                                                                SYS_token=lang.index2word[kwargs['SYS_token']],
+                                                                                USR_token=lang.index2word[kwargs['USR_token']],
+                                                                                appended_values=kwargs['appended_values'],
+                                                                                append_SYS_values=kwargs['append_SYS_values'],
+                                                                                percent_ground_truth=kwargs['percent_ground_truth'],
+                                                                                drop_slots=kwargs['drop_slots'],
+                                                                                shuffle_buffer=kwargs['shuffle_buffer'],
+                                                                                seed=kwargs['seed'])
+            else:
+                data_train, max_len_train, slot_train = read_language(file_train, gating_dict, all_slots, "train", lang, mem_lang,
+                                                                      ENT_token=lang.index2word[kwargs['ENT_token']],
+                                                                      use_USR_SYS_tokens=kwargs['USR_SYS_tokens'],
+                                                                      SYS_token=lang.index2word[kwargs['SYS_token']],
+                                                                      USR_token=lang.index2word[kwargs['USR_token']],
+                                                                      appended_values=kwargs['appended_values'],
+                                                                      append_SYS_values=kwargs['append_SYS_values'],
+                                                                      percent_ground_truth=kwargs['percent_ground_truth'],
+                                                                      data_ratio=kwargs['train_data_ratio'],
+                                                                      drop_slots=kwargs['drop_slots'],
+                                                                      seed=kwargs['seed'])
+            vocab_size_train = lang.n_words
+
+            # Get dev data, longest dev turn length, slots used in dev
+            data_dev, max_len_dev, slot_dev = read_language(file_dev, gating_dict, all_slots, "dev", lang, mem_lang,
+                                                            ENT_token=lang.index2word[kwargs['ENT_token']],
+                                                            use_USR_SYS_tokens=kwargs['USR_SYS_tokens'],
+                                                            SYS_token=lang.index2word[kwargs['SYS_token']],
+                                                            USR_token=lang.index2word[kwargs['USR_token']],
+                                                            appended_values=kwargs['appended_values'],
+                                                            append_SYS_values=kwargs['append_SYS_values'],
+                                                            percent_ground_truth=kwargs['percent_ground_truth'],
+                                                            data_ratio=kwargs['dev_data_ratio'],
+                                                            drop_slots=kwargs['drop_slots'],
+                                                            seed=kwargs['seed'])
+
+            data_test, max_len_test, slot_test = read_language(file_test, gating_dict, all_slots, "test", lang,
+                                                               mem_lang, data_ratio=kwargs['test_data_ratio'],
+                                                               drop_slots=kwargs['drop_slots'])
+
+            save_preprocessed(cache_key, {'train': (data_train, max_len_train, slot_train),
+                                          'dev': (data_dev, max_len_dev, slot_dev),
+                                          'test': (data_test, max_len_test, slot_test),
+                                          'vocab_size_train': vocab_size_train,
+                                          'langs': (lang, mem_lang)}, **kwargs)
+
+        if kwargs['stream_train']:
+            dataloader_train = get_streaming_dataloader(data_train, batch_size, **dataloader_options(**kwargs))
+        else:
+            dataloader_train = get_sequence_dataloader(data_train, lang, mem_lang, batch_size,
+                                                       store_path=columnar_store_path(cache_key, "train", **kwargs),
+                                                       **dataloader_options(**kwargs))
+        dataloader_dev = get_sequence_dataloader(data_dev, lang, mem_lang, batch_size, shuffle=False,
+                                                 store_path=columnar_store_path(cache_key, "dev", **kwargs),
+                                                 **dataloader_options(**kwargs))
         dataloader_test = []
 
         # if language files already exist, load them
@@ -792,9 +1010,8 @@ def prepare_data(training, **kwargs):
                 pkl.dump(mem_lang, p)
 
         # dump the pre-calculated embeddings for the language
-        embedding_dump_path = f'data/emb{lang.n_words}.json'
-        if not os.path.exists(embedding_dump_path) and load_embeddings:
-            dump_pretrained_emb(lang.word2index, lang.index2word, embedding_dump_path)
+        if load_embeddings and not pretrained_embeddings.is_up_to_date(lang.word2index):
+            dump_pretrained_emb(lang.word2index, lang.index2word)
 
     # if testing
     else:
@@ -808,20 +1025,37 @@ def prepare_data(training, **kwargs):
 
         data_dev, max_len_dev, slot_dev, dataloader_dev = [], 0, [], []
 
-        # Get test data, longest test turn length, slots used in test
-        data_test, max_len_test, slot_test = read_language(file_test, gating_dict, all_slots, "test",
-                                                           lang, mem_lang,
-                                                           ENT_token=lang.index2word[kwargs['ENT_token']],
-                                                           use_USR_SYS_tokens=kwargs['USR_SYS_tokens'],
-                                                           SYS_token=lang.index2word[kwargs['SYS_token']],
-                                                           USR_token=lang.index2word[kwargs['USR_token']],
-                                                           appended_values=kwargs['appended_values'],
-                                                           append_SYS_values=kwargs['append_SYS_values'],
-                                                           percent_ground_truth=kwargs['percent_ground_truth'],
-                                                           data_ratio=kwargs['test_data_ratio'],
-                                                           drop_slots=kwargs['drop_slots'])
-
-        dataloader_test = get_sequence_dataloader(data_test, lang, mem_lang, batch_size)
+        # the test data adds its words to the saved languages, so they are part of the cache key
+        #   the ontology of the DB value sources is part of the source fingerprint
+        cache_key = preprocessing_cache_key([file_test, ontology_path, os.path.join(lang_path, lang_name),
+                                             os.path.join(lang_path, mem_lang_name)], training,
+                                            value_source_fingerprint(kwargs['appended_values'], load_multiwoz_database),
+                                            **kwargs)
+        preprocessed = load_preprocessed(cache_key, **kwargs)
+        if preprocessed:
+            data_test, max_len_test, slot_test = preprocessed['test']
+            lang, mem_lang = preprocessed['langs']
+
+        else:
+            # Get test data, longest test turn length, slots used in test
+            data_test, max_len_test, slot_test = read_language(file_test, gating_dict, all_slots, "test",
+                                                               lang, mem_lang,
+                                                               ENT_token=lang.index2word[kwargs['ENT_token']],
+                                                               use_USR_SYS_tokens=kwargs['USR_SYS_tokens'],
+                                                               SYS_token=lang.index2word[kwargs['SYS_token']],
+                                                               USR_token=lang.index2word[kwargs['USR_token']],
+                                                               appended_values=kwargs['appended_values'],
+                                                               append_SYS_values=kwargs['append_SYS_values'],
+                                                               percent_ground_truth=kwargs['percent_ground_truth'],
+                                                               data_ratio=kwargs['test_data_ratio'],
+                                                               drop_slots=kwargs['drop_slots'],
+                                                               seed=kwargs['seed'])
+            save_preprocessed(cache_key, {'test': (data_test, max_len_test, slot_test),
+                                          'langs': (lang, mem_lang)}, **kwargs)
+
+        dataloader_test = get_sequence_dataloader(data_test, lang, mem_lang, batch_size, shuffle=False,
+                                                  store_path=columnar_store_path(cache_key, "test", **kwargs),
+                                                  **dataloader_options(**kwargs))
 
     max_word = max(max_len_train, max_len_dev, max_len_test) + 1
 
@@ -867,7 +1101,8 @@ def prepare_data_multiwoz_22(training, **kwargs):
         os.makedirs(lang_path)
 
     # load domain-slot pairs from original ontology
-    ontology = json.load(open("data/multi-woz/MULTIWOZ2 2/ontology.json", 'r'))
+    ontology_path = "data/multi-woz/MULTIWOZ2 2/ontology.json"
+    ontology = json.load(open(ontology_path, 'r'))
     all_slots = get_slot_information_multiwoz_22(ontology, kwargs['drop_slots'])
     gating_dict = {"ptr": 0, "dontcare": 1, "none": 2}
 
@@ -896,38 +1131,84 @@ def prepare_data_multiwoz_22(training, **kwargs):
     mem_lang_name = 'mem-lang-all.pkl'
 
     if training:
-        # Get training data, longest training turn length, slots used in training
-        data_train, max_len_train, slot_train = read_language_multiwoz_22(files_train, gating_dict, all_slots, "train", lang, mem_lang,
-                                                                          ENT_token=lang.index2word[kwargs['ENT_token']],
-                                                                          use_USR_SYS_tokens=kwargs['USR_SYS_tokens'],
-                                                                          SYS_token=lang.index2word[kwargs['SYS_token']],
-                                                                          USR_token=lang.index2word[kwargs['USR_token']],
-                                                                          appended_values=kwargs['appended_values'],
-                                                                          append_SYS_values=kwargs['append_SYS_values'],
-                                                                          percent_ground_truth=kwargs['percent_ground_truth'],
-                                                                          data_ratio=kwargs['train_data_ratio'],
-                                                                          drop_slots=kwargs['drop_slots'],
-                                                                          ground_truth_slots=kwargs['ground_truth_slots'])
-        dataloader_train = get_sequence_dataloader(data_train, lang, mem_lang, batch_size)
-        vocab_size_train = lang.n_words
-
-        # Get dev data, longest dev turn length, slots used in dev
-        data_dev, max_len_dev, slot_dev = read_language_multiwoz_22(files_dev, gating_dict, all_slots, "dev", lang, mem_lang,
-                                                                    ENT_token=lang.index2word[kwargs['ENT_token']],
-                                                                    use_USR_SYS_tokens=kwargs['USR_SYS_tokens'],
-                                                                    SYS_token=lang.index2word[kwargs['SYS_token']],
-                                                                    USR_token=lang.index2word[kwargs['USR_token']],
-                                                                    appended_values=kwargs['appended_values'],
-                                                                    append_SYS_values=kwargs['append_SYS_values'],
-                                                                    percent_ground_truth=kwargs['percent_ground_truth'],
-                                                                    data_ratio=kwargs['dev_data_ratio'],
-                                                                    drop_slots=kwargs['drop_slots'],
-                                                                    ground_truth_slots=kwargs['ground_truth_slots'])
-        dataloader_dev = get_sequence_dataloader(data_dev, lang, mem_lang, batch_size)
-
-        data_test, max_len_test, slot_test = read_language_multiwoz_22(files_test, gating_dict, all_slots, "test", lang,
-                                                                       mem_lang, data_ratio=kwargs['test_data_ratio'],
-                                                                       drop_slots=kwargs['drop_slots'])
+        cache_key = preprocessing_cache_key(files_train + files_dev + files_test + [ontology_path], training,
+                                            value_source_fingerprint(kwargs['appended_values'], load_multiwoz_22_database),
+                                            **kwargs)
+        preprocessed = load_preprocessed(cache_key, **kwargs)
+        if preprocessed:
+            data_train, max_len_train, slot_train = preprocessed['train']
+            data_dev, max_len_dev, slot_dev = preprocessed['dev']
+            data_test, max_len_test, slot_test = preprocessed['test']
+            vocab_size_train = preprocessed['vocab_size_train']
+            lang, mem_lang = preprocessed['langs']
+
+        else:
+            # Get training data, longest training turn length, slots used in training
+            if kwargs['stream_train']:
+                data_train, max_len_train, slot_train = read_language_streaming(files_train, gating_dict, all_slots, "train",
+                                                                                lang, mem_lang, kwargs['dataset'],
+                                                                                ENT_token=lang.index2word[kwargs['ENT_token']],
+                                                                                use_USR_SYS_tokens=kwargs['USR_SYS_tokens'],
+                                                                                SYS_token=lang.index2word[kwargs['SYS_token']],
+                                                                                USR_token=lang.index2word[kwargs['USR_token']],
+                                                                                appended_values=kwargs['appended_values'],
+                                                                                append_SYS_values=kwargs['append_SYS_values'],
+                                                                                percent_ground_truth=kwargs['percent_ground_truth'],
+                                                                                drop_slots=kwargs['drop_slots'],
+                                                                                ground_truth_slots=kwargs['ground_truth_slots'],
+                                                                                shuffle_buffer=kwargs['shuffle_buffer'],
+                                                                                seed=kwargs['seed'])
+            else:
+                data_train, max_len_train, slot_train = read_language_multiwoz_22(files_train, gating_dict, all_slots, "train", lang, mem_lang,
+                                                                                  ENT_token=lang.index2word[kwargs['ENT_token']],
+                                                                                  use_USR_SYS_tokens=kwargs['USR_SYS_tokens'],
+                                                                                  SYS_token=lang.index2word[kwargs['SYS_token']],
+                                                                                  USR_token=lang.index2word[kwargs['USR_token']],
+                                                                                  appended_values=kwargs['appended_values'],
+                                                                                  append_SYS_values=kwargs['append_SYS_values'],
+                                                                                  percent_ground_truth=kwargs['percent_ground_truth'],
+                                                                                  data_ratio=kwargs['train_data_ratio'],
+                                                                                  drop_slots=kwargs['drop_slots'],
+                                                                                  ground_truth_slots=kwargs['ground_truth_slots'],
+                                                                                  seed=kwargs['seed'],
+                                                                                  num_workers=kwargs['ingestion_workers'])
+            vocab_size_train = lang.n_words
+
+            # Get dev data, longest dev turn length, slots used in dev
+            data_dev, max_len_dev, slot_dev = read_language_multiwoz_22(files_dev, gating_dict, all_slots, "dev", lang, mem_lang,
+                                                                        ENT_token=lang.index2word[kwargs['ENT_token']],
+                                                                        use_USR_SYS_tokens=kwargs['USR_SYS_tokens'],
+                                                                        SYS_token=lang.index2word[kwargs['SYS_token']],
+                                                                        USR_token=lang.index2word[kwargs['USR_token']],
+                                                                        appended_values=kwargs['appended_values'],
+                                                                        append_SYS_values=kwargs['append_SYS_values'],
+                                                                        percent_ground_truth=kwargs['percent_ground_truth'],
+                                                                        data_ratio=kwargs['dev_data_ratio'],
+                                                                        drop_slots=kwargs['drop_slots'],
+                                                                        ground_truth_slots=kwargs['ground_truth_slots'],
+                                                                        seed=kwargs['seed'],
+                                                                        num_workers=kwargs['ingestion_workers'])
+
+            data_test, max_len_test, slot_test = read_language_multiwoz_22(files_test, gating_dict, all_slots, "test", lang,
+                                                                           mem_lang, data_ratio=kwargs['test_data_ratio'],
+                                                                           drop_slots=kwargs['drop_slots'],
+                                                                           num_workers=kwargs['ingestion_workers'])
+
+            save_preprocessed(cache_key, {'train': (data_train, max_len_train, slot_train),
+                                          'dev': (data_dev, max_len_dev, slot_dev),
+                                          'test': (data_test, max_len_test, slot_test),
+                                          'vocab_size_train': vocab_size_train,
+                                          'langs': (lang, mem_lang)}, **kwargs)
+
+        if kwargs['stream_train']:
+            dataloader_train = get_streaming_dataloader(data_train, batch_size, **dataloader_options(**kwargs))
+        else:
+            dataloader_train = get_sequence_dataloader(data_train, lang, mem_lang, batch_size,
+                                                       store_path=columnar_store_path(cache_key, "train", **kwargs),
+                                                       **dataloader_options(**kwargs))
+        dataloader_dev = get_sequence_dataloader(data_dev, lang, mem_lang, batch_size, shuffle=False,
+                                                 store_path=columnar_store_path(cache_key, "dev", **kwargs),
+                                                 **dataloader_options(**kwargs))
         dataloader_test = []
 
         # if language files already exist, load them
@@ -947,9 +1228,8 @@ def prepare_data_multiwoz_22(training, **kwargs):
                 pkl.dump(mem_lang, p)
 
         # dump the pre-calculated embeddings for the language
-        embedding_dump_path = f'data/emb{lang.n_words}.json'
-        if not os.path.exists(embedding_dump_path) and load_embeddings:
-            dump_pretrained_emb(lang.word2index, lang.index2word, embedding_dump_path)
+        if load_embeddings and not pretrained_embeddings.is_up_to_date(lang.word2index):
+            dump_pretrained_emb(lang.word2index, lang.index2word)
 
     # if testing
     else:
@@ -963,21 +1243,39 @@ def prepare_data_multiwoz_22(training, **kwargs):
 
         data_dev, max_len_dev, slot_dev, dataloader_dev = [], 0, [], []
 
-        # Get test data, longest test turn length, slots used in test
-        data_test, max_len_test, slot_test = read_language_multiwoz_22(files_test, gating_dict, all_slots, "test",
-                                                                       lang, mem_lang,
-                                                                       ENT_token=lang.index2word[kwargs['ENT_token']],
-                                                                       use_USR_SYS_tokens=kwargs['USR_SYS_tokens'],
-                                                                       SYS_token=lang.index2word[kwargs['SYS_token']],
-                                                                       USR_token=lang.index2word[kwargs['USR_token']],
-                                                                       appended_values=kwargs['appended_values'],
-                                                                       append_SYS_values=kwargs['append_SYS_values'],
-                                                                       percent_ground_truth=kwargs['percent_ground_truth'],
-                                                                       data_ratio=kwargs['test_data_ratio'],
-                                                                       drop_slots=kwargs['drop_slots'],
-                                                                       ground_truth_slots=kwargs['ground_truth_slots'])
-
-        dataloader_test = get_sequence_dataloader(data_test, lang, mem_lang, batch_size)
+        # the test data adds its words to the saved languages, so they are part of the cache key
+        #   the ontology of the DB value sources, read from every split for multiwoz_22, is part of the source fingerprint
+        cache_key = preprocessing_cache_key(files_test + [ontology_path, os.path.join(lang_path, lang_name),
+                                                          os.path.join(lang_path, mem_lang_name)], training,
+                                            value_source_fingerprint(kwargs['appended_values'], load_multiwoz_22_database),
+                                            **kwargs)
+        preprocessed = load_preprocessed(cache_key, **kwargs)
+        if preprocessed:
+            data_test, max_len_test, slot_test = preprocessed['test']
+            lang, mem_lang = preprocessed['langs']
+
+        else:
+            # Get test data, longest test turn length, slots used in test
+            data_test, max_len_test, slot_test = read_language_multiwoz_22(files_test, gating_dict, all_slots, "test",
+                                                                           lang, mem_lang,
+                                                                           ENT_token=lang.index2word[kwargs['ENT_token']],
+                                                                           use_USR_SYS_tokens=kwargs['USR_SYS_tokens'],
+                                                                           SYS_token=lang.index2word[kwargs['SYS_token']],
+                                                                           USR_token=lang.index2word[kwargs['USR_token']],
+                                                                           appended_values=kwargs['appended_values'],
+                                                                           append_SYS_values=kwargs['append_SYS_values'],
+                                                                           percent_ground_truth=kwargs['percent_ground_truth'],
+                                                                           data_ratio=kwargs['test_data_ratio'],
+                                                                           drop_slots=kwargs['drop_slots'],
+                                                                           ground_truth_slots=kwargs['ground_truth_slots'],
+                                                                           seed=kwargs['seed'],
+                                                                           num_workers=kwargs['ingestion_workers'])
+            save_preprocessed(cache_key, {'test': (data_test, max_len_test, slot_test),
+                                          'langs': (lang, mem_lang)}, **kwargs)
+
+        dataloader_test = get_sequence_dataloader(data_test, lang, mem_lang, batch_size, shuffle=False,
+                                                  store_path=columnar_store_path(cache_key, "test", **kwargs),
+                                                  **dataloader_options(**kwargs))
 
     max_word = max(max_len_train, max_len_dev, max_len_test) + 1
 
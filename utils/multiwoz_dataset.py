@@ -1,121 +1,332 @@
+import os
+import json
+import random
+import hashlib
+import pickle as pkl
+from functools import lru_cache
+import numpy as np
 import torch
+from utils.dialogue_stream import iter_dialogues
 
 UNK_token = 0
 PAD_token = 1
 EOS_token = 3
 
-DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
+# bump when the layout of the columnar store changes
+COLUMNAR_STORE_VERSION = 1
+
+
+def vocab_hash(word2idx):
+    return hashlib.sha1(json.dumps(sorted(word2idx.items())).encode()).hexdigest()
+
+
+@lru_cache(maxsize=None)
+def open_array(path):
+    """memory-map an array of the columnar store, once per process
+    copy-on-write, so that tensors can be made from slices without copying or warnings about read-only memory
+    """
+    return np.load(path, mmap_mode='c')
+
+
+def is_columnar_store(path, src_word2id):
+    meta_path = os.path.join(path, 'meta.json')
+    if not os.path.exists(meta_path):
+        return False
+    with open(meta_path, 'r') as f:
+        meta = json.load(f)
+    return meta['version'] == COLUMNAR_STORE_VERSION and meta['vocab_hash'] == vocab_hash(src_word2id)
+
+
+def write_columnar_store(data_info, src_word2id, trg_word2id, path):
+    """
+    Write a split in a compact columnar format, memory-mapped by Dataset
+        tokens.npy: int32, the token ids of every dialogue history, each dialogue stored once as a single run
+        token_offsets.npy: (turns, 2) start and end of each turn's history in tokens,
+            a turn's history is a prefix of its dialogue's run, so later turns do not store the history again
+        text.npy, text_offsets.npy: the same for the utf-8 bytes of the history strings (context_plain)
+        gating_label.npy: (turns, slots) int8
+        generate_y.npy: (turns, slots, max value length) int32 ids of each slot value with EOS, padded with PAD
+        y_lengths.npy: (turns, slots) int32
+        meta.pkl: dialogue IDs, turn IDs and turn beliefs
+    """
+    tokens, token_offsets, run_tokens, run_start = [], [], [], 0
+    text, text_offsets, run_text, text_run_start, text_len = [], [], b"", 0, 0
+    prev_ID = None
+    for ID, history in zip(data_info['ID'], data_info['dialog_history']):
+        ids = [src_word2id[word] if word in src_word2id else UNK_token for word in history.split()]
+        history = history.encode('utf-8')
+
+        # continue the current run if this history extends the previous turn of the same dialogue
+        if ID != prev_ID or ids[:len(run_tokens)] != run_tokens:
+            run_start, run_tokens = len(tokens), []
+        tokens.extend(ids[len(run_tokens):])
+        run_tokens = ids
+        token_offsets.append((run_start, run_start + len(ids)))
+
+        if ID != prev_ID or not history.startswith(run_text):
+            text_run_start, run_text = text_len, b""
+        text.append(history[len(run_text):])
+        text_len += len(history) - len(run_text)
+        run_text = history
+        text_offsets.append((text_run_start, text_run_start + len(history)))
+        prev_ID = ID
+
+    values = [[[trg_word2id[word] if word in trg_word2id else UNK_token for word in value.split()] + [EOS_token]
+               for value in generate_y] for generate_y in data_info['generate_y']]
+    y_lengths = np.array([[len(v) for v in datum] for datum in values], dtype=np.int32)
+    generate_y = np.full(y_lengths.shape + (y_lengths.max(),), PAD_token, dtype=np.int32)
+    for i, datum in enumerate(values):
+        for j, v in enumerate(datum):
+            generate_y[i, j, :len(v)] = v
+
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, 'tokens.npy'), np.array(tokens, dtype=np.int32))
+    np.save(os.path.join(path, 'token_offsets.npy'), np.array(token_offsets, dtype=np.int64))
+    np.save(os.path.join(path, 'text.npy'), np.frombuffer(b"".join(text), dtype=np.uint8))
+    np.save(os.path.join(path, 'text_offsets.npy'), np.array(text_offsets, dtype=np.int64))
+    np.save(os.path.join(path, 'gating_label.npy'), np.array(data_info['gating_label'], dtype=np.int8))
+    np.save(os.path.join(path, 'generate_y.npy'), generate_y)
+    np.save(os.path.join(path, 'y_lengths.npy'), y_lengths)
+    with open(os.path.join(path, 'meta.pkl'), 'wb') as f:
+        pkl.dump({'ID': data_info['ID'], 'turn_id': data_info['turn_id'], 'turn_belief': data_info['turn_belief']}, f)
+    # written last, the store is only valid once meta.json exists
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({'version': COLUMNAR_STORE_VERSION, 'vocab_hash': vocab_hash(src_word2id),
+                   'num_turns': len(token_offsets), 'num_tokens': len(tokens)}, f)
+
+
+class ContextPlain():
+    """The dialogue history string of a turn, only decoded from the columnar store when used"""
+
+    def __init__(self, text_path, start, end):
+        self.text_path = text_path
+        self.start = start
+        self.end = end
+
+    def __str__(self):
+        return open_array(self.text_path)[self.start:self.end].tobytes().decode('utf-8')
+
+    def __repr__(self):
+        return repr(str(self))
 
 
 class Dataset(torch.utils.data.Dataset):
-    """Custom dataset for multiwoz"""
+    """Custom dataset for multiwoz, served from a columnar store (see write_columnar_store)"""
 
-    def __init__(self, data_info, source_word2id, target_word2id, mem_word2id):
-        """Reads source and target sequences from txt files."""
-        self.ID = data_info['ID']
-        # list of domains by TURN, not by dialogue
-        # self.turn_domain = data_info['turn_domain']
+    def __init__(self, store_path):
+        self.store_path = store_path
+        with open(os.path.join(store_path, 'meta.pkl'), 'rb') as f:
+            meta = pkl.load(f)
+        # list of dialogue IDs by turn
+        self.ID = meta['ID']
         # list of turn indices per dialogue [0,1,2,3,4, 0,1,2,3, etc]
-        self.turn_id = data_info['turn_id']
-        # dialogue history by turn
-        self.dialog_history = data_info['dialog_history']
+        self.turn_id = meta['turn_id']
         # list of domain-slot value pairs by turn
-        self.turn_belief = data_info['turn_belief']
-        # list of list of gate labels for each gate, by turn
-        self.gating_label = data_info['gating_label']
-        # self.turn_uttr = data_info['turn_uttr']
-        # list of accumulated slot values by turn
-        self.generate_y = data_info["generate_y"]
-        self.num_total_seqs = len(self.dialog_history)
-        self.src_word2id = source_word2id
-        self.trg_word2id = target_word2id
-        self.mem_word2id = mem_word2id
+        self.turn_belief = meta['turn_belief']
+        self.num_total_seqs = len(self.ID)
+
+    def array(self, name):
+        # arrays are opened lazily, so that the dataset can be sent to dataloader workers without their contents
+        return open_array(os.path.join(self.store_path, f"{name}.npy"))
 
     def __len__(self):
         return self.num_total_seqs
 
+    def context_lengths(self):
+        """number of tokens in each turn's dialogue history"""
+        offsets = self.array('token_offsets')
+        return offsets[:, 1] - offsets[:, 0]
+
     def __getitem__(self, index):
         """returns one datum (source and target)"""
-        ID = self.ID[index]
-        turn_id = self.turn_id[index]
-        turn_belief = self.turn_belief[index]
-        gating_label = self.gating_label[index]
-        # turn_uttr = self.turn_uttr[index]
-        # turn_domain = self.preprocess_domain(self.turn_domain[index])
-        generate_y = self.generate_y[index]
-        generate_y = self.preprocess_slot(generate_y, self.trg_word2id)
-        context = self.dialog_history[index]
-        context = self.preprocess(context, self.src_word2id)
-        context_plain = self.dialog_history[index]
+        start, end = self.array('token_offsets')[index]
+        text_start, text_end = self.array('text_offsets')[index]
 
         item_info = {
-            "ID": ID,
-            "turn_id": turn_id,
-            "turn_belief": turn_belief,
-            "gating_label": gating_label,
-            "context": context,
-            "context_plain": context_plain,
-            # "turn_uttr_plain": turn_uttr,
-            # "turn_domain": turn_domain,
-            "generate_y": generate_y,
+            "ID": self.ID[index],
+            "turn_id": self.turn_id[index],
+            "turn_belief": self.turn_belief[index],
+            "gating_label": torch.from_numpy(self.array('gating_label')[index]),
+            "context": torch.from_numpy(self.array('tokens')[start:end]),
+            "context_plain": ContextPlain(os.path.join(self.store_path, 'text.npy'), text_start, text_end),
+            "generate_y": torch.from_numpy(self.array('generate_y')[index]),
+            "y_lengths": torch.from_numpy(self.array('y_lengths')[index]),
         }
         return item_info
 
-    def preprocess(self, sequence, word2idx):
-        """Converts words to ids."""
-        context = [word2idx[word]
-                   if word in word2idx else UNK_token for word in sequence.split()]
-        context = torch.Tensor(context)
-        return context
-
-    def preprocess_slot(self, sequence, word2idx):
-        """Converts words to ids."""
-        story = []
-        for value in sequence:
-            v = [word2idx[word] if word in word2idx else UNK_token for word in value.split()] + \
-                [EOS_token]
-            story.append(v)
-        return story
-
     def preprocess_domain(self, turn_domain):
         domains = {"attraction": 0, "restaurant": 1, "taxi": 2,
                    "train": 3, "hotel": 4, "hospital": 5, "bus": 6, "police": 7}
         return domains[turn_domain]
 
 
+class StreamingDataset(torch.utils.data.IterableDataset):
+    """
+    Custom dataset for multiwoz, reading the dialogues from their files every epoch instead of keeping them in memory
+        turns go through a shuffle buffer, so memory stays bounded by shuffle_buffer whatever the size of the files
+        with dataloader workers, each worker reads every num_workers-th dialogue
+    """
+
+    def __init__(self, paths, read_dialogue, src_word2id, trg_word2id, num_turns, max_value_tokens,
+                 shuffle_buffer=10000, seed=None):
+        """
+        :param paths: json or jsonl files of dialogues (see dialogue_stream.iter_dialogues)
+        :param read_dialogue: picklable function of a dialogue, returns its data as read by read_language
+        :param num_turns: number of turns read from paths, the length of an epoch
+        :param max_value_tokens: longest slot value in tokens, with EOS
+        :param shuffle_buffer: number of turns shuffled together, 0 or 1 yields the turns in order
+        :param seed: seed of the shuffling, None to shuffle differently on every run
+        """
+        self.paths = paths
+        self.read_dialogue = read_dialogue
+        self.src_word2id = src_word2id
+        self.trg_word2id = trg_word2id
+        self.num_turns = num_turns
+        self.max_value_tokens = max_value_tokens
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+
+    def __len__(self):
+        return self.num_turns
+
+    def item(self, datum):
+        """a datum in the same format as Dataset.__getitem__"""
+        context = [self.src_word2id[word] if word in self.src_word2id else UNK_token
+                   for word in datum['dialog_history'].split()]
+        values = [[self.trg_word2id[word] if word in self.trg_word2id else UNK_token for word in value.split()] + [EOS_token]
+                  for value in datum['generate_y']]
+        generate_y = torch.full((len(values), self.max_value_tokens), PAD_token, dtype=torch.int32)
+        for j, v in enumerate(values):
+            generate_y[j, :len(v)] = torch.tensor(v, dtype=torch.int32)
+
+        item_info = {
+            "ID": datum['ID'],
+            "turn_id": datum['turn_id'],
+            "turn_belief": datum['turn_belief'],
+            "gating_label": torch.tensor(datum['gating_label'], dtype=torch.int8),
+            "context": torch.tensor(context, dtype=torch.int32),
+            "context_plain": datum['dialog_history'],
+            "generate_y": generate_y,
+            "y_lengths": torch.tensor([len(v) for v in values], dtype=torch.int32),
+        }
+        return item_info
+
+    def __iter__(self):
+        worker = torch.utils.data.get_worker_info()
+        shard, num_shards = (worker.id, worker.num_workers) if worker is not None else (0, 1)
+        # persistent workers keep their copy of the dataset, so every epoch is shuffled differently
+        self.epoch += 1
+        rng = random.Random(None if self.seed is None else f"{self.seed}-{self.epoch}-{shard}")
+
+        buffer = []
+        for dialogue_dict in iter_dialogues(self.paths, shard, num_shards):
+            for datum in self.read_dialogue(dialogue_dict):
+                item = self.item(datum)
+                if self.shuffle_buffer <= 1:
+                    yield item
+                elif len(buffer) < self.shuffle_buffer:
+                    buffer.append(item)
+                else:
+                    # yield a random turn of the buffer, and keep the new turn in its place
+                    index = rng.randrange(len(buffer))
+                    yield buffer[index]
+                    buffer[index] = item
+        rng.shuffle(buffer)
+        yield from buffer
+
+
+class LengthBatchSampler(torch.utils.data.Sampler):
+    """
+    Batches turns with similar context lengths, so that less of each batch is padding
+        if shuffle, turns are shuffled then sorted by length within buckets of bucket_batches batches,
+            and the batches are shuffled, so that each epoch sees different batches in a different order
+        otherwise, all turns are sorted by length, longest first, and always batched the same way
+    """
+
+    def __init__(self, lengths, batch_size, shuffle=True, max_tokens=None, bucket_batches=100, seed=None):
+        """
+        :param lengths: context length of each turn
+        :param batch_size: number of turns in a batch, unless max_tokens is set
+        :param max_tokens: if set, batches have as many turns as fit in batch size * longest context <= max_tokens,
+            a single turn longer than max_tokens is batched alone
+        :param bucket_batches: number of batches in each bucket sorted by length
+        :param seed: seed of the shuffling, None to shuffle differently on every run
+        """
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.max_tokens = max_tokens
+        self.bucket_size = batch_size*bucket_batches
+        self.rng = random.Random(seed)
+        # batches of the coming epoch, made once so that len() matches the iteration
+        self.epoch_batches = None
+
+    def batch(self, indices):
+        """split indices sorted by length into batches"""
+        if self.max_tokens is None:
+            return [indices[i:i+self.batch_size] for i in range(0, len(indices), self.batch_size)]
+
+        batches, batch, max_len = [], [], 0
+        for index in indices:
+            length = max(1, int(self.lengths[index]))
+            if batch and (len(batch)+1)*max(max_len, length) > self.max_tokens:
+                batches.append(batch)
+                batch, max_len = [], 0
+            batch.append(index)
+            max_len = max(max_len, length)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def make_batches(self):
+        if not self.shuffle:
+            # stable sort, so that turns of equal length stay in dataset order
+            return self.batch(np.argsort(-self.lengths, kind='stable').tolist())
+
+        indices = list(range(len(self.lengths)))
+        self.rng.shuffle(indices)
+        batches = []
+        for start in range(0, len(indices), self.bucket_size):
+            bucket = sorted(indices[start:start+self.bucket_size], key=lambda i: self.lengths[i], reverse=True)
+            batches.extend(self.batch(bucket))
+        self.rng.shuffle(batches)
+        return batches
+
+    def __len__(self):
+        if self.epoch_batches is None:
+            self.epoch_batches = self.make_batches()
+        return len(self.epoch_batches)
+
+    def __iter__(self):
+        batches = self.epoch_batches if self.epoch_batches is not None else self.make_batches()
+        self.epoch_batches = None
+        return iter(batches)
+
+
 def collate_fn(data):
+    """
+    Pads a batch in single allocations, without moving it to a device,
+        so that it can run in dataloader workers and be pinned (see DevicePrefetcher)
+    """
     def merge(sequences):
         '''
-        merge from batch * sent_len to batch * max_len 
+        merge from batch * sent_len to batch * max_len
         '''
-        lengths = [len(seq) for seq in sequences]
-        max_len = 1 if max(lengths) == 0 else max(lengths)
-        padded_seqs = torch.ones(len(sequences), max_len).long()
-        for i, seq in enumerate(sequences):
-            end = lengths[i]
-            padded_seqs[i, :end] = seq[:end]
-        padded_seqs = padded_seqs.detach()  # torch.tensor(padded_seqs)
-        return padded_seqs, lengths
-
-    def merge_multi_response(sequences):
+        lengths = torch.tensor([len(seq) for seq in sequences])
+        max_len = max(1, lengths.max().item())
+        padded_seqs = torch.full((len(sequences), max_len), PAD_token, dtype=torch.long)
+        # the tokens of the batch fill the unpadded positions row by row
+        padded_seqs[torch.arange(max_len) < lengths.unsqueeze(1)] = torch.cat(sequences).long()
+        return padded_seqs, lengths.tolist()
+
+    def merge_multi_response(sequences, lengths):
         '''
-        merge from batch * nb_slot * slot_len to batch * nb_slot * max_slot_len
+        merge from batch * nb_slot * split_max_slot_len to batch * nb_slot * max_slot_len
         '''
-        lengths = []
-        for bsz_seq in sequences:
-            length = [len(v) for v in bsz_seq]
-            lengths.append(length)
-        max_len = max([max(l) for l in lengths])
-        padded_seqs = []
-        for bsz_seq in sequences:
-            pad_seq = []
-            for v in bsz_seq:
-                v = v + [PAD_token] * (max_len-len(v))
-                pad_seq.append(v)
-            padded_seqs.append(pad_seq)
-        padded_seqs = torch.tensor(padded_seqs)
-        lengths = torch.tensor(lengths)
-        return padded_seqs, lengths
+        lengths = torch.stack(lengths)
+        padded_seqs = torch.stack(sequences)[:, :, :lengths.max()].long()
+        return padded_seqs, lengths.long()
 
     # sort a list by sequence length (descending order) to use pack_padded_sequence
     data.sort(key=lambda x: len(x['context']), reverse=True)
@@ -125,14 +336,58 @@ def collate_fn(data):
 
     # merge sequences
     src_seqs, src_lengths = merge(item_info['context'])
-    y_seqs, y_lengths = merge_multi_response(item_info["generate_y"])
-    gating_label = torch.tensor(item_info["gating_label"])
-    # turn_domain = torch.tensor(item_info["turn_domain"])
+    y_seqs, y_lengths = merge_multi_response(item_info["generate_y"], item_info["y_lengths"])
+    gating_label = torch.stack(item_info["gating_label"]).long()
 
-    item_info["context"] = src_seqs.to(DEVICE)
+    item_info["context"] = src_seqs
     item_info["context_len"] = src_lengths
-    item_info["gating_label"] = gating_label.to(DEVICE)
-    # item_info["turn_domain"] = turn_domain.to(DEVICE)
-    item_info["generate_y"] = y_seqs.to(DEVICE)
-    item_info["y_lengths"] = y_lengths.to(DEVICE)
+    item_info["gating_label"] = gating_label
+    item_info["generate_y"] = y_seqs
+    item_info["y_lengths"] = y_lengths
     return item_info
+
+
+class DevicePrefetcher():
+    """
+    Wraps a dataloader, and moves each batch to the device
+        on cuda, the next batch is copied on a side stream while the current batch is used
+    """
+
+    def __init__(self, dataloader, device):
+        self.dataloader = dataloader
+        self.dataset = dataloader.dataset
+        self.device = torch.device(device)
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def to_device(self, batch):
+        # non_blocking only overlaps with compute when the batch is in pinned memory
+        return {k: v.to(self.device, non_blocking=True) if torch.is_tensor(v) else v for k, v in batch.items()}
+
+    def __iter__(self):
+        if self.device.type != 'cuda':
+            for batch in self.dataloader:
+                yield self.to_device(batch)
+            return
+
+        stream = torch.cuda.Stream(self.device)
+        batches = iter(self.dataloader)
+
+        def load():
+            batch = next(batches, None)
+            if batch is None:
+                return None
+            with torch.cuda.stream(stream):
+                return self.to_device(batch)
+
+        batch = load()
+        while batch is not None:
+            torch.cuda.current_stream(self.device).wait_stream(stream)
+            # the tensors are used on the current stream, don't let the side stream reuse their memory early
+            for v in batch.values():
+                if torch.is_tensor(v):
+                    v.record_stream(torch.cuda.current_stream(self.device))
+            next_batch = load()
+            yield batch
+            batch = next_batch
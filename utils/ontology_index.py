@@ -0,0 +1,86 @@
+import os
+import json
+
+from utils.preprocessing_cache import hash_file
+
+# bump when the layout of the index, or the values read from the dialogues, change
+ONTOLOGY_INDEX_VERSION = 1
+
+
+def source_fingerprint(path):
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha1': hash_file(path).hexdigest()}
+
+
+def is_up_to_date(index, sources):
+    """
+    Whether the index was built from the current content of sources
+        files whose size and modification time did not change are not read again,
+        the fingerprints of files which were modified without changing their content are refreshed in index
+    """
+    if index['version'] != ONTOLOGY_INDEX_VERSION or list(index['sources']) != sources:
+        return False
+    for path in sources:
+        stat = os.stat(path)
+        fingerprint = index['sources'][path]
+        if (stat.st_size, stat.st_mtime_ns) != (fingerprint['size'], fingerprint['mtime_ns']):
+            if hash_file(path).hexdigest() != fingerprint['sha1']:
+                return False
+            fingerprint.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+            index['refreshed'] = True
+    return True
+
+
+def save_index(path, index):
+    # write to a temporary file first, so that an interrupted run never leaves a partial index
+    with open(path + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(path + '.tmp', path)
+
+
+def write_ontology_index(path, ontology, sources):
+    """
+    Save an ontology as a list of distinct values, and the ids of the values of each domain-slot
+    :param ontology: dict of domain-slot -> values, in the order they were found
+    :param sources: paths of the files the ontology was read from
+    """
+    value_ids = {}
+    slots = {ds: [value_ids.setdefault(v, len(value_ids)) for v in values] for ds, values in ontology.items()}
+    index = {'version': ONTOLOGY_INDEX_VERSION,
+             'sources': {source: source_fingerprint(source) for source in sources},
+             'values': list(value_ids),
+             'slots': slots}
+    save_index(path, index)
+
+
+def load_ontology_index(path, sources, build_ontology):
+    """
+    Load the ontology saved in the index at path, or build it and save the index when sources changed
+    :param sources: paths of the files the ontology is read from
+    :param build_ontology: function reading sources, returns a dict of domain-slot -> values in the order they were found
+    :returns: dict of domain-slot -> set of values, each set built in the order the values were found
+    """
+    index = None
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            index = json.load(f)
+        if not is_up_to_date(index, sources):
+            index = None
+        elif index.pop('refreshed', False):
+            save_index(path, index)
+
+    if index is None:
+        print(f"Building the ontology index at {path}")
+        ontology = build_ontology(sources)
+        write_ontology_index(path, ontology, sources)
+    else:
+        values = index['values']
+        ontology = {ds: [values[i] for i in ids] for ds, ids in index['slots'].items()}
+
+    # sets are filled one value at a time, so that they iterate in the same order as when read from the dialogues
+    ontology_sets = {}
+    for ds, values in ontology.items():
+        ontology_sets[ds] = set()
+        for v in values:
+            ontology_sets[ds].add(v)
+    return ontology_sets
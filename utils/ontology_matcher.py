@@ -0,0 +1,233 @@
+import os
+import json
+import hashlib
+import pickle as pkl
+from collections import deque
+
+# bump when the layout of a saved OntologyMatcher changes
+ONTOLOGY_MATCHER_VERSION = 2
+
+
+def database_fingerprint(database):
+    """hash of the values of each domain-slot, independent of their order"""
+    content = sorted((ds, sorted(set(values))) for ds, values in database.items())
+    return hashlib.sha1(json.dumps(content).encode()).hexdigest()
+
+
+class Automaton():
+    """Aho-Corasick automaton, finds every occurrence of a list of strings in a text in a single pass over the text"""
+
+    def __init__(self, strings):
+        """:param strings: list of strings, empty strings are never found"""
+        self.lengths = [len(s) for s in strings]
+        # trie, every node is a dict of character -> child node, the root is node 0
+        self.goto = [{}]
+        # strings ending at each node
+        self.outputs = [[]]
+        for index, s in enumerate(strings):
+            if not s:
+                continue
+            node = 0
+            for ch in s:
+                if ch not in self.goto[node]:
+                    self.goto[node][ch] = len(self.goto)
+                    self.goto.append({})
+                    self.outputs.append([])
+                node = self.goto[node][ch]
+            self.outputs[node].append(index)
+
+        # failure links, to the longest proper suffix which is in the trie,
+        #   and output links, to the longest proper suffix which ends a string
+        self.fail = [0]*len(self.goto)
+        self.output_link = [0]*len(self.goto)
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self.goto[node].items():
+                queue.append(child)
+                f = self.fail[node]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[child] = self.goto[f][ch] if ch in self.goto[f] and self.goto[f][ch] != child else 0
+                suffix = self.fail[child]
+                self.output_link[child] = suffix if self.outputs[suffix] else self.output_link[suffix]
+
+    def find(self, text):
+        """yields (index of the string, (start, end)) of every occurrence of a string in text"""
+        node = 0
+        goto, fail, outputs, output_link = self.goto, self.fail, self.outputs, self.output_link
+        for end, ch in enumerate(text, 1):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            match = node if outputs[node] else output_link[node]
+            while match:
+                for index in outputs[match]:
+                    yield index, (end - self.lengths[index], end)
+                match = output_link[match]
+
+
+class OntologyMatcher():
+    """
+    Finds the values of an ontology (domain-slot -> values) contained in an utterance, with an Automaton
+        over the lowercased values, matching as `value.lower() in utterance.lower()`
+    """
+
+    def __init__(self, database):
+        # lowercased pattern -> (domain-slot, value) pairs it matches
+        self.patterns = []
+        pattern_ids = {}
+        for ds, values in database.items():
+            for v in values:
+                pattern = v.lower()
+                if pattern not in pattern_ids:
+                    pattern_ids[pattern] = len(self.patterns)
+                    self.patterns.append((pattern, []))
+                if (ds, v) not in self.patterns[pattern_ids[pattern]][1]:
+                    self.patterns[pattern_ids[pattern]][1].append((ds, v))
+
+        self.automaton = Automaton([pattern for pattern, _ in self.patterns])
+        # empty patterns are contained in every utterance
+        self.always = [pattern_id for pattern_id, (pattern, _) in enumerate(self.patterns) if not pattern]
+
+        # rank of each (domain-slot, value) in the iteration order of the database, see set_order
+        self.order = {}
+        self.set_order(database)
+
+    def set_order(self, database):
+        """
+        Remember the iteration order of the database, found values are returned in this order
+            a value listed several times under a domain-slot is returned as many times
+        """
+        self.order = {}
+        rank = 0
+        for ds, values in database.items():
+            for v in values:
+                self.order.setdefault((ds, v), []).append(rank)
+                rank += 1
+
+    def matches(self, utterance):
+        """yields (domain-slot, value, (start, end)) of every occurrence of a value in the lowercased utterance"""
+        for pattern_id, span in self.automaton.find(utterance.lower()):
+            for ds, v in self.patterns[pattern_id][1]:
+                yield ds, v, span
+
+    def found_patterns(self, utterance):
+        """returns the ids of the patterns contained in the lowercased utterance"""
+        pattern_ids = set(self.always)
+        pattern_ids.update(pattern_id for pattern_id, _ in self.automaton.find(utterance.lower()))
+        return pattern_ids
+
+    def found_values(self, utterance):
+        """returns the (domain-slot, value) pairs contained in the utterance, in the iteration order of the database"""
+        pattern_ids = self.found_patterns(utterance)
+        ranked = [(rank, ds, v) for pattern_id in pattern_ids for ds, v in self.patterns[pattern_id][1]
+                  for rank in self.order.get((ds, v), [])]
+        return [(ds, v) for _, ds, v in sorted(ranked)]
+
+    def save(self, path):
+        # write to a temporary file first, so that an interrupted run never leaves a partial matcher
+        with open(path + '.tmp', 'wb') as f:
+            pkl.dump((ONTOLOGY_MATCHER_VERSION, self), f, protocol=pkl.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+
+
+def within_edits(peq, length, text, max_edits):
+    """
+    Myers' bit-parallel approximate matching
+    :param peq: dict of character -> bitmask of its positions in the pattern
+    :param length: length of the pattern
+    :returns: True if some substring of text is within max_edits insertions, deletions or substitutions of the pattern
+    """
+    mask = (1 << length) - 1
+    high = 1 << (length - 1)
+    pv, mv, score = mask, 0, length
+    if score <= max_edits:
+        return True
+    for ch in text:
+        eq = peq.get(ch, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & mask)
+        mh = pv & xh
+        if ph & high:
+            score += 1
+        elif mh & high:
+            score -= 1
+        if score <= max_edits:
+            return True
+        # a match may start anywhere in the text, so no carry is shifted into the first row
+        ph = (ph << 1) & mask
+        mh = (mh << 1) & mask
+        pv = mh | (~(xv | ph) & mask)
+        mv = ph & xv
+    return False
+
+
+class FuzzyOntologyMatcher(OntologyMatcher):
+    """
+    Finds the values found by OntologyMatcher, and the values which are within max_edits edits of a part of the utterance
+    Each value is split into max_edits + 1 disjoint n-grams, a part of the utterance within k edits of the value
+        contains at least one of its k + 1 n-grams unedited: the n-grams of every value are found with an Automaton,
+        and each occurrence is verified with a bounded edit distance on a window of the utterance around it
+    Values shorter than min_length are only matched exactly, otherwise a value like "east" would also match "west"
+    """
+
+    def __init__(self, database, max_edits=1, min_length=None):
+        super(FuzzyOntologyMatcher, self).__init__(database)
+        self.max_edits = max_edits
+        min_length = min_length or 3*(max_edits+1)
+
+        # n-grams, and the (pattern id, position in the pattern) of each n-gram
+        ngrams = []
+        self.postings = []
+        # bitmasks of the characters of each fuzzy pattern, see within_edits
+        self.peqs = {}
+        for pattern_id, (pattern, _) in enumerate(self.patterns):
+            if len(pattern.strip()) < min_length:
+                continue
+            bounds = [len(pattern)*i//(max_edits+1) for i in range(max_edits+2)]
+            for start, end in zip(bounds, bounds[1:]):
+                ngrams.append(pattern[start:end])
+                self.postings.append((pattern_id, start))
+            peq = {}
+            for i, ch in enumerate(pattern):
+                peq[ch] = peq.get(ch, 0) | (1 << i)
+            self.peqs[pattern_id] = peq
+        self.ngram_automaton = Automaton(ngrams)
+
+    def found_patterns(self, utterance):
+        pattern_ids = super(FuzzyOntologyMatcher, self).found_patterns(utterance)
+        text = utterance.lower()
+        k = self.max_edits
+        for index, (j, _) in self.ngram_automaton.find(text):
+            pattern_id, i = self.postings[index]
+            if pattern_id in pattern_ids:
+                continue
+            # edits before the n-gram shift it by at most k characters
+            length = len(self.patterns[pattern_id][0])
+            window = text[max(0, j - i - k):j - i + length + 2*k]
+            if within_edits(self.peqs[pattern_id], length, window, k):
+                pattern_ids.add(pattern_id)
+        return pattern_ids
+
+
+def load_ontology_matcher(database, directory, max_edits=0):
+    """
+    Load the matcher of a database from directory, or build and save it there
+    Matchers are keyed by the values of the database, the iteration order of this database is applied on load
+    :param max_edits: 0 for an OntologyMatcher, otherwise the max_edits of a FuzzyOntologyMatcher
+    """
+    suffix = f"-{max_edits}edits" if max_edits else ""
+    path = os.path.join(directory, f"ontology-matcher-{database_fingerprint(database)}{suffix}.pkl")
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            version, matcher = pkl.load(f)
+        if version == ONTOLOGY_MATCHER_VERSION:
+            matcher.set_order(database)
+            return matcher
+
+    matcher = FuzzyOntologyMatcher(database, max_edits) if max_edits else OntologyMatcher(database)
+    os.makedirs(directory, exist_ok=True)
+    matcher.save(path)
+    return matcher
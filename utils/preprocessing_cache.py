@@ -0,0 +1,79 @@
+import os
+import json
+import hashlib
+import pickle as pkl
+
+# bump when the preprocessing output changes, so that older caches are not reused
+PREPROCESSING_VERSION = 1
+
+# options which change the output of read_language/read_language_multiwoz_22
+PREPROCESSING_OPTIONS = ['dataset', 'appended_values', 'USR_SYS_tokens', 'append_SYS_values', 'drop_slots',
+                         'train_data_ratio', 'dev_data_ratio', 'test_data_ratio', 'ground_truth_slots',
+                         'percent_ground_truth', 'seed', 'ENT_token', 'SYS_token', 'USR_token']
+
+
+def hash_file(path, sha=None):
+    sha = sha or hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            sha.update(chunk)
+    return sha
+
+
+def preprocessing_cache_key(input_files, training, source_fingerprint=None, **kwargs):
+    """
+    Key of the preprocessed data, from the content of every input file, the preprocessing options,
+        and the model or settings of the value source
+    :param input_files: paths of every file read during preprocessing
+    :param training: whether train and dev data are preprocessed, or only test data
+    :param source_fingerprint: cache_fingerprint of the value source, see value_sources.value_source_fingerprint
+    :returns: hex digest, or None if the preprocessed data is not reproducible and should not be cached
+    """
+    # ground truth values are sampled at random, they can only be reproduced with a seed
+    if kwargs['appended_values'] == 'ground_truth' and kwargs['percent_ground_truth'] < 100 and kwargs['seed'] is None:
+        return None
+    # streamed training data is never held in memory, there is nothing to cache
+    if training and kwargs['stream_train']:
+        return None
+
+    sha = hashlib.sha1()
+    for path in input_files:
+        sha.update(path.encode())
+        hash_file(path, sha)
+    options = {option: kwargs[option] for option in PREPROCESSING_OPTIONS}
+    options.update(training=training, value_source=source_fingerprint, version=PREPROCESSING_VERSION)
+    sha.update(json.dumps(options, sort_keys=True).encode())
+    return sha.hexdigest()
+
+
+def load_preprocessed(cache_key, **kwargs):
+    """returns the cached preprocessed data, or None on a cache miss"""
+    if cache_key is None or kwargs['no_preprocessing_cache']:
+        return None
+    path = os.path.join(kwargs['preprocessing_cache_path'], f"{cache_key}.pkl")
+    if not os.path.exists(path):
+        return None
+    print(f"Loading preprocessed data from {path}")
+    with open(path, 'rb') as f:
+        return pkl.load(f)
+
+
+def save_preprocessed(cache_key, preprocessed, **kwargs):
+    if cache_key is None or kwargs['no_preprocessing_cache']:
+        return
+    os.makedirs(kwargs['preprocessing_cache_path'], exist_ok=True)
+    path = os.path.join(kwargs['preprocessing_cache_path'], f"{cache_key}.pkl")
+    # write to a temporary file first, so that an interrupted run never leaves a partial cache
+    with open(path + '.tmp', 'wb') as f:
+        pkl.dump(preprocessed, f, protocol=pkl.HIGHEST_PROTOCOL)
+    os.replace(path + '.tmp', path)
+    print(f"Saved preprocessed data to {path}")
+
+
+def columnar_store_path(cache_key, split, **kwargs):
+    """directory of a split's columnar store (see multiwoz_dataset.write_columnar_store), next to the cached data
+    :returns: None if the preprocessed data is not cached, then the store is written to a temporary directory
+    """
+    if cache_key is None or kwargs['no_preprocessing_cache']:
+        return None
+    return os.path.join(kwargs['preprocessing_cache_path'], f"{cache_key}-{split}")
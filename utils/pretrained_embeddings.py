@@ -0,0 +1,137 @@
+import os
+import json
+import glob
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+# GloVe (300) + Kazuma character n-gram (100) vectors, the default hidden size
+EMBEDDING_DIM = 400
+EMBEDDING_DIR = 'data'
+
+# word vector sources of each lookup worker, see init_lookup
+lookup_embeddings = None
+
+
+def embedding_paths(vocab_size, directory=EMBEDDING_DIR):
+    """returns the paths of the embedding matrix and of its manifest for a vocab"""
+    return (os.path.join(directory, f'emb{vocab_size}.npy'),
+            os.path.join(directory, f'emb{vocab_size}.manifest.json'))
+
+
+def words_of(word2index):
+    """words of a vocab, in order of index"""
+    return [word for word, _ in sorted(word2index.items(), key=lambda item: item[1])]
+
+
+def vocab_hash(words):
+    return hashlib.sha1(json.dumps(words).encode()).hexdigest()
+
+
+def read_manifest(manifest_path):
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+
+def is_up_to_date(word2index, directory=EMBEDDING_DIR):
+    words = words_of(word2index)
+    manifest = read_manifest(embedding_paths(len(words), directory)[1])
+    return manifest is not None and manifest['vocab_hash'] == vocab_hash(words)
+
+
+def init_lookup():
+    global lookup_embeddings
+    # imported here, each worker opens its own connection to the embedding databases
+    from embeddings import GloveEmbedding, KazumaCharEmbedding
+    lookup_embeddings = [GloveEmbedding(), KazumaCharEmbedding()]
+
+
+def lookup_words(words):
+    """returns the (words, EMBEDDING_DIM) vectors of words, zeros for unknown words"""
+    if lookup_embeddings is None:
+        init_lookup()
+    E = np.zeros((len(words), EMBEDDING_DIM), dtype=np.float32)
+    for i, word in enumerate(words):
+        e = []
+        for emb in lookup_embeddings:
+            e += emb.emb(word, default='zero')
+        E[i] = e
+    return E
+
+
+def previous_vectors(directory=EMBEDDING_DIR):
+    """
+    Index the rows of every embedding matrix already built in directory
+    :returns: dict of word -> (matrix path, row)
+    """
+    rows = {}
+    for manifest_path in glob.glob(os.path.join(directory, 'emb*.manifest.json')):
+        manifest = read_manifest(manifest_path)
+        matrix_path = os.path.join(directory, manifest['matrix'])
+        if not os.path.exists(matrix_path):
+            continue
+        for row, word in enumerate(manifest['words']):
+            rows.setdefault(word, (matrix_path, row))
+    return rows
+
+
+def dump_pretrained_emb(word2index, index2word, directory=EMBEDDING_DIR, num_workers=None, chunk_size=1000):
+    """
+    Build the embedding matrix of a vocab as a .npy file, with a manifest of its vocab
+        vectors of words in previously built matrices are copied, only the missing words are looked up,
+        in parallel chunks when there are many of them
+    :param num_workers: number of lookup processes, defaults to the number of cpus
+    """
+    words = [index2word[i] for i in range(len(word2index))]
+    matrix_path, manifest_path = embedding_paths(len(words), directory)
+    print(f"Dumping pretrained embeddings at {matrix_path}")
+
+    E = np.zeros((len(words), EMBEDDING_DIM), dtype=np.float32)
+    previous = previous_vectors(directory)
+    matrices = {}
+    missing = []
+    for i, word in enumerate(words):
+        if word in previous:
+            path, row = previous[word]
+            if path not in matrices:
+                matrices[path] = np.load(path, mmap_mode='r')
+            E[i] = matrices[path][row]
+        else:
+            missing.append(i)
+    print(f"Reused {len(words) - len(missing)} vectors, looking up {len(missing)} words")
+
+    chunks = [missing[i:i+chunk_size] for i in range(0, len(missing), chunk_size)]
+    if len(chunks) > 1:
+        num_workers = min(num_workers or os.cpu_count(), len(chunks))
+        with ProcessPoolExecutor(num_workers, initializer=init_lookup) as executor:
+            vectors = executor.map(lookup_words, [[words[i] for i in chunk] for chunk in chunks])
+            for chunk, chunk_vectors in zip(chunks, vectors):
+                E[chunk] = chunk_vectors
+    elif chunks:
+        E[chunks[0]] = lookup_words([words[i] for i in chunks[0]])
+
+    os.makedirs(directory, exist_ok=True)
+    # the manifest is removed first and written last, so that a matrix is never used with the manifest of another vocab
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+    with open(matrix_path + '.tmp', 'wb') as f:
+        np.save(f, E)
+    os.replace(matrix_path + '.tmp', matrix_path)
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump({'matrix': os.path.basename(matrix_path), 'vocab_hash': vocab_hash(words),
+                   'dim': EMBEDDING_DIM, 'words': words}, f)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def load_pretrained_emb(word2index, directory=EMBEDDING_DIR):
+    """returns the memory-mapped embedding matrix of a vocab, built by dump_pretrained_emb
+    copy-on-write, so that a tensor can be made from it without copying or warnings about read-only memory
+    """
+    words = words_of(word2index)
+    matrix_path, manifest_path = embedding_paths(len(words), directory)
+    manifest = read_manifest(manifest_path)
+    assert(manifest is not None and manifest['vocab_hash'] == vocab_hash(words)), \
+        f"{matrix_path} is missing or was built for another vocab, run training to build it"
+    return np.load(matrix_path, mmap_mode='c')
@@ -3,6 +3,8 @@ import re
 import json
 from torch import cuda
 
+from utils.ontology_index import load_ontology_index
+
 UNK_token = 0
 PAD_token = 1
 SOS_token = 2
@@ -30,7 +32,10 @@ ALL_SLOTS = ['hotel-pricerange', 'hotel-type', 'hotel-parking', 'hotel-book stay
              'restaurant-book time', 'restaurant-book day', 'restaurant-book people', 'taxi-arriveby']
 
 
-def parse_args():
+def parse_args(args=None):
+    """
+    :param args: list of command line arguments, defaults to sys.argv
+    """
 
     parser = argparse.ArgumentParser()
     parser.add_argument("--experiment_ID", type=str, default="")
@@ -55,19 +60,71 @@ def parse_args():
     parser.add_argument('--dev_data_ratio', type=int, default=100)
     parser.add_argument('--test_data_ratio', type=int, default=100)
     parser.add_argument('--percent_ground_truth', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=None,
+                        help="seed for sampling ground truth values with --percent_ground_truth")
     parser.add_argument('--no_categorical_slots', action='store_true')
     parser.add_argument('--no_categorical_evaluation', action='store_true')
     parser.add_argument('--only_categorical_evaluation', action='store_true')
     parser.add_argument('--appended_values', type=str, default=None,
-                        choices=['NER', 'ground_truth', 'boosted_NER', 'BERT_VE', 'DB'])
+                        choices=['NER', 'ground_truth', 'boosted_NER', 'BERT_VE', 'DB', 'fuzzy_DB'])
     parser.add_argument('--USR_SYS_tokens', action='store_true')
     parser.add_argument('--append_SYS_values', action='store_true')
     parser.add_argument('--ground_truth_slots', type=str, default="all",
                         choices=["all", "categorical", "noncategorical"])
+    parser.add_argument('--early_exit_decode', action='store_true',
+                        help="at inference, stop decoding (slot, batch) rows once they emit EOS or are not gated ptr")
+    parser.add_argument('--gate_first_decode', action='store_true',
+                        help="at inference, compute all gates first and only generate values for slots gated ptr")
+    parser.add_argument('--streaming_loss', action='store_true',
+                        help="during training, only keep the probability of each target word instead of full pointer distributions")
+    parser.add_argument('--sparse_copy_decode', action='store_true',
+                        help="at inference, keep the copy distribution sparse and skip the vocab distribution when copying must win")
+    parser.add_argument('--causal_encoder', action='store_true',
+                        help="use a unidirectional encoder, which can encode live dialogues one turn at a time")
+    parser.add_argument('--session_cache_MB', type=int, default=256,
+                        help="memory budget for cached encoder states of live dialogues, used with --causal_encoder")
+    parser.add_argument('--host', type=str, default="127.0.0.1", help="address for serve.py to listen on")
+    parser.add_argument('--port', type=int, default=8765, help="port for serve.py to listen on")
+    parser.add_argument('--unix_socket', type=str, default=None,
+                        help="if set, serve.py listens on this unix socket instead of host:port")
+    parser.add_argument('--max_batch_size', type=int, default=32,
+                        help="maximum number of dialogue turns that serve.py predicts in a single batch")
+    parser.add_argument('--max_wait_ms', type=float, default=5,
+                        help="maximum time serve.py waits for more turns before predicting a batch")
+    parser.add_argument('--max_sessions', type=int, default=10000,
+                        help="maximum number of open dialogues in serve.py, the least recently used idle dialogues are closed beyond it")
+    parser.add_argument('--export_path', type=str, default=None,
+                        help="directory for the TorchScript model and vocab written by export.py, defaults to model_path/scripted")
+    parser.add_argument('--quantize', type=str, default=None, choices=['int8'],
+                        help="inference only, dynamically quantize the GRUs and linear layers, runs on cpu")
+    parser.add_argument('--bf16', action='store_true',
+                        help="run the encoder and decoder under bfloat16 autocast, losses stay in fp32")
+    parser.add_argument('--bucket_by_length', action='store_true',
+                        help="batch training turns with similar context lengths, shuffled within buckets every epoch")
+    parser.add_argument('--max_batch_tokens', type=int, default=None,
+                        help="size batches so that batch size * longest context stays under this many tokens, instead of --batch_size")
+    parser.add_argument('--num_workers', type=int, default=0,
+                        help="number of dataloader worker processes, 0 loads batches in the main process")
+    parser.add_argument('--prefetch_factor', type=int, default=2,
+                        help="batches loaded in advance by each dataloader worker")
+    parser.add_argument('--ingestion_workers', type=int, default=0,
+                        help="number of processes reading the MultiWOZ 2.2 dialogue files in parallel, 0 reads them in the main process")
+    parser.add_argument('--stream_train', action='store_true',
+                        help="read the training dialogues from their files every epoch instead of keeping them in memory, "
+                             "for training sets larger than RAM, reads the jsonl copies written by utils/dialogue_stream.py when they exist")
+    parser.add_argument('--shuffle_buffer', type=int, default=10000,
+                        help="with --stream_train, number of training turns shuffled together")
+    parser.add_argument('--preprocessing_cache_path', type=str, default="data/preprocessed",
+                        help="directory of cached preprocessed data, keyed by the input files and preprocessing options")
+    parser.add_argument('--no_preprocessing_cache', action='store_true',
+                        help="always preprocess the data, without reading or writing the cache")
 
-    args = parser.parse_args()
+    args = parser.parse_args(args)
 
     setattr(args, 'device', 'cuda' if cuda.is_available() else 'cpu')
+    # dynamically quantized layers only have cpu kernels
+    if args.quantize:
+        args.device = 'cpu'
     setattr(args, 'UNK_token', UNK_token)
     setattr(args, 'PAD_token', PAD_token)
     setattr(args, 'SOS_token', SOS_token)
@@ -106,6 +163,11 @@ def parse_args():
         "Ground truth values are not determined by the speaker, appending these values to the system utterance\
                 will result in doubly appending values to the system utterance and user utterance"
 
+    assert(not(args.stream_train and (args.bucket_by_length or args.max_batch_tokens))),\
+        "Streamed training turns are batched in the order of the shuffle buffer, they can not be bucketed by length"
+    assert(not(args.stream_train and args.train_data_ratio != 100)),\
+        "--train_data_ratio samples from the whole list of training dialogues, which is never in memory while streaming them"
+
     return vars(args)
 
 
@@ -123,8 +185,13 @@ def parse_args():
 #             found_values[domain_slot] = matches
 #     return found_values
 
-def find_database_value_in_utterance_by_slot(utterance, database):
+def find_database_value_in_utterance_by_slot(utterance, database, matcher=None):
     found_values = {}
+    if matcher is not None:
+        # a single pass over the utterance, see utils.ontology_matcher
+        for ds, v in matcher.found_values(utterance):
+            found_values.setdefault(ds, []).append(v.strip())
+        return found_values
     for domain_slot, values in database.items():
         # matches = re.findall(r"(?=("+'|'.join(values)+r")){e<=1}",
         #                      utterance, re.IGNORECASE)
@@ -141,8 +208,13 @@ def find_database_value_in_utterance_by_slot(utterance, database):
     return found_values
 
 
-def find_database_value_in_utterance(utterance, database):
+def find_database_value_in_utterance(utterance, database, matcher=None):
     found_values = set()
+    if matcher is not None:
+        # a single pass over the utterance, values are added in the same order as below
+        for ds, v in matcher.found_values(utterance):
+            found_values.add(v.strip())
+        return found_values
     for ds, values in database.items():
         matches = []
         utter_lower = utterance.lower()
@@ -160,22 +232,11 @@ def load_multiwoz_database(database_file="data/multi-woz/MULTIWOZ2 2/ontology.js
     return ontology
 
 
-def load_multiwoz_22_database():
-    # Returns all possible values from the database, as a dataset
+MULTIWOZ_22_ONTOLOGY_INDEX = "MultiWOZ_2.2/ontology_index.json"
 
-    files_train = ["MultiWOZ_2.2/train/dialogues_001.json", "MultiWOZ_2.2/train/dialogues_002.json",
-                   "MultiWOZ_2.2/train/dialogues_003.json", "MultiWOZ_2.2/train/dialogues_004.json",
-                   "MultiWOZ_2.2/train/dialogues_005.json", "MultiWOZ_2.2/train/dialogues_006.json",
-                   "MultiWOZ_2.2/train/dialogues_007.json", "MultiWOZ_2.2/train/dialogues_008.json",
-                   "MultiWOZ_2.2/train/dialogues_009.json", "MultiWOZ_2.2/train/dialogues_010.json",
-                   "MultiWOZ_2.2/train/dialogues_011.json", "MultiWOZ_2.2/train/dialogues_012.json",
-                   "MultiWOZ_2.2/train/dialogues_013.json", "MultiWOZ_2.2/train/dialogues_014.json",
-                   "MultiWOZ_2.2/train/dialogues_015.json", "MultiWOZ_2.2/train/dialogues_016.json",
-                   "MultiWOZ_2.2/train/dialogues_017.json"]
-    files_dev = ["MultiWOZ_2.2/dev/dialogues_001.json",
-                 "MultiWOZ_2.2/dev/dialogues_002.json"]
-    files_test = ["MultiWOZ_2.2/test/dialogues_001.json",
-                  "MultiWOZ_2.2/test/dialogues_002.json"]
+
+def read_multiwoz_22_ontology(files):
+    # Returns all values of the domain-slots in the dialogue files, as a dict of domain-slot -> values, in the order found
 
     noncat_slot_names = ["restaurant-food", "restaurant-name", "restaurant-booktime",
                          "attraction-name", "hotel-name", "taxi-destination",
@@ -187,9 +248,10 @@ def load_multiwoz_22_database():
                       "hotel-bookday", "hotel-bookstay", "train-destination", "train-departure",
                       "train-day", "train-bookpeople"]
 
-    ontology = {k: set() for k in noncat_slot_names+cat_slot_names}
+    # dicts keep the order in which values are first found
+    ontology = {k: {} for k in noncat_slot_names+cat_slot_names}
 
-    for f in files_train+files_dev+files_test:
+    for f in files:
         dialogues = json.load(open(f))
         for dialogue_dict in dialogues:
             for turn in dialogue_dict['turns']:
@@ -201,9 +263,9 @@ def load_multiwoz_22_database():
 
                         if type(slot['value']) == list:
                             for v in slot['value']:
-                                ontology[slot['slot']].add(f" {v} ")
+                                ontology[slot['slot']][f" {v} "] = None
                         else:
-                            ontology[slot['slot']].add(f" {slot['value']} ")
+                            ontology[slot['slot']][f" {slot['value']} "] = None
 
                     # belief state only comes attached with user turns
                     if turn['speaker'] == "USER":
@@ -212,7 +274,30 @@ def load_multiwoz_22_database():
                             if ds not in noncat_slot_names+cat_slot_names:
                                 continue
                             for v in values:
-                                ontology[ds].add(f" {v} ")
+                                ontology[ds][f" {v} "] = None
+
+    return {ds: list(values) for ds, values in ontology.items()}
+
+
+def load_multiwoz_22_database():
+    # Returns all possible values from the database, as a dataset
+    # values are read from the dialogues once, and then loaded from the index at MULTIWOZ_22_ONTOLOGY_INDEX
+
+    files_train = ["MultiWOZ_2.2/train/dialogues_001.json", "MultiWOZ_2.2/train/dialogues_002.json",
+                   "MultiWOZ_2.2/train/dialogues_003.json", "MultiWOZ_2.2/train/dialogues_004.json",
+                   "MultiWOZ_2.2/train/dialogues_005.json", "MultiWOZ_2.2/train/dialogues_006.json",
+                   "MultiWOZ_2.2/train/dialogues_007.json", "MultiWOZ_2.2/train/dialogues_008.json",
+                   "MultiWOZ_2.2/train/dialogues_009.json", "MultiWOZ_2.2/train/dialogues_010.json",
+                   "MultiWOZ_2.2/train/dialogues_011.json", "MultiWOZ_2.2/train/dialogues_012.json",
+                   "MultiWOZ_2.2/train/dialogues_013.json", "MultiWOZ_2.2/train/dialogues_014.json",
+                   "MultiWOZ_2.2/train/dialogues_015.json", "MultiWOZ_2.2/train/dialogues_016.json",
+                   "MultiWOZ_2.2/train/dialogues_017.json"]
+    files_dev = ["MultiWOZ_2.2/dev/dialogues_001.json",
+                 "MultiWOZ_2.2/dev/dialogues_002.json"]
+    files_test = ["MultiWOZ_2.2/test/dialogues_001.json",
+                  "MultiWOZ_2.2/test/dialogues_002.json"]
 
+    ontology = load_ontology_index(MULTIWOZ_22_ONTOLOGY_INDEX, files_train+files_dev+files_test,
+                                   read_multiwoz_22_ontology)
     ontology['restaurant-area'].add(" center ")
     return ontology
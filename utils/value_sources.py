@@ -0,0 +1,335 @@
+import os
+import abc
+import random
+import hashlib
+import threading
+import importlib.metadata
+import pickle as pkl
+from functools import lru_cache
+from collections import OrderedDict
+
+from utils.utils import find_database_value_in_utterance, load_multiwoz_database, load_multiwoz_22_database
+from utils.ontology_matcher import ONTOLOGY_MATCHER_VERSION, database_fingerprint, load_ontology_matcher
+
+# sources of the values appended to each turn by utils.multiwoz.get_turn, by --appended_values name
+# heavy dependencies (spaCy, transformers) are only imported when a source using them is constructed
+VALUE_SOURCES = {}
+
+# entities found by spaCy, by model version, see NERCache
+NER_CACHE_PATH = 'data/ner_cache'
+# utterances annotated together by spaCy's pipe, and number of processes annotating them
+NER_BATCH_SIZE = 256
+NER_PROCESSES = min(4, os.cpu_count() or 1)
+
+# values extracted by BertForValueExtraction, by trained model, see BERTValueCache
+BERT_VE_CACHE_PATH = 'data/bert_ve_cache'
+BERT_VE_MODEL_PATH = 'BERT_ValueExtraction_models/MW_bs30_gradacc20_lr1e-4_usrsys-F10.8377'
+BERT_VE_BATCH_SIZE = 32
+
+# utterances extracted one at a time (e.g. live dialogues) are not saved, only this many are kept in memory
+LIVE_CACHE_SIZE = 1024
+
+# the ontology matcher of the DB value source is saved next to the ontology it was built from
+ONTOLOGY_DIRECTORIES = {load_multiwoz_database: 'data/multi-woz/MULTIWOZ2 2',
+                        load_multiwoz_22_database: 'MultiWOZ_2.2'}
+# edits allowed between an ontology value and the utterance by the fuzzy_DB value source
+FUZZY_MAX_EDITS = 1
+
+
+def register_value_source(name):
+    """class decorator, registers a ValueSource under an --appended_values name"""
+    def register(cls):
+        # fail when the plugin is defined, rather than when it is first used
+        assert(not cls.__abstractmethods__), f"value source {name} does not implement {sorted(cls.__abstractmethods__)}"
+        VALUE_SOURCES[name] = cls
+        return cls
+    return register
+
+
+class ValueSource(abc.ABC):
+    """
+    Appends values found in a turn to the turn
+    Subclasses load any model or database they need in __init__, and must implement append_values
+    """
+    # whether the source can be constructed again in each process reading files in parallel,
+    #   sources holding large models, and caches written while reading, stay in the main process
+    process_safe = True
+
+    def __init__(self, load_database):
+        """:param load_database: function returning the ontology of the dataset"""
+        pass
+
+    @classmethod
+    def cache_fingerprint(cls, load_database):
+        """
+        Identity of the model or settings the appended values depend on, part of the preprocessed data cache key
+        computed without constructing the source, so that a cache hit does not load its model
+        :returns: json serializable, None if the values only depend on the dialogues and the command line options
+        """
+        return None
+
+    def annotate(self, utterances):
+        """called with every utterance of a split before they are read, so that they can be processed in batches"""
+        pass
+
+    @abc.abstractmethod
+    def append_values(self, turn, ENT_token, **kwargs):
+        """
+        :param turn: string that is either the system utterance, user utterance, or both
+        :param kwargs: kwargs of get_turn
+        :returns: string of turn, with values appended
+        """
+
+
+@lru_cache(maxsize=None)
+def load_spacy_ner():
+    import en_core_web_sm
+    return en_core_web_sm.load()
+
+
+def entity_tokens(doc):
+    """
+    Tokens appended for the entities of a spaCy doc
+    Only the first token of each entity is appended, ent_iob is an int so ent_iob == "I" never holds
+    """
+    return [str(token) for token in doc if token.ent_iob_ == "B"]
+
+
+class UtteranceCache(abc.ABC):
+    """
+    Values extracted from each utterance, extracted in batches and saved on disk
+    Subclasses implement extract, and choose a path that changes with the extraction model
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.values = {}
+        # least recently used last
+        self.live_values = OrderedDict()
+        # live turns are appended from several threads, the extraction models are called by one thread at a time
+        self.lock = threading.Lock()
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                self.values = pkl.load(f)
+
+    @abc.abstractmethod
+    def extract(self, utterances):
+        """returns the list of values of each utterance"""
+
+    def annotate(self, utterances):
+        """extract the values of the utterances which are not cached yet, and save them"""
+        # dict keeps the first occurrence of each utterance, in order
+        missing = list(dict.fromkeys(u for u in utterances if u not in self.values))
+        if not missing:
+            return
+        print(f"Extracting values from {len(missing)} utterances for {self.path}")
+        for utterance, values in zip(missing, self.extract(missing)):
+            self.values[utterance] = values
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # write to a temporary file first, so that an interrupted run never leaves a partial cache
+        with open(self.path + '.tmp', 'wb') as f:
+            pkl.dump(self.values, f, protocol=pkl.HIGHEST_PROTOCOL)
+        os.replace(self.path + '.tmp', self.path)
+
+    def __getitem__(self, utterance):
+        if utterance in self.values:
+            return self.values[utterance]
+        # utterances which were not annotated beforehand (e.g. live dialogues) are extracted one at a time
+        with self.lock:
+            if utterance not in self.live_values:
+                self.live_values[utterance] = self.extract([utterance])[0]
+                if len(self.live_values) > LIVE_CACHE_SIZE:
+                    self.live_values.popitem(last=False)
+            self.live_values.move_to_end(utterance)
+            return self.live_values[utterance]
+
+
+class NERCache(UtteranceCache):
+    """Entity tokens of each utterance, annotated by spaCy, keyed by the spaCy model and its version"""
+
+    def __init__(self, ner, directory=NER_CACHE_PATH):
+        self.ner = ner
+        meta = ner.meta
+        super(NERCache, self).__init__(os.path.join(directory, f"{meta['lang']}_{meta['name']}-{meta['version']}.pkl"))
+
+    def extract(self, utterances):
+        n_process = NER_PROCESSES if len(utterances) > 10*NER_BATCH_SIZE else 1
+        return [entity_tokens(doc) for doc in self.ner.pipe(utterances, batch_size=NER_BATCH_SIZE, n_process=n_process)]
+
+
+def model_files_fingerprint(model_path):
+    """hash of the names, sizes and modification times of the files of a trained model"""
+    sha = hashlib.sha1()
+    for name in sorted(os.listdir(model_path)) if os.path.isdir(model_path) else []:
+        stat = os.stat(os.path.join(model_path, name))
+        sha.update(f"{name} {stat.st_size} {stat.st_mtime_ns}".encode())
+    return sha.hexdigest()
+
+
+class BERTValueCache(UtteranceCache):
+    """Values of each utterance, extracted by BertForValueExtraction, keyed by the files of the trained model"""
+
+    def __init__(self, ve_model, tokenizer, model_path, directory=BERT_VE_CACHE_PATH):
+        self.ve_model = ve_model
+        self.tokenizer = tokenizer
+        super(BERTValueCache, self).__init__(
+            os.path.join(directory, f"{os.path.basename(model_path)}-{model_files_fingerprint(model_path)[:12]}.pkl"))
+
+    def extract(self, utterances):
+        return self.ve_model.predict_values(self.tokenizer, utterances, batch_size=BERT_VE_BATCH_SIZE)
+
+
+def append_GT_values(turn, turn_label, ENT_token, percent_ground_truth, slots, rng=random):
+    for domain_slot, value in turn_label:
+        if domain_slot in slots:
+            if rng.random() <= percent_ground_truth*0.01:
+                turn += f" {ENT_token} {value}"
+    return turn
+
+
+def append_NER_values(turn, ENT_token, entities):
+    for word in entities:
+        turn += f" {ENT_token} {word}"
+    return turn
+
+
+def append_boosted_NER_values(turn, turn_label, ENT_token, entities):
+    for word in entities:
+        turn += f" {ENT_token} {word}"
+    for domain_slot, value in turn_label:
+        if domain_slot in ['hotel-parking', 'hotel-internet']:
+            turn += f" {ENT_token} {value}"
+    return turn
+
+
+def append_BERT_VE_values(turn, values, ENT_token):
+    for value in values:
+        turn += f" {ENT_token} {value}"
+    return turn
+
+
+def append_DB_values_include_domain_slot_name(turn, database, ENT_token):
+    domain_slot_values = find_database_value_in_utterance(turn, database)
+    for ds, value in domain_slot_values.items():
+        for v in value:
+            turn += f" {ENT_token} {ds} {v}"
+    return turn
+
+
+def append_DB_values(turn, database, ENT_token, matcher=None):
+    domain_slot_values = find_database_value_in_utterance(turn, database, matcher)
+    for value in domain_slot_values:
+        turn += f" {ENT_token} {value}"
+    return turn
+
+
+@register_value_source('ground_truth')
+class GroundTruthValues(ValueSource):
+    def append_values(self, turn, ENT_token, **kwargs):
+        return append_GT_values(turn, kwargs['turn_label'], ENT_token,
+                                kwargs['percent_ground_truth'], kwargs['ground_truth_slots'], kwargs['rng'])
+
+
+@register_value_source('NER')
+class NERValues(ValueSource):
+    process_safe = False
+
+    def __init__(self, load_database):
+        self.cache = NERCache(load_spacy_ner())
+
+    @classmethod
+    def cache_fingerprint(cls, load_database):
+        # versions of the installed packages, spaCy and its model are not imported
+        return {'model': 'en_core_web_sm', 'version': importlib.metadata.version('en_core_web_sm'),
+                'spacy': importlib.metadata.version('spacy')}
+
+    def annotate(self, utterances):
+        self.cache.annotate(utterances)
+
+    def append_values(self, turn, ENT_token, **kwargs):
+        return append_NER_values(turn, ENT_token, self.cache[turn])
+
+
+@register_value_source('boosted_NER')
+class BoostedNERValues(NERValues):
+    def append_values(self, turn, ENT_token, **kwargs):
+        return append_boosted_NER_values(turn, kwargs['turn_label'], ENT_token, self.cache[turn])
+
+
+@register_value_source('BERT_VE')
+class BERTValueExtractionValues(ValueSource):
+    process_safe = False
+
+    def __init__(self, load_database):
+        from torch import cuda
+        from transformers import BertTokenizer
+        from BertForValueExtraction import BertForValueExtraction
+        tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
+        ve_model = BertForValueExtraction(from_pretrained=BERT_VE_MODEL_PATH)
+        if cuda.is_available():
+            ve_model.to('cuda')
+        ve_model.eval()
+        self.cache = BERTValueCache(ve_model, tokenizer, BERT_VE_MODEL_PATH)
+
+    @classmethod
+    def cache_fingerprint(cls, load_database):
+        return {'model': BERT_VE_MODEL_PATH, 'files': model_files_fingerprint(BERT_VE_MODEL_PATH)}
+
+    def annotate(self, utterances):
+        self.cache.annotate(utterances)
+
+    def append_values(self, turn, ENT_token, **kwargs):
+        return append_BERT_VE_values(turn, self.cache[turn], ENT_token)
+
+
+@register_value_source('DB')
+class DatabaseValues(ValueSource):
+    max_edits = 0
+
+    def __init__(self, load_database):
+        self.database = load_database()
+        self.matcher = load_ontology_matcher(self.database, ONTOLOGY_DIRECTORIES.get(load_database, 'data'),
+                                             self.max_edits)
+
+    @classmethod
+    def cache_fingerprint(cls, load_database):
+        # the values found depend on the content of the ontology, which may be read from the dialogue files
+        return {'ontology': database_fingerprint(load_database()), 'max_edits': cls.max_edits,
+                'matcher': ONTOLOGY_MATCHER_VERSION}
+
+    def append_values(self, turn, ENT_token, **kwargs):
+        return append_DB_values(turn, self.database, ENT_token, self.matcher)
+
+
+@register_value_source('fuzzy_DB')
+class FuzzyDatabaseValues(DatabaseValues):
+    """Also appends the ontology values which are misspelled in the turn, by up to FUZZY_MAX_EDITS edits"""
+    max_edits = FUZZY_MAX_EDITS
+
+
+@lru_cache(maxsize=None)
+def get_value_source(appended_values, load_database):
+    """constructs a registered value source once per process, returns None if appended_values is not registered"""
+    if appended_values not in VALUE_SOURCES:
+        return None
+    return VALUE_SOURCES[appended_values](load_database)
+
+
+def value_source_fingerprint(appended_values, load_database):
+    """cache_fingerprint of a registered value source, None if appended_values is not registered"""
+    if appended_values not in VALUE_SOURCES:
+        return None
+    return VALUE_SOURCES[appended_values].cache_fingerprint(load_database)
+
+
+def load_value_source(appended_values, load_database, value_kwargs):
+    """
+    Load the value source used by get_turn into value_kwargs
+    :param appended_values: name of source that generates values
+    :param load_database: function returning the ontology, for the DB value source
+    :param value_kwargs: kwargs for get_turn, updated in place
+    :returns: value_kwargs
+    """
+    value_kwargs['source'] = get_value_source(appended_values, load_database)
+    return value_kwargs